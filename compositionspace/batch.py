@@ -0,0 +1,183 @@
+import os
+import copy
+import json
+import time
+import traceback
+import yaml
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from tqdm.notebook import tqdm
+from compositionspace.datautils import DataPreparation
+
+#peak memory of a specimen as a multiple of its input file size
+DEFAULT_MEMORY_FACTOR = 6
+
+def process_specimen(params, filename):
+    """
+    Run the data preparation stages for a single specimen
+
+    Parameters
+    ----------
+    params: dict
+        Input parameters, ``output_path`` is the output folder of the specimen
+
+    filename: string
+        Name of the pos or apt file in ``input_path``
+
+    Returns
+    -------
+    result: dict
+        Output files, time per stage in seconds, and the error message and
+        traceback if a stage failed
+
+    Notes
+    -----
+    Runs in worker processes, exceptions are caught and reported in the
+    result so that one failing specimen does not stop the batch.
+    """
+    params = copy.deepcopy(params)
+    params["input_files"] = [filename]
+    result = {"specimen": filename, "output_path": params["output_path"],
+              "status": "running", "timings": {}}
+    start = time.time()
+    data = None
+    try:
+        data = DataPreparation(params)
+        stages = [("get_big_slices", data.get_big_slices),
+                  ("get_voxels", data.get_voxels),
+                  ("calculate_voxel_composition", data.calculate_voxel_composition)]
+        for name, stage in stages:
+            stage_start = time.time()
+            stage()
+            result["timings"][name] = time.time() - stage_start
+        result["chunk_files"] = data.chunk_files
+        result["voxel_files"] = data.voxel_files
+        result["voxel_ratio_file"] = data.voxel_ratio_file
+        result["project_file"] = data.get_project().filename
+        result["status"] = "done"
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = repr(e)
+        result["traceback"] = traceback.format_exc()
+    finally:
+        if data is not None and data.project is not None:
+            data.project.close()
+    result["timings"]["total"] = time.time() - start
+    return result
+
+
+class BatchProcessing:
+    """
+    Process every specimen in ``input_path`` independently
+
+    Notes
+    -----
+    The batch is configured with the optional ``batch`` section of the input
+    parameters::
+
+        batch:
+           n_workers: 4
+           memory_budget_gb: 32
+           memory_factor: 6
+
+    Specimens run in parallel worker processes. A specimen is only started
+    if the estimated memory of all running specimens, ``memory_factor``
+    times their input file size, stays within ``memory_budget_gb``. A
+    single specimen larger than the budget is run on its own.
+    """
+    def __init__(self, inputfile):
+        if isinstance(inputfile, dict):
+            self.params = inputfile
+        else:
+            with open(inputfile, "r") as fin:
+                params = yaml.safe_load(fin)
+            self.params = params
+        self.version = "1.0.0"
+        if not os.path.exists(self.params['output_path']):
+            os.mkdir(self.params['output_path'])
+
+    def get_specimen_params(self, filename):
+        """
+        Input parameters for one specimen, with its own output folder
+        """
+        params = copy.deepcopy(self.params)
+        params.pop("batch", None)
+        params["output_path"] = os.path.join(self.params["output_path"], filename.replace(".", "_"))
+        #the specimens are already spread over the workers
+        params["n_workers"] = 1
+        return params
+
+    def estimate_memory(self, filename):
+        """
+        Estimated peak memory in bytes of processing a specimen
+        """
+        batch_params = self.params.get("batch", {})
+        memory_factor = batch_params.get("memory_factor", DEFAULT_MEMORY_FACTOR)
+        path = os.path.join(self.params["input_path"], filename)
+        return memory_factor*os.path.getsize(path)
+
+    def write_manifest(self, results):
+        """
+        Write the results of all finished specimens to batch_manifest.json
+        """
+        manifest = {"input_path": self.params["input_path"],
+                    "specimens": sorted(results, key=lambda result: result["specimen"])}
+        self.manifest_file = os.path.join(self.params["output_path"], "batch_manifest.json")
+        with open(self.manifest_file, "w") as fout:
+            json.dump(manifest, fout, indent=2)
+
+    def run(self):
+        """
+        Run the batch
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        results: list of dicts
+            One entry per specimen, see ``process_specimen``
+
+        Notes
+        -----
+        The manifest is rewritten after every finished specimen, so the
+        progress of an interrupted batch is kept.
+        """
+        batch_params = self.params.get("batch", {})
+        n_workers = batch_params.get("n_workers", 1)
+        budget = batch_params.get("memory_budget_gb", float("inf"))*1024**3
+
+        files, rrng_file = DataPreparation(self.params).get_input_files()
+        pending = [(filename, self.estimate_memory(filename)) for filename in files]
+        running = {}
+        results = []
+
+        pbar = tqdm(total=len(pending), desc="Processing specimens")
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                used = sum(memory for filename, memory in running.values())
+                while len(pending) > 0 and len(running) < n_workers:
+                    filename, memory = pending[0]
+                    if len(running) > 0 and used + memory > budget:
+                        break
+                    pending.pop(0)
+                    future = executor.submit(process_specimen, self.get_specimen_params(filename), filename)
+                    running[future] = (filename, memory)
+                    used += memory
+
+                done, not_done = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    filename, memory = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        #the worker process itself died
+                        result = {"specimen": filename, "status": "failed", "error": repr(e),
+                                  "output_path": self.get_specimen_params(filename)["output_path"],
+                                  "timings": {}}
+                    results.append(result)
+                    self.write_manifest(results)
+                    pbar.update(1)
+        pbar.close()
+
+        self.results = results
+        return results
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+def get_file_identity(file_name):
+    """
+    Identify a file by its path, size and modification time
+
+    Parameters
+    ----------
+    file_name: string
+        Name of the file, or of a directory such as a zarr store
+
+    Returns
+    -------
+    identity: dict
+        Absolute path, size in bytes and mtime in nanoseconds. For a
+        directory, the total size and latest mtime of the files in it.
+    """
+    if os.path.isdir(file_name):
+        size = 0
+        mtime = os.stat(file_name).st_mtime_ns
+        for root, dirs, files in os.walk(file_name):
+            for name in files:
+                stat = os.stat(os.path.join(root, name))
+                size += stat.st_size
+                mtime = max(mtime, stat.st_mtime_ns)
+        return {"path": os.path.abspath(file_name), "size": size, "mtime": mtime}
+    stat = os.stat(file_name)
+    return {"path": os.path.abspath(file_name), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def get_file_hash(file_name, chunk_size=1024*1024):
+    """
+    sha256 of the contents of a file
+    """
+    sha = hashlib.sha256()
+    with open(file_name, "rb") as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_file_fingerprint(file_name, sample_size=1024*1024):
+    """
+    sha256 of the size and the first and last bytes of a file
+
+    Parameters
+    ----------
+    file_name: string
+        Name of the file
+
+    sample_size: int
+        Number of bytes hashed at either end of the file
+
+    Returns
+    -------
+    fingerprint: string
+        Hex digest, cheap to compute even for very large files
+    """
+    size = os.path.getsize(file_name)
+    sha = hashlib.sha256(str(size).encode())
+    with open(file_name, "rb") as fin:
+        sha.update(fin.read(sample_size))
+        if size > sample_size:
+            fin.seek(max(size - sample_size, sample_size))
+            sha.update(fin.read(sample_size))
+    return sha.hexdigest()
+
+
+class StageCache:
+    """
+    Content-addressed cache of the outputs of pipeline stages
+
+    Parameters
+    ----------
+    output_path: string
+        The entries are kept in ``output_path/cache``
+
+    max_age_days: float, optional
+        Entries not used for longer are evicted
+
+    max_size_gb: float, optional
+        If the cache grows larger, the least recently used entries are
+        evicted
+
+    Notes
+    -----
+    A stage hashes everything its output depends on into a key, see
+    ``get_key``. The outputs of the stage are written into the entry folder
+    of that key and registered with ``store``. An entry only counts as
+    complete once its manifest is written, so an interrupted stage is
+    recomputed. Entries used by this instance are never evicted by it.
+    """
+    def __init__(self, output_path, max_age_days=None, max_size_gb=None):
+        self.path = os.path.join(output_path, "cache")
+        self.max_age_days = max_age_days
+        self.max_size_gb = max_size_gb
+        self.used_entries = set()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def get_key(self, stage, inputs):
+        """
+        Hash the inputs of a stage
+
+        Parameters
+        ----------
+        stage: string
+            Name of the stage
+
+        inputs: dict
+            JSON serializable description of everything the stage output
+            depends on, such as file identities and parameters
+
+        Returns
+        -------
+        key: string
+            sha256 hex digest
+        """
+        description = json.dumps({"stage": stage, "inputs": inputs}, sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def get_entry(self, stage, key):
+        """
+        Folder for the outputs of a stage, created if needed
+        """
+        entry = os.path.join(self.path, "{}_{}".format(stage, key[:16]))
+        if not os.path.exists(entry):
+            os.makedirs(entry)
+        self.used_entries.add(entry)
+        return entry
+
+    def lookup(self, stage, key):
+        """
+        Get the outputs of a complete entry
+
+        Parameters
+        ----------
+        stage: string
+            Name of the stage
+
+        key: string
+            Key from ``get_key``
+
+        Returns
+        -------
+        outputs: dict or None
+            The outputs registered with ``store``, None if there is no
+            complete entry or one of its files is missing
+        """
+        entry = os.path.join(self.path, "{}_{}".format(stage, key[:16]))
+        manifest_file = os.path.join(entry, "manifest.json")
+        if not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file, "r") as fin:
+            manifest = json.load(fin)
+        if manifest["key"] != key:
+            return None
+        for file_name in manifest["files"]:
+            if not os.path.exists(file_name):
+                return None
+        #mark as recently used
+        os.utime(manifest_file)
+        self.used_entries.add(entry)
+        return manifest["outputs"]
+
+    def store(self, stage, key, outputs, files):
+        """
+        Register the outputs of a stage and evict old entries
+
+        Parameters
+        ----------
+        stage: string
+            Name of the stage
+
+        key: string
+            Key from ``get_key``
+
+        outputs: dict
+            JSON serializable outputs, returned by ``lookup``
+
+        files: list of strings
+            Files the outputs refer to
+        """
+        entry = self.get_entry(stage, key)
+        manifest = {"stage": stage, "key": key, "created": time.time(),
+                    "outputs": outputs, "files": list(files)}
+        with open(os.path.join(entry, "manifest.json"), "w") as fout:
+            json.dump(manifest, fout, indent=2)
+        self.evict()
+
+    def get_size(self, entry):
+        """
+        Size of an entry in bytes
+        """
+        size = 0
+        for root, dirs, files in os.walk(entry):
+            for file_name in files:
+                size += os.path.getsize(os.path.join(root, file_name))
+        return size
+
+    def get_last_used(self, entry):
+        """
+        Time an entry was last stored or looked up
+        """
+        manifest_file = os.path.join(entry, "manifest.json")
+        if os.path.exists(manifest_file):
+            return os.path.getmtime(manifest_file)
+        return os.path.getmtime(entry)
+
+    def evict(self):
+        """
+        Remove entries older than ``max_age_days`` and, least recently used
+        first, entries beyond ``max_size_gb``
+
+        Returns
+        -------
+        evicted: list of strings
+            Removed entry folders
+        """
+        entries = [os.path.join(self.path, name) for name in os.listdir(self.path)]
+        entries = [entry for entry in entries if os.path.isdir(entry) and entry not in self.used_entries]
+        entries = sorted(entries, key=self.get_last_used)
+        evicted = []
+
+        if self.max_age_days is not None:
+            oldest = time.time() - self.max_age_days*24*3600
+            for entry in list(entries):
+                if self.get_last_used(entry) < oldest:
+                    shutil.rmtree(entry)
+                    entries.remove(entry)
+                    evicted.append(entry)
+
+        if self.max_size_gb is not None:
+            total = sum(self.get_size(entry) for entry in entries)
+            total += sum(self.get_size(entry) for entry in self.used_entries if os.path.exists(entry))
+            for entry in list(entries):
+                if total <= self.max_size_gb*1024**3:
+                    break
+                total -= self.get_size(entry)
+                shutil.rmtree(entry)
+                evicted.append(entry)
+
+        return evicted
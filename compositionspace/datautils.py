@@ -8,15 +8,366 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pickle
 import time
-import h5py
+import uuid
 import warnings
+import contextlib
+from numpy.lib.recfunctions import structured_to_unstructured
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import compositionspace.paraprobe_transcoder as paraprobe_transcoder
+from compositionspace.ranging import RangeTable, MoleculeTable
+from compositionspace.filters import IonFilter
+from compositionspace.cache import StageCache, get_file_identity, get_file_hash, get_file_fingerprint
+from compositionspace.storage import get_backend
+from compositionspace.project import Project
 
 #really check this!
 pd.options.mode.chained_assignment = None
 
+#pos files are headerless big-endian float32 records
+POS_DTYPE = np.dtype({'names':['x', 'y', 'z', 'm'],
+                      'formats':['>f4', '>f4', '>f4', '>f4']})
+
+#number of ions converted or processed at once when streaming input files
+DEFAULT_BLOCK_SIZE = 1000000
+
+#voxels with fewer ions are discarded
+DEFAULT_MIN_VOXEL_IONS = 21
+
+def get_ion_dtype(spec_dtype=np.uint8, vox_dtype=None):
+    """
+    Structured dtype of the ions in the slice and voxel files
+
+    Parameters
+    ----------
+    spec_dtype: np.dtype
+        Type of the species id, see ``ranging.get_species_dtype``
+
+    vox_dtype: np.dtype, optional
+        Type of the voxel id, no voxel id field if None
+
+    Returns
+    -------
+    dtype: np.dtype
+        float32 fields x, y, z and Da, followed by spec and vox_file
+    """
+    fields = [("x", np.float32), ("y", np.float32), ("z", np.float32), ("Da", np.float32), ("spec", spec_dtype)]
+    if vox_dtype is not None:
+        fields.append(("vox_file", vox_dtype))
+    return np.dtype(fields)
+
+
+def get_vox_dtype(n_voxels):
+    """
+    uint32, or uint64 if there are too many voxels
+    """
+    if n_voxels <= np.iinfo(np.uint32).max:
+        return np.dtype(np.uint32)
+    return np.dtype(np.uint64)
+
+
+def get_column(ions, name, columns=None):
+    """
+    A column of an ion array
+
+    Parameters
+    ----------
+    ions: np array
+        Structured ion array, or a 2D array as written by older versions
+
+    name: string
+        Column name
+
+    columns: list of strings, optional
+        Column names of a 2D array, from the ``columns`` attribute of the
+        file
+
+    Returns
+    -------
+    column: np array
+    """
+    if ions.dtype.names is not None:
+        return ions[name]
+    if columns is None:
+        columns = ["x", "y", "z", "Da", "spec", "vox_file"]
+    return ions[:, columns.index(name)]
+
+
+def get_xyz(ions, columns=None):
+    """
+    Ion coordinates as a float array of shape (n, 3), see ``get_column``
+    """
+    if ions.dtype.names is not None:
+        return structured_to_unstructured(ions[["x", "y", "z"]])
+    return np.column_stack([get_column(ions, name, columns) for name in ["x", "y", "z"]])
+
+
+def voxelize(xyz, voxel_size, min_ions=DEFAULT_MIN_VOXEL_IONS):
+    """
+    Assign ions to the voxels of a global cubic grid in a single pass
+
+    Parameters
+    ----------
+    xyz: np array
+        Ion coordinates, shape (n, 3)
+
+    voxel_size: float
+        Edge length of the voxels
+
+    min_ions: int
+        Voxels with fewer ions are discarded
+
+    Returns
+    -------
+    order: np array
+        Indices of the ions in the kept voxels, grouped by voxel
+
+    counts: np array
+        Number of ions in each kept voxel
+
+    lattice: np array
+        Integer grid index (ix, iy, iz) of each kept voxel
+
+    Notes
+    -----
+    The grid is anchored at the origin, voxel (ix, iy, iz) spans the
+    half-open box ``[ix*voxel_size, (ix+1)*voxel_size)`` and so on, so every
+    ion belongs to exactly one voxel and the grid does not depend on which
+    ions are passed. Voxels are ordered by z, then y, then x.
+    """
+    if len(xyz) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 3), dtype=np.int64)
+
+    #float64 so that an ion below a grid plane is never rounded onto it
+    ijk = np.floor(np.asarray(xyz, dtype=np.float64)/voxel_size).astype(np.int64)
+    mins = ijk.min(axis=0)
+    extents = ijk.max(axis=0) - mins + 1
+    local = ijk - mins
+    keys = (local[:,2]*extents[1] + local[:,1])*extents[0] + local[:,0]
+
+    order = np.argsort(keys, kind="stable")
+    voxel_keys, counts = np.unique(keys[order], return_counts=True)
+
+    keep = counts >= min_ions
+    order = order[np.repeat(keep, counts)]
+    voxel_keys = voxel_keys[keep]
+    counts = counts[keep]
+
+    lattice = np.column_stack((voxel_keys % extents[0],
+                               (voxel_keys // extents[0]) % extents[1],
+                               voxel_keys // (extents[0]*extents[1]))) + mins
+    return order, counts, lattice
+
+
+def get_voxel_geometry(xyz, counts, with_bounds=False):
+    """
+    Centroids and bounding boxes of voxels
+
+    Parameters
+    ----------
+    xyz: np array
+        Ion coordinates grouped by voxel, shape (n, 3)
+
+    counts: np array
+        Number of ions in each voxel
+
+    with_bounds: bool
+        If True, also compute the bounding boxes
+
+    Returns
+    -------
+    centroids: np array
+        Mean ion position of every voxel, shape (n_voxels, 3)
+
+    bounds: np array or None
+        Minimum and maximum ion coordinates (xmin, ymin, zmin, xmax, ymax,
+        zmax) of every voxel, shape (n_voxels, 6)
+    """
+    if len(counts) == 0:
+        return np.zeros((0, 3)), (np.zeros((0, 6)) if with_bounds else None)
+    starts = np.cumsum(counts) - counts
+    xyz = np.asarray(xyz, dtype=np.float64)
+    centroids = np.add.reduceat(xyz, starts, axis=0)/counts[:,None]
+    bounds = None
+    if with_bounds:
+        bounds = np.column_stack((np.minimum.reduceat(xyz, starts, axis=0),
+                                  np.maximum.reduceat(xyz, starts, axis=0)))
+    return centroids, bounds
+
+
+def voxelize_chunk(chunk_file, chunk_id, partial_file, voxel_size, min_ions=DEFAULT_MIN_VOXEL_IONS, with_bounds=False, partial_group=None):
+    """
+    Voxelize one big slice and write the result to a partial file
+
+    Parameters
+    ----------
+    chunk_file: string
+        File written by ``DataPreparation.get_big_slices``
+
+    chunk_id: int
+        Index of the slice
+
+    partial_file: string
+        Output file
+
+    voxel_size: float
+        Edge length of the voxels
+
+    min_ions: int
+        Voxels with fewer ions are discarded
+
+    with_bounds: bool
+        If True, also store the bounding boxes of the voxels
+
+    partial_group: string, optional
+        Group of ``partial_file`` to write to. Workers share one zarr store
+        by writing different groups, see ``storage.ZarrBackend``. By default
+        ``partial_file`` is overwritten.
+
+    Returns
+    -------
+    partial_file: string
+        Name of the output file, holding the voxel-sorted ions, the number
+        of ions and the centroid of every voxel
+
+    Notes
+    -----
+    Runs in worker processes, so it only depends on its arguments. Voxel ids
+    are local to the slice, ``DataPreparation.merge_voxel_chunks`` makes
+    them global.
+    """
+    with get_backend(path=chunk_file).open(chunk_file, "r") as hdfr:
+        read_array = hdfr["group_xyz_Da_spec/chunk_{}".format(chunk_id)][...]
+
+    order, counts, lattice = voxelize(get_xyz(read_array), voxel_size, min_ions)
+    voxel_ions = read_array[order]
+    centroids, bounds = get_voxel_geometry(get_xyz(voxel_ions), counts, with_bounds)
+
+    backend = get_backend(path=partial_file)
+    with backend.open(partial_file, "w" if partial_group is None else "a") as hdfw:
+        group = hdfw if partial_group is None else hdfw.create_group(partial_group)
+        backend.create_dataset(group, "ions", data = voxel_ions)
+        backend.create_dataset(group, "counts", data = counts)
+        backend.create_dataset(group, "centroids", data = centroids)
+        if with_bounds:
+            backend.create_dataset(group, "bounds", data = bounds)
+    return partial_file
+
+
+@contextlib.contextmanager
+def open_partial(partial_file, partial_group=None):
+    """
+    Open the output of ``voxelize_chunk`` for reading
+    """
+    with get_backend(path=partial_file).open(partial_file, "r") as hdfr:
+        yield hdfr if partial_group is None else hdfr[partial_group]
+
+
+class VoxelStore:
+    """
+    Read access to the voxels written by ``DataPreparation.get_voxels``
+
+    Parameters
+    ----------
+    filename: string
+        Name of the voxel file
+
+    Notes
+    -----
+    The file holds one ion array sorted by voxel id and an ``offsets`` array
+    indexed by voxel id. If the ion array is stored contiguously it is
+    memory-mapped, so ``store[i]`` is a zero-copy slice of the file.
+    Otherwise the slice is read through h5py, or zarr for ``.zarr`` stores.
+
+    Ions are structured records, see ``get_ion_dtype``. Files written by
+    older versions hold a 2D float array instead, use ``get_column`` to
+    read a column from either.
+
+    Examples
+    --------
+    >>> with VoxelStore("file_R31_pos_small_chunks_arr.h5") as store:
+    ...     ions = store[0]
+    """
+    def __init__(self, filename):
+        if not os.path.exists(filename):
+            raise FileNotFoundError(f"filename {filename} does not exist")
+        self.filename = filename
+        self.backend = get_backend(path=filename)
+        self.hdf = self.backend.open_root(filename, "r")
+        group = self.hdf["voxels"]
+        self.columns = list(group.attrs["columns"])
+        self.spec_name_order = list(group.attrs["spec_name_order"])
+        self.voxel_size = group.attrs["voxel_size"]
+        self.offsets = group["offsets"][...]
+
+        dataset = group["ions"]
+        memmap = None if dataset.size == 0 else self.backend.get_memmap(filename, dataset)
+        if memmap is not None:
+            self.ions = memmap
+        elif dataset.size == 0:
+            self.ions = np.zeros(dataset.shape, dtype=dataset.dtype)
+        else:
+            self.ions = dataset
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, voxel_id):
+        return self.ions[self.offsets[voxel_id]:self.offsets[voxel_id+1]]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.backend.close(self.hdf)
+
+    def get_column(self, ions, name):
+        """
+        A column of ions read from the store, see ``get_column``
+        """
+        return get_column(ions, name, self.columns)
+
+    def get_counts(self):
+        """
+        Number of ions in every voxel
+        """
+        return np.diff(self.offsets)
+
+    def get_centroids(self):
+        """
+        Mean ion position of every voxel, shape (n_voxels, 3)
+        """
+        return self.hdf["voxels/centroids"][...]
+
+    def get_bounds(self):
+        """
+        Bounding box (xmin, ymin, zmin, xmax, ymax, zmax) of every voxel,
+        None if the voxels were written without ``voxel_bounds``
+        """
+        if "bounds" not in self.hdf["voxels"]:
+            return None
+        return self.hdf["voxels/bounds"][...]
+
+    def iter_blocks(self, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Stream the sorted ion array in blocks of rows
+
+        Yields
+        ------
+        start: int
+            Row of the first ion in the block
+
+        block: np array
+            The ions, including their voxel id
+        """
+        for start in range(0, self.ions.shape[0], block_size):
+            yield start, np.asarray(self.ions[start:start+block_size])
+
+
 class DataPreparation:
-    def __init__(self, inputfile):
+    def __init__(self, inputfile, project=None):
         if isinstance(inputfile, dict):
             self.params = inputfile
         else:
@@ -27,14 +378,97 @@ class DataPreparation:
         if not os.path.exists(self.params['output_path']):
             os.mkdir(self.params['output_path'])
 
+        self.cache = None
+        cache_params = self.params.get("cache", None)
+        if cache_params is not None and cache_params.get("enabled", True):
+            self.cache = StageCache(self.params['output_path'],
+                                    max_age_days=cache_params.get("max_age_days", None),
+                                    max_size_gb=cache_params.get("max_size_gb", None))
+        self.project = project
+
+    def get_project(self):
+        """
+        The project file of ``output_path``, opened on first use
+
+        Returns
+        -------
+        project: Project
+            Pass it on to ``CompositionClustering`` and ``DataPostprocess``
+            to share the open file
+        """
+        if self.project is None:
+            self.project = Project.from_params(self.params)
+        return self.project
+
+    def get_stage_cache(self, stage, inputs):
+        """
+        Look up the outputs of a stage in the cache
+        
+        Parameters
+        ----------
+        stage: string
+            Name of the stage
+
+        inputs: dict
+            Everything the stage output depends on
+        
+        Returns
+        -------
+        key: string or None
+            Cache key of the stage, None if caching is disabled
+
+        outputs: dict or None
+            Cached outputs, None if the stage has to run
+
+        prefix: string
+            Folder the stage writes its outputs to
+        
+        Notes
+        -----
+        Caching is enabled with the ``cache`` section of the input
+        parameters::
+
+            cache:
+               enabled: True
+               max_age_days: 30
+               max_size_gb: 100
+
+        Stage outputs are then written to ``output_path/cache`` and reused
+        whenever the inputs hash to the same key.
+        """
+        if self.cache is None:
+            return None, None, self.params['output_path']
+        inputs = dict(inputs, version=self.version)
+        key = self.cache.get_key(stage, inputs)
+        outputs = self.cache.lookup(stage, key)
+        return key, outputs, self.cache.get_entry(stage, key)
+
     def get_label_ions(self, pos, rrngs):
-        pos['comp'] = ''
-        pos['colour'] = '#FFFFFF'
-        pos['nature'] = ''
-        count=0;
-        for n,r in rrngs.iterrows():
-            count= count+1;
-            pos.loc[(pos.Da >= r.lower) & (pos.Da <= r.upper),['comp','colour', 'nature']] = [r['comp'],'#' + r['colour'],count]
+        """
+        Label every ion with the composition, colour and number of its range
+
+        Parameters
+        ----------
+        pos: pandas DataFrame
+            Ions with a Da column
+
+        rrngs: pandas DataFrame
+            Ranges as returned by ``get_rrng``
+
+        Returns
+        -------
+        pos: pandas DataFrame
+            pos with the added columns comp, colour and nature. Unranged ions
+            keep an empty comp, white colour and empty nature.
+        """
+        range_ids = RangeTable(rrngs).get_range_ids(pos['Da'].values)
+        #the appended entry is picked up by the -1 of unranged ions
+        comp = np.append(rrngs['comp'].values.astype(object), '')
+        colour = np.append(('#' + rrngs['colour']).values.astype(object), '#FFFFFF')
+        nature = np.append(np.arange(1, len(rrngs)+1).astype(object), '')
+        pos['comp'] = comp[range_ids]
+        pos['colour'] = colour[range_ids]
+        pos['nature'] = nature[range_ids]
         
         return pos
 
@@ -42,38 +476,70 @@ class DataPreparation:
     def atom_filter(self, x, atom_range):
         
         """
-        Get a list of atom species and their counts
+        Get the ions inside a set of ranges
         
         Parameters
         ----------
+        x: pandas DataFrame
+            Ions, the last column is the mass-to-charge ratio
+
+        atom_range: pandas DataFrame
+            Ranges to keep, as returned by ``get_rrng``
         
         Returns
         -------
+        atom_total: pandas DataFrame
+            Rows of x inside any of the ranges, in their original order
+
+        count_atom: int
+            Number of ions kept
         
         Notes
         -----
-        Assuming all the data
+        Ranges are matched with a single sorted search instead of one pass
+        per range, see ``RangeTable``.
         """
-        atom_total = []
-        x_arr = x.values
-        mass = x_arr[:,-1] 
-        x_columns = x.columns
-        
-        for i in range(len(atom_range)):
-            low_bound = atom_range['lower'][i]
-            upper_bound =  atom_range['upper'][i]
-            
-            id_ = np.where(np.logical_and(mass>=low_bound, mass<=upper_bound))                      
-            atom = x_arr[id_]           
-            atom_total.append(atom)
-             
-        atom_total = tuple(atom_total)
-        atom_total = np.vstack(atom_total)
-        atom_total = pd.DataFrame(atom_total, columns = x_columns)
+        table = RangeTable(atom_range)
+        species_ids = table.get_species_ids(x.values[:,-1])
+        atom_total = x[species_ids != table.unranged]
         count_atom= len(atom_total)
         return atom_total, count_atom        
 
-    def get_pos(self, file_name):
+    def get_pos_memmap(self, file_name):
+        """
+        Memory-map a pos file without reading it
+
+        Parameters
+        ----------
+        file_name: string
+            Name of the input file
+
+        Returns
+        -------
+        pos: np.memmap
+            Read-only structured view with big-endian fields x, y, z and m
+
+        Notes
+        -----
+        No data is copied; pages are only read from disk when the view
+        is accessed.
+
+        Raises
+        ------
+        FileNotFoundError: if the file does not exist
+        ValueError: if the file is truncated
+        """
+        if not os.path.exists(file_name):
+            raise FileNotFoundError(f"filename {file_name} does not exist")
+
+        file_size = os.path.getsize(file_name)
+        if file_size % POS_DTYPE.itemsize != 0:
+            raise ValueError(f"size of {file_name} is not a multiple of {POS_DTYPE.itemsize} bytes")
+        if file_size == 0:
+            return np.zeros(0, dtype=POS_DTYPE)
+        return np.memmap(file_name, dtype=POS_DTYPE, mode="r")
+
+    def get_pos(self, file_name, columns=None, block_size=None, filters=None):
         """
         Read the pos file 
         
@@ -81,33 +547,71 @@ class DataPreparation:
         ----------
         file_name: string
             Name of the input file
+
+        columns: list of strings, optional
+            Subset of ``x``, ``y``, ``z`` and ``m`` to read. All columns
+            are read by default.
+
+        block_size: int, optional
+            Number of ions converted to native byte order at a time.
+            Defaults to ``read_block_size`` from the input parameters.
+
+        filters: dict or IonFilter, optional
+            Mass-to-charge and spatial cuts, see ``IonFilter``
         
         Returns
         -------
         pos: np structured array
-            The atom positions and ---- ratio
+            The atom positions and mass-to-charge ratio as native float32
         
         Notes
         -----
-        Assumptions
-        
-        Examples
-        --------
+        The file is memory-mapped and converted one block of rows at a
+        time, so apart from the returned array only one block is held in
+        memory. Filters are applied to every block, so rejected ions are
+        never copied.
         
         Raises
         ------
-        FileNotFoundError: describe
+        FileNotFoundError: if the file does not exist
+        ValueError: if an unknown column is requested or a filter needs
+            detector data
         """
-        if not os.path.exists(file_name):
-            raise FileNotFoundError(f"filename {file_name} does not exist")
+        pos_view = self.get_pos_memmap(file_name)
+
+        if columns is None:
+            columns = list(POS_DTYPE.names)
+        unknown = [column for column in columns if column not in POS_DTYPE.names]
+        if len(unknown) > 0:
+            raise ValueError(f"unknown pos columns {unknown}, choose from: {list(POS_DTYPE.names)}")
+
+        ion_filter = IonFilter.from_params(filters)
+        if ion_filter is not None and len(ion_filter.sections) > 0:
+            raise ValueError(f"pos files have no {ion_filter.sections} data to filter on")
+
+        if block_size is None:
+            block_size = self.params.get("read_block_size", DEFAULT_BLOCK_SIZE)
+
+        dtype = [(column, np.float32) for column in columns]
+        if ion_filter is None:
+            pos = np.empty(len(pos_view), dtype=dtype)
+            for start in range(0, len(pos_view), block_size):
+                block = pos_view[start:start+block_size]
+                for column in columns:
+                    pos[column][start:start+block_size] = block[column]
+            return pos
+
+        pieces = [np.empty(0, dtype=dtype)]
+        for start in range(0, len(pos_view), block_size):
+            block = pos_view[start:start+block_size]
+            xyzm = np.column_stack([block[column] for column in POS_DTYPE.names]).astype(np.float32)
+            mask = ion_filter.get_mask(xyzm)
+            piece = np.empty(np.count_nonzero(mask), dtype=dtype)
+            for column in columns:
+                piece[column] = block[column][mask]
+            pieces.append(piece)
         
-        with open(file_name, 'rb') as f:
-            dt_type = np.dtype({'names':['x', 'y', 'z', 'm'], 
-                          'formats':['>f4', '>f4', '>f4', '>f4']})
-            pos = np.fromfile(f, dt_type, -1)
-            pos = pos.byteswap().newbyteorder()
-        
-        return pos
+        return np.concatenate(pieces)
 
     def get_rrng(self, file_name):
         """
@@ -115,16 +619,28 @@ class DataPreparation:
         
         Parameters
         ----------
+        file_name: string
+            Name of the range file
         
         Returns
         -------
+        ions, rrngs: pandas DataFrames
+            The ion names and the ranges
         
         Notes
         -----
+        With caching enabled the parsed table is kept in the cache and
+        reused as long as the contents of the range file are unchanged.
         """
         if not os.path.exists(file_name):
             raise FileNotFoundError(f"filename {file_name} does not exist")
 
+        key, outputs, prefix = self.get_stage_cache("rrng", {"file": get_file_hash(file_name)})
+        if outputs is not None:
+            ions = pd.DataFrame(outputs["ions"], columns=['number','name']).set_index('number')
+            rrngs = pd.DataFrame(outputs["rrngs"], columns=['number','lower','upper','vol','comp','colour']).set_index('number')
+            return ions, rrngs
+
         patterns = re.compile(r'Ion([0-9]+)=([A-Za-z0-9]+).*|Range([0-9]+)=(\d+.\d+) +(\d+.\d+) +Vol:(\d+.\d+) +([A-Za-z:0-9 ]+) +Color:([A-Z0-9]{6})')
         ions = []
         rrngs = []
@@ -144,9 +660,13 @@ class DataPreparation:
         rrngs.set_index('number',inplace=True) 
         rrngs[['lower','upper','vol']] = rrngs[['lower','upper','vol']].astype(float)
         rrngs[['comp','colour']] = rrngs[['comp','colour']].astype(str)
+
+        if key is not None:
+            self.cache.store("rrng", key, {"ions": ions.reset_index().values.tolist(),
+                                           "rrngs": rrngs.reset_index().values.tolist()}, [])
         return ions, rrngs
 
-    def get_apt(self, file_name):
+    def get_apt(self, file_name, filters=None):
         """
         Read the apt file 
         
@@ -154,33 +674,208 @@ class DataPreparation:
         ----------
         file_name: string
             Name of the input file
+
+        filters: dict or IonFilter, optional
+            Mass-to-charge, spatial, multiplicity and detector cuts, see
+            ``IonFilter``
         
         Returns
         -------
-        pos: np structured array
-            The atom positions and ---- ratio
+        pos: np array
+            The atom positions and mass-to-charge ratio, shape (n, 4)
         
         Notes
         -----
-        Assumptions
-        
-        Examples
-        --------
+        Only the section headers are parsed and only the Position and Mass
+        sections are memory-mapped, all other branches of the file are skipped.
+        With filters, the file is streamed block-wise and only the kept ions
+        are copied.
         
         Raises
         ------
-        FileNotFoundError: describe
+        FileNotFoundError: if the file does not exist
         """
         if not os.path.exists(file_name):
             raise FileNotFoundError(f"filename {file_name} does not exist")
         
+        if filters is not None:
+            blocks = list(self.iter_ion_blocks(file_name, cached=False, filters=filters))
+            return np.concatenate([np.empty((0, 4), dtype=np.float32)] + blocks)
+
         apt = paraprobe_transcoder.paraprobe_transcoder(file_name)
-        apt.read_cameca_apt()
-        POS = apt.Position
-        MASS = apt.Mass
+        sections = apt.read_sections(["Position", "Mass"])
+        POS = sections["Position"]
+        MASS = sections["Mass"]
         POS_MASS = np.concatenate((POS,MASS),axis = 1)
         return POS_MASS
 
+    def get_input_files(self):
+        """
+        Find the ion and range files in the input path
+        
+        Parameters
+        ----------
+        
+        Returns
+        -------
+        ion_files: list of strings
+            Names of the pos and apt files, sorted
+        
+        rrng_file: string or None
+            Path of the range file
+        
+        Notes
+        -----
+        File extensions are matched case-insensitively. If the parameter
+        ``input_files`` is given, only the listed ion files are used.
+        """
+        ion_files = []
+        rrng_file = None
+        selected = self.params.get("input_files", None)
+        for filename in sorted(os.listdir(self.params["input_path"])):
+            extension = os.path.splitext(filename)[1].lower()
+            if extension in [".pos", ".apt"]:
+                if selected is None or filename in selected:
+                    ion_files.append(filename)
+            elif extension == ".rrng":
+                rrng_file = os.path.join(self.params["input_path"], filename)
+        return ion_files, rrng_file
+
+    def get_ingested_ions(self, file_name):
+        """
+        Parse a pos or apt file once into the cache
+
+        Parameters
+        ----------
+        file_name: string
+            Name of the input file
+
+        Returns
+        -------
+        ions: np.memmap
+            Native float32 array of shape (n, 4) with columns x, y, z, Da
+
+        Notes
+        -----
+        The ions are written to an ``.npy`` file in the cache, keyed by the
+        size, modification time and a fingerprint of the input file, and
+        memory-mapped on every later call. If caching is disabled, see
+        ``get_stage_cache``, the file is read into memory instead.
+        """
+        if self.cache is None:
+            blocks = [np.zeros((0, 4), dtype=np.float32)]
+            blocks += [np.asarray(block, dtype=np.float32) for block in self.iter_ion_blocks(file_name, cached=False)]
+            return np.concatenate(blocks)
+
+        key, outputs, prefix = self.get_stage_cache("ingest",
+            {"file": get_file_identity(file_name), "fingerprint": get_file_fingerprint(file_name)})
+        if outputs is None:
+            if os.path.splitext(file_name)[1].lower() == ".pos":
+                n_ions = len(self.get_pos_memmap(file_name))
+            else:
+                apt = paraprobe_transcoder.paraprobe_transcoder(file_name)
+                n_ions = len(apt.read_sections(["Mass"])["Mass"])
+            npy_file = os.path.join(prefix, "ions.npy")
+            ions = np.lib.format.open_memmap(npy_file, mode="w+", dtype=np.float32, shape=(n_ions, 4))
+            start = 0
+            for block in self.iter_ion_blocks(file_name, cached=False):
+                ions[start:start+len(block)] = block
+                start += len(block)
+            ions.flush()
+            del ions
+            outputs = {"ions": npy_file}
+            self.cache.store("ingest", key, outputs, [npy_file])
+        return np.load(outputs["ions"], mmap_mode="r")
+
+    def iter_ion_blocks(self, file_name, block_size=None, cached=True, filters=None):
+        """
+        Stream the ions of a pos or apt file in fixed-size blocks
+        
+        Parameters
+        ----------
+        file_name: string
+            Name of the input file
+
+        block_size: int, optional
+            Number of ions per block. Defaults to ``read_block_size`` from
+            the input parameters.
+
+        cached: bool
+            Read through the ingest cache if caching is enabled, see
+            ``get_ingested_ions``
+
+        filters: dict or IonFilter, optional
+            Cuts applied to every block, see ``IonFilter``
+        
+        Yields
+        ------
+        block: np array
+            float32 array of shape (block_size, 4) with columns x, y, z, Da.
+            The last block may be shorter. With filters, blocks only hold
+            the kept ions and blocks without any are skipped.
+        
+        Notes
+        -----
+        The file is memory-mapped, so only the current block is held in
+        memory. Blocks are yielded in file order.
+
+        Raises
+        ------
+        FileNotFoundError: if the file does not exist
+        ValueError: if the file is neither a pos nor an apt file, or a
+            filter needs apt sections the file does not have
+        """
+        if not os.path.exists(file_name):
+            raise FileNotFoundError(f"filename {file_name} does not exist")
+
+        if block_size is None:
+            block_size = self.params.get("read_block_size", DEFAULT_BLOCK_SIZE)
+
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension not in [".pos", ".apt"]:
+            raise ValueError(f"{file_name} is neither a pos nor an apt file")
+
+        ion_filter = IonFilter.from_params(filters)
+        extra_sections = [] if ion_filter is None else ion_filter.sections
+        if extension == ".pos" and len(extra_sections) > 0:
+            raise ValueError(f"pos files have no {extra_sections} data to filter on")
+
+        if cached and self.cache is not None and len(extra_sections) == 0:
+            ions = self.get_ingested_ions(file_name)
+            for start in range(0, len(ions), block_size):
+                block = np.array(ions[start:start+block_size])
+                if ion_filter is not None:
+                    block = block[ion_filter.get_mask(block)]
+                    if len(block) == 0:
+                        continue
+                yield block
+            return
+
+        if extension == ".pos":
+            pos_view = self.get_pos_memmap(file_name)
+            n_ions = len(pos_view)
+            columns = [(pos_view, "x"), (pos_view, "y"), (pos_view, "z"), (pos_view, "m")]
+        elif extension == ".apt":
+            apt = paraprobe_transcoder.paraprobe_transcoder(file_name)
+            sections = apt.read_sections(["Position", "Mass"] + extra_sections)
+            n_ions = len(sections["Mass"])
+            position = sections["Position"]
+            columns = [(position, 0), (position, 1), (position, 2), (sections["Mass"], 0)]
+
+        for start in range(0, n_ions, block_size):
+            stop = min(start+block_size, n_ions)
+            block = np.empty((stop-start, 4), dtype=np.float32)
+            for i, (view, key) in enumerate(columns):
+                if isinstance(key, str):
+                    block[:,i] = view[key][start:stop]
+                else:
+                    block[:,i] = view[start:stop, key]
+            if ion_filter is not None:
+                block = block[ion_filter.get_mask(block, {name: sections[name][start:stop] for name in extra_sections})]
+                if len(block) == 0:
+                    continue
+            yield block
+
     def get_apt_dataframe(self):
         """
         Read the data 
@@ -190,216 +885,258 @@ class DataPreparation:
         
         Returns
         -------
+        df_lst: list of pandas DataFrames
+            x, y, z and Da for every pos and apt file in the input path
+
+        files: list of strings
+            Corresponding file names
+
+        ions, rrngs: pandas DataFrames
+            The parsed range file
         
         Notes
         -----
+        All files are held in memory at once, use ``iter_ion_blocks`` to
+        stream large datasets.
         """
         df_Mass_POS_lst = []
-        file_name_lst=[]
         ions = None 
         rrngs = None
 
-        pbar = tqdm(os.listdir(self.params["input_path"]), desc="Reading files")
+        file_name_lst, rrng_file = self.get_input_files()
+        pbar = tqdm(file_name_lst, desc="Reading files")
         for filename in pbar:
-            
-            if filename.endswith(".POS"):
-                #print(filename)
-                path = os.path.join(self.params["input_path"], filename)
-                pos = self.get_pos(path)
-                df_POS_MASS = pd.DataFrame({'x':pos['x'],'y': pos['y'],'z': pos['z'],'Da': pos['m']})
-                df_Mass_POS_lst.append(df_POS_MASS)
-                file_name_lst.append(filename)
-            
-            if filename.lower().endswith(".pos"):
-                path = os.path.join(self.params["input_path"], filename)            
-                pos = self.get_pos(path)
-                df_POS_MASS = pd.DataFrame({'x':pos['x'],'y': pos['y'],'z': pos['z'],'Da': pos['m']})
-                df_Mass_POS_lst.append(df_POS_MASS)
-                file_name_lst.append(filename)
-
-            if filename.endswith(".apt"):
-                path = os.path.join(self.params["input_path"], filename)
-                POS_MASS = self.get_apt(path) 
-                df_POS_MASS = pd.DataFrame(POS_MASS, columns = ["x","y","z","Da"])
-                df_Mass_POS_lst.append(df_POS_MASS)
-                file_name_lst.append(filename)
-
-            if filename.lower().endswith(".rrng"):
-                path = os.path.join(self.params["input_path"], filename) 
-                ions,rrngs = self.get_rrng(path)
-                
-            if filename.endswith(".RRNG"):
-                path = os.path.join(self.params["input_path"], filename) 
-                ions,rrngs = self.get_rrng(rrange_file)
+            path = os.path.join(self.params["input_path"], filename)
+            blocks = list(self.iter_ion_blocks(path, filters=self.params.get("filters", None)))
+            POS_MASS = np.concatenate([np.empty((0, 4), dtype=np.float32)] + blocks)
+            df_POS_MASS = pd.DataFrame(POS_MASS, columns = ["x","y","z","Da"])
+            df_Mass_POS_lst.append(df_POS_MASS)
+
+        if rrng_file is not None:
+            ions,rrngs = self.get_rrng(rrng_file)
                 
         return (df_Mass_POS_lst, file_name_lst, ions, rrngs) 
 
 
 
-    def get_big_slices(self):
+    def get_slice_edges(self, z):
         """
-        Cut the data into specified portions
+        Get the z edges of the big slices
         
         Parameters
         ----------
+        z: np array
+            z coordinates of the ions, sorted
         
         Returns
         -------
+        edges: np array
+            ``n_big_slices+1`` edges, slice i holds the ions with
+            ``edges[i] <= z < edges[i+1]``
         
         Notes
         -----
+        With ``slice_mode: length`` (default) the slices have equal
+        z-length, with ``slice_mode: count`` they hold about the same number
+        of ions, which balances the work of parallel voxelization. Inner
+        edges are snapped to the nearest plane of the voxel grid, see
+        ``voxelize``, so that no voxel is split between two slices. The
+        outer edges are open.
+
+        Raises
+        ------
+        ValueError: if ``slice_mode`` is unknown
         """
-        #df_lst, files, ions, rrngs= read_apt_to_df(folder)
-        df_lst, files, ions, rrngs= self.get_apt_dataframe()
+        size = self.params["voxel_size"]
+        n_slices = self.params["n_big_slices"]
+        slice_mode = self.params.get("slice_mode", "length")
+        if len(z) == 0:
+            edges = np.zeros(n_slices+1)
+        elif slice_mode == "length":
+            edges = np.linspace(z[0], z[-1], n_slices+1)
+        elif slice_mode == "count":
+            quantiles = np.linspace(0, len(z)-1, n_slices+1).round().astype(np.int64)
+            edges = np.asarray(z[quantiles], dtype=np.float64)
+        else:
+            raise ValueError(f"unknown slice_mode {slice_mode}, choose from: ['length', 'count']")
+        edges = np.round(edges/size)*size
+        edges[0] = -np.inf
+        edges[-1] = np.inf
+        return edges
 
-        filestrings = []
-        prefix = self.params['output_path']
-        
-        for idx, file in enumerate(files):
-            org_file = df_lst[idx]
-            atoms_spec = []
-            c = np.unique(rrngs.comp.values)
-            for i in range(len(c)):
-                range_element = rrngs[rrngs['comp']=='{}'.format(c[i])]
-                total, count = self.atom_filter(org_file, range_element)
-                name = i
-                total["spec"] = [name for j in range(len(total))]
-                atoms_spec.append(total)
-
-            df_atom_spec = pd.concat(atoms_spec)
-            x_wu=df_atom_spec
-            sorted_df = x_wu.sort_values(by=['z'])
-
-            filestring = "file_{}_large_chunks_arr.h5".format(file.replace(".","_"))
-            filestring = os.path.join(prefix, filestring)
-            filestrings.append(filestring)
+    def write_big_slices(self, filestring, atom_spec, spec_name_order):
+        """
+        Sort ions by z and write them as big slices
+        
+        Parameters
+        ----------
+        filestring: string
+            Name of the output file
+
+        atom_spec: np array
+            Structured ions with the fields x, y, z, Da and spec
 
-            hdf = h5py.File(filestring, "w")
+        spec_name_order: list of strings
+            Species names, indexed by spec
+        
+        Returns
+        -------
+        
+        Notes
+        -----
+        The ions are sorted by z once and the slice edges are located with
+        ``np.searchsorted``, so every slice is a contiguous half-open range
+        of the sorted array and every ion is written exactly once. The
+        ``hdf5`` section of the input parameters sets the chunking and
+        compression of the datasets, see ``storage.get_dataset_options``.
+        """
+        atom_spec = atom_spec[np.argsort(atom_spec["z"], kind="stable")]
+        z = atom_spec["z"]
+        edges = self.get_slice_edges(z)
+        bounds = np.searchsorted(z, edges, side="left")
+        storage = self.params.get("hdf5", None)
+        backend = get_backend(path=filestring)
+
+        with backend.open(filestring, "w") as hdf:
             group1 = hdf.create_group("group_xyz_Da_spec")
             group1.attrs["columns"] = ["x","y","z","Da","spec"]
-            group1.attrs["spec_name_order"] = list(c)
-            sublength_x= abs((max(sorted_df['z'])-min(sorted_df['z']))/self.params["n_big_slices"])
-            
-            start = min(sorted_df['z'])
-            end = min(sorted_df['z']) + sublength_x
+            group1.attrs["spec_name_order"] = list(spec_name_order)
             
             pbar = tqdm(range(self.params["n_big_slices"]), desc="Creating chunks")
             for i in pbar:
-                temp = sorted_df[sorted_df['z'].between(start, end, inclusive="both")]
-                group1.create_dataset("chunk_{}".format(i), data = temp.values)
-                start += sublength_x
-                end += sublength_x 
-            hdf.close()                
+                backend.create_dataset(group1, "chunk_{}".format(i), storage, data = atom_spec[bounds[i]:bounds[i+1]])
+
+    def get_ranged_ions(self, file_name, table, molecule_table=None):
+        """
+        Stream a specimen and keep its ranged ions
+        
+        Parameters
+        ----------
+        file_name: string
+            Name of the pos or apt file
+
+        table: RangeTable
+            Ranges of the specimen
+
+        molecule_table: MoleculeTable, optional
+            If given, molecular ions are split into their atoms
+        
+        Returns
+        -------
+        atom_spec: np array
+            Structured array with the fields x, y, z, Da and spec, see
+            ``get_ion_dtype``. spec is the species id, or the atom id if
+            ``molecule_table`` is given.
+        
+        Notes
+        -----
+        Atoms of a molecular ion share the position and mass-to-charge ratio
+        of the ion. The ``filters`` of the input parameters are applied while
+        streaming, see ``IonFilter``.
+        """
+        spec_dtype = table.dtype if molecule_table is None else molecule_table.atom_ids.dtype
+        dtype = get_ion_dtype(spec_dtype)
+        atoms_spec = [np.zeros(0, dtype=dtype)]
+        for block in self.iter_ion_blocks(file_name, filters=self.params.get("filters", None)):
+            spec = table.get_species_ids(block[:,3])
+            ranged = spec != table.unranged
+            block = block[ranged]
+            spec = spec[ranged]
+            if molecule_table is not None:
+                parents, spec = molecule_table.decompose(spec)
+                block = block[parents]
+            atom_spec = np.empty(len(block), dtype=dtype)
+            for i, name in enumerate(["x", "y", "z", "Da"]):
+                atom_spec[name] = block[:,i]
+            atom_spec["spec"] = spec
+            atoms_spec.append(atom_spec)
+        return np.concatenate(atoms_spec)
+
+    def get_big_slices(self, molecules=False):
+        """
+        Cut the data into specified portions
+        
+        Parameters
+        ----------
+        molecules: bool
+            If True, molecular ions are split into their atoms, see
+            ``get_big_slices_molecules``
+        
+        Returns
+        -------
+        
+        Notes
+        -----
+        Every specimen is streamed block-wise, ranged with ``RangeTable``
+        and only the ranged ions are kept. See ``write_big_slices`` for
+        how the slices are cut. With caching enabled, see
+        ``get_stage_cache``, the slices are reused as long as the input
+        files, the range file contents and the slicing parameters are
+        unchanged.
+        """
+        files, rrng_file = self.get_input_files()
+        if rrng_file is None:
+            raise FileNotFoundError(f"no range file found in {self.params['input_path']}")
+        key, outputs, prefix = self.get_stage_cache("slices",
+            {"files": [get_file_identity(os.path.join(self.params["input_path"], file)) for file in files],
+             "rrng": get_file_hash(rrng_file), "molecules": molecules,
+             "n_big_slices": self.params["n_big_slices"], "voxel_size": self.params["voxel_size"],
+             "slice_mode": self.params.get("slice_mode", "length"),
+             "filters": self.params.get("filters", None), "hdf5": self.params.get("hdf5", None),
+             "storage_backend": self.params.get("storage_backend", None)})
+        if outputs is not None:
+            self.chunk_files = outputs["chunk_files"]
+            self.get_project().set_files("slices", self.chunk_files)
+            return
+
+        ions, rrngs = self.get_rrng(rrng_file)
+        table = RangeTable(rrngs)
+        molecule_table = None
+        c = table.species_names
+        if molecules:
+            molecule_table = MoleculeTable(table.species_names)
+            c = molecule_table.atom_names
+
+        filestrings = []
+        backend = get_backend(self.params.get("storage_backend", None))
+        
+        for file in files:
+            path = os.path.join(self.params["input_path"], file)
+            atom_spec = self.get_ranged_ions(path, table, molecule_table)
+
+            filestring = "file_{}_large_chunks_arr{}".format(file.replace(".","_"), backend.extension)
+            filestring = os.path.join(prefix, filestring)
+            filestrings.append(filestring)
+            self.write_big_slices(filestring, atom_spec, c)
 
         self.chunk_files = filestrings 
+        self.get_project().set_files("slices", filestrings)
+        if key is not None:
+            self.cache.store("slices", key, {"chunk_files": filestrings}, filestrings)
 
     def get_big_slices_molecules(self):
-        df_lst, files,ions,rrngs = self.get_apt_dataframe()
-        for file_idx in range(len(files)):
-            Org_file =df_lst[file_idx]  
-
-            atoms_spec = []
-            c = np.unique(rrngs.comp.values)
-            for i in range(len(c)):
-                print(c[i])
-
-                range_element = rrngs[rrngs['comp']=='{}'.format(c[i])]
-                total, Count = atom_filter(Org_file,range_element)
-                name = c[i]
-                #name = i 
-                total["spec"] = [name for j in range(len(total))]
-                atoms_spec.append(total)
-
-            Df_atom_spec = pd.concat(atoms_spec)
-    #############################
-            #check molecules:
-            print("MOLECULE CHECK")
-            molecule_check = np.array([len(c[i].split(" ")) for i in range(len(c))])
-            molecules = c[np.argwhere(molecule_check == 2)]
-
-            Df_lst = [] 
-            for mol in molecules:
-                spec_mol = mol[0].split(" ")
-                Df = Df_atom_spec.loc[Df_atom_spec['spec'] == mol[0]].copy()
-                Df["spec"] = [spec_mol[1]]*len(Df)
-
-                Df_atom_spec.loc[Df_atom_spec['spec'] == mol[0], ['spec'] ] = spec_mol[0]
-
-                Df_lst.append(Df)
-            Df_lst.append(Df_atom_spec) 
-            Df_atom_spec = pd.concat(Df_lst)
-
-            SpecSemi = np.unique(Df_atom_spec.spec.values)
-
-            #check doubles
-            print(SpecSemi)
-            mol_doub_check = np.array([int(SpecSemi[j].split(":")[1]) for j in range(len(SpecSemi))])
-            mol_doub = SpecSemi[np.argwhere(mol_doub_check == 2)] 
-
-            Df_lst = []
-            for mol in mol_doub:
-                spec_mol = mol[0].split(":")[0]+":1"
-                Df = Df_atom_spec.loc[Df_atom_spec['spec'] == mol[0]].copy()
-                Df["spec"] = [spec_mol]*len(Df)
-
-                Df_atom_spec.loc[Df_atom_spec['spec'] == mol[0], ['spec'] ] = spec_mol
-
-                Df_lst.append(Df)
-            Df_lst.append(Df_atom_spec) 
-            Df_atom_spec = pd.concat(Df_lst)
-            SpecFinal = np.unique(Df_atom_spec.spec.values)
-
-            Df_spec_lst = []
-            for spec_ID in range(len(SpecFinal)):
-                print( SpecFinal[spec_ID])
-
-                Df = Df_atom_spec.loc[Df_atom_spec['spec'] == SpecFinal[spec_ID]].copy()
-                name = spec_ID 
-                Df["spec"] = [name for j in range(len(Df))]
-                Df_spec_lst.append(Df)
-            Df_atom_spec = pd.concat(Df_spec_lst)        
-
-
-    ############################        
-
-            x_wu=Df_atom_spec
-            sort_x = x_wu.sort_values(by=['z'])
-
-            ## open hdf5 file 
-            #hdf = pd.HDFStore("./file_{}_large_chunks.h5".format(files[file_idx].replace(".","_")))
-            
-            output_path = self.params['output_path'] + "/Output_big_slices.h5"
-            hdf = h5py.File(output_path, "w")          
-            G1 = hdf.create_group("Group_xyz_Da_spec")
-            G1.attrs["columns"] = ["x","y","z","Da","spec"]
-            G1.attrs["spec_name_order"] = list(SpecFinal)
-            ##end
-
-            sublength_x= abs((max(sort_x['z'])-min(sort_x['z']))/self.params["n_big_slices"])
-            print(sublength_x)
-            start = min(sort_x['z'])
-            end = min(sort_x['z']) +sublength_x
-            for i in tqdm(range(self.params["n_big_slices"])):
-                #temp = sort_x.iloc[start:end]
-                print(start)
-                print(end)
-                temp = sort_x[sort_x['z'].between(start, end, inclusive=True)]
-
-                #temp.to_csv('B3_Hi_ent_cubes/{}.csv'.format(i), index=False)
-                #hdf.put("chunk_{}".format(i), temp, format = "table", data_columns= True)
-                ##Put data into hdf5 file
-                G1.create_dataset("chunk_{}".format(i), data = temp.values)
-                ##end
-
-                start += sublength_x
-                end += sublength_x
-                #print(end) 
-            hdf.close() 
-            
-            
-    def get_voxels(self):
         """
+        Cut the data into specified portions, splitting molecular ions
+        
+        Parameters
+        ----------
+        
+        Returns
+        -------
         
+        Notes
+        -----
+        The range species are decomposed once into a lookup table of their
+        atoms, see ``MoleculeTable``. Every ion is then expanded into its
+        atoms with a single ``np.repeat``, so for example a "Ti:1 O:2" ion
+        becomes one Ti:1 and two O:1 atoms at the ion position. The spec
+        column holds the atom species.
+        """
+        self.get_big_slices(molecules=True)
+
+    def get_voxels(self):
+        """
+        Split the big slices into cubic voxels
         
         Parameters
         ----------
@@ -409,136 +1146,259 @@ class DataPreparation:
         
         Notes
         -----
+        Ions are binned on a global grid with edge length ``voxel_size`` in
+        one sort per slice, see ``voxelize``. Voxels with fewer than
+        ``min_voxel_ions`` ions (default 21) are discarded. Voxel ids
+        increase with z, then y, then x.
+
+        The ions of all voxels are stored in a single array sorted by voxel
+        id, the ions of voxel i are the rows ``offsets[i]:offsets[i+1]``.
+        The centroid of every voxel, and its bounding box if ``voxel_bounds``
+        is set, are computed in the same pass. Use ``VoxelStore`` to read
+        them.
+
+        With ``n_workers`` > 1 the slices are voxelized in a process pool,
+        each writing a partial file that is merged in slice order, so the
+        output is identical to a serial run.
         """
         filestrings = []
-        prefix = self.params['output_path']
         size = self.params["voxel_size"]
+        min_ions = self.params.get("min_voxel_ions", DEFAULT_MIN_VOXEL_IONS)
+        with_bounds = self.params.get("voxel_bounds", False)
+        n_workers = self.params.get("n_workers", 1)
+
+        key, outputs, prefix = self.get_stage_cache("voxels",
+            {"chunk_files": [get_file_identity(filename) for filename in self.chunk_files],
+             "voxel_size": size, "min_voxel_ions": min_ions, "voxel_bounds": with_bounds,
+             "hdf5": self.params.get("hdf5", None), "storage_backend": self.params.get("storage_backend", None)})
+        if outputs is not None:
+            self.voxel_files = outputs["voxel_files"]
+            self.get_project().set_files("voxels", self.voxel_files)
+            return
 
         for filename in self.chunk_files:
-            hdfr = h5py.File(filename, "r")
-            filestring = filename.replace("large", "small")
-            #filestring = os.path.join(prefix, filestring)
+            filestring = os.path.basename(filename).replace("large", "small")
+            filestring = os.path.join(prefix, filestring)
             filestrings.append(filestring)
-
-            with h5py.File(filestring, "w") as hdfw:
-                group_r = hdfr.get("group_xyz_Da_spec")
-                group_keys = list(group_r.keys())
-                columns_r = list(list(group_r.attrs.values())[0])
-
-                group1 = hdfw.create_group("0")
-                prev_attri =list(list(group_r.attrs.values())[0])
-                prev_attri.append("vox_file")
-                group1.attrs["columns"] =  prev_attri
-                group1.attrs["spec_name_order"] = list(list(group_r.attrs.values())[1])
-
-                name_sub_file = 0
-                step = 0
-                m=0
-
-                pbar = tqdm(group_keys, desc="Getting Voxels")
-                for key in pbar:
-                    read_array = np.array(group_r.get(key))
-                    s= pd.DataFrame(data = read_array, columns =  columns_r)
-                    x_min = round(min(s['x']))
-                    x_max = round(max(s['x']))
-                    y_min = round(min(s['y']))
-                    y_max = round(max(s['y']))
-                    z_min = round(min(s['z']))
-                    z_max = round(max(s['z']))   
-                    p=[]
-                    x=[]
-
-                    for i in range(z_min, z_max, size):
-                        cubic = s[s['z'].between(i, i+size, inclusive="both")]
-                        for j in range(y_min, y_max, size):
-                            p = cubic[cubic['y'].between(j, j+size, inclusive="both")]
-                            for k in range(x_min, x_max, size):
-                                x = p[p['x'].between(k, k+size, inclusive="both")]
-                                if len(x['x'])>20:
-                                    #warnings.warn("I am running some code with hardcoded numbers. Really recheck what's up here!")
-                                    name ='cubes_z{}_x{}_y{}'.format(i,j,k).replace("-","m")
-                                    if step>99999:
-                                        step=0
-                                        m=m+1
-                                        group1 = hdfw.create_group("{}".format(100000*m))
-
-                                    x["vox_file"] = [name_sub_file for n_file in range(len(x))]
-                                    group1.create_dataset("{}".format(name_sub_file), data = x.values)
-                                    name_sub_file = name_sub_file+1
-                                    step=step+1
-                group1 = hdfw.get("0")
-                group1.attrs["total_voxels"]="{}".format(name_sub_file)
+            backend = get_backend(path=filestring)
+
+            with backend.open(filename, "r") as hdfr:
+                group_r = hdfr["group_xyz_Da_spec"]
+                n_chunks = len(list(group_r.keys()))
+                columns = list(group_r.attrs["columns"]) + ["vox_file"]
+                spec_name_order = list(group_r.attrs["spec_name_order"])
+
+            if backend.name == "zarr":
+                #the workers write their voxels into groups of the final store
+                with backend.open(filestring, "w") as hdfw:
+                    hdfw.create_group("parts")
+                partials = [(filestring, "parts/{}".format(i)) for i in range(n_chunks)]
+            else:
+                partials = [(filestring.replace(".h5", "_part_{}.h5".format(i)), None) for i in range(n_chunks)]
+            jobs = [(filename, i, partials[i][0], size, min_ions, with_bounds, partials[i][1]) for i in range(n_chunks)]
+            pbar = tqdm(total=n_chunks, desc="Getting Voxels")
+            if n_workers > 1:
+                with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                    futures = [executor.submit(voxelize_chunk, *job) for job in jobs]
+                    for future in as_completed(futures):
+                        future.result()
+                        pbar.update(1)
+            else:
+                for job in jobs:
+                    voxelize_chunk(*job)
+                    pbar.update(1)
+            pbar.close()
+
+            self.merge_voxel_chunks(partials, filestring, columns, spec_name_order)
 
         self.voxel_files = filestrings
+        self.get_project().set_files("voxels", filestrings)
+        if key is not None:
+            self.cache.store("voxels", key, {"voxel_files": filestrings}, filestrings)
 
-    def calculate_voxel_composition(self, fileindex=0, outfilename="output_vox_ratio_composition.h5"):
-        vox_ratio_files = []
-
-        for voxel_file in self.voxel_files:
-            small_chunk_file_name = self.voxel_files[fileindex]
-            hdf_sm_r = h5py.File(small_chunk_file_name, "r")
-            group = hdf_sm_r.get("0")
-            
-            total_voxels =list(list(group.attrs.values())[2])
-            spec_lst_len = len(list(list(group.attrs.values())[1]))
+    def merge_voxel_chunks(self, partials, filestring, columns, spec_name_order):
+        """
+        Merge the voxels of the big slices into one voxel file
+        
+        Parameters
+        ----------
+        partials: list of tuples
+            File and group written by ``voxelize_chunk``, in slice order. The
+            group is None for separate partial files.
 
-            items = list(hdf_sm_r.items())
-            item_lst = []
+        filestring: string
+            Name of the merged voxel file
 
-            ### CHECK THESE NUMBERS!
-            for item in range(len(items)):
-                item_lst.append([100000*(item), 100000*(item+1)])
-            item_lst = np.array(item_lst)
+        columns: list of strings
+            Column names of the merged ion array
 
-            total_voxels_int =""
-            for number in total_voxels:
-                total_voxels_int = total_voxels_int + number
+        spec_name_order: list of strings
+            Species names
+        
+        Returns
+        -------
+        
+        Notes
+        -----
+        Global voxel ids are assigned in slice order, so the result does not
+        depend on how many workers wrote the partial files. Only one slice is
+        held in memory at a time and the partial files or groups are removed.
+        The voxel
+        id is stored as uint32, or uint64 if needed. Only uncompressed,
+        contiguous ion arrays can be memory-mapped by ``VoxelStore``.
+        """
+        size = self.params["voxel_size"]
+        n_ions = 0
+        n_voxels = 0
+        with_bounds = True
+        for partial_file, partial_group in partials:
+            with open_partial(partial_file, partial_group) as hdfr:
+                n_ions += hdfr["ions"].shape[0]
+                n_voxels += hdfr["counts"].shape[0]
+                with_bounds = with_bounds and "bounds" in hdfr
+                spec_dtype = hdfr["ions"].dtype["spec"]
+        dtype = get_ion_dtype(spec_dtype, get_vox_dtype(n_voxels))
+        storage = self.params.get("hdf5", None)
+        backend = get_backend(path=filestring)
+        shared = any(partial_group is not None for partial_file, partial_group in partials)
+
+        with backend.open(filestring, "a" if shared else "w") as hdfw:
+            if "voxels" in hdfw:
+                del hdfw["voxels"]
+            group1 = hdfw.create_group("voxels")
+            group1.attrs["columns"] = columns
+            group1.attrs["spec_name_order"] = spec_name_order
+            group1.attrs["voxel_size"] = size
+            group1.attrs["total_voxels"] = n_voxels
+            ions = backend.create_dataset(group1, "ions", storage, shape=(n_ions,), dtype=dtype)
+            offsets = backend.create_dataset(group1, "offsets", storage, shape=(n_voxels+1,), dtype=np.int64)
+            centroids = backend.create_dataset(group1, "centroids", storage, shape=(n_voxels, 3), dtype=np.float64)
+            if with_bounds:
+                bounds = backend.create_dataset(group1, "bounds", storage, shape=(n_voxels, 6), dtype=np.float64)
+
+            ion_start = 0
+            voxel_start = 0
+            offsets[0] = 0
+            for partial_file, partial_group in partials:
+                with open_partial(partial_file, partial_group) as hdfr:
+                    counts = hdfr["counts"][...]
+                    ion_end = ion_start + int(counts.sum())
+                    voxel_end = voxel_start + len(counts)
+                    if ion_end > ion_start:
+                        part = hdfr["ions"][...]
+                        block = np.empty(len(part), dtype=dtype)
+                        for name in part.dtype.names:
+                            block[name] = part[name]
+                        block["vox_file"] = np.repeat(np.arange(voxel_start, voxel_end), counts)
+                        ions[ion_start:ion_end] = block
+                    if voxel_end > voxel_start:
+                        offsets[voxel_start+1:voxel_end+1] = ion_start + np.cumsum(counts)
+                        centroids[voxel_start:voxel_end] = hdfr["centroids"][...]
+                        if with_bounds:
+                            bounds[voxel_start:voxel_end] = hdfr["bounds"][...]
+                if partial_group is None:
+                    get_backend(path=partial_file).remove(partial_file)
+                else:
+                    del hdfw[partial_group]
+                    parent = os.path.dirname(partial_group)
+                    if parent != "" and len(list(hdfw[parent].keys())) == 0:
+                        del hdfw[parent]
+                ion_start = ion_end
+                voxel_start = voxel_end
+
+    def calculate_voxel_composition(self, fileindex=0, outfilename=None):
+        """
+        Calculate the composition of every voxel
+        
+        Parameters
+        ----------
+        fileindex: int
+            Index of the voxel file in ``self.voxel_files``
 
-            total_voxels_int = int(total_voxels_int)
-            
-            files = [file_num for file_num in range(total_voxels_int)]
-
-            spec_names =  np.arange(spec_lst_len)
-            dic_ratios = {}
-            for spec_name in spec_names:
-                dic_ratios["{}".format(spec_name)] = []
-
-            dic_ratios["Total_no"]=[]
-            dic_ratios["file_name"]=[]
-            dic_ratios["vox"] = []
-
-            ratios = []
-            f_count = 0
-            pbar = tqdm(files, desc="Calculating voxel composition")
-            for filename in pbar:
-                group = np.min(item_lst[[filename in range(j[0],j[1]) for j in item_lst]])
-                arr = np.array(hdf_sm_r.get("{}/{}".format(group,filename))[:,4])
-                N_x = len(arr)
-
-                for spec in (spec_names):
-                    ratio = (len(np.argwhere(arr==spec)))/N_x
-                    dic_ratios["{}".format(spec)].append(ratio)
-
-                dic_ratios["file_name"].append(filename)
-                dic_ratios["vox"].append(f_count)
-                dic_ratios["Total_no"].append(N_x)
-                f_count = f_count+1
-                
-            df = pd.DataFrame.from_dict(dic_ratios)
-            
+        outfilename: string, optional
+            Name of a separate output file in ``output_path``. By default
+            the composition is written to the project file.
+        
+        Returns
+        -------
+        
+        Notes
+        -----
+        The (n_voxels, n_species) count matrix is built with one
+        ``np.bincount`` over combined voxel and species ids per block of the
+        sorted ion array. The ``composition`` group holds the datasets
+
+        - ``vox_ratios``: species ratios, the total number of ions and the
+          voxel id, described by the ``columns`` attribute
+        - ``vox_counts``: integer ion count of every species
+        - ``vox_totals``: integer total number of ions
+        - ``vox_centroids`` and, if available, ``vox_bounds``: copied from
+          the voxel file
+
+        ``self.voxel_ratio_file`` is set to the file holding the group.
+        """
+        small_chunk_file_name = self.voxel_files[fileindex]
+        block_size = self.params.get("read_block_size", DEFAULT_BLOCK_SIZE)
+        storage = self.params.get("hdf5", None)
+        project = self.get_project()
+        output_path = project.filename
+        if outfilename is not None:
             output_path = os.path.join(self.params["output_path"], outfilename)
-            with h5py.File(output_path, "w") as hdfw:
-                hdfw.create_dataset("vox_ratios", data =df.drop("file_name", axis = 1).values )
-                hdfw.attrs["what"] = ["All the Vox ratios for a given APT smaple"]
-                hdfw.attrs["howto_Group_name"] = ["Group_sm_vox_xyz_Da_spec/"]
-                df_actual = df.drop("file_name", axis = 1)
-                df_columns = list(df_actual.columns)
-                hdfw.attrs["columns"]= df_columns
-            hdf_sm_r.close()
 
+        key, outputs, prefix = self.get_stage_cache("composition",
+            {"voxel_file": get_file_identity(small_chunk_file_name), "hdf5": storage,
+             "storage_backend": self.params.get("storage_backend", None)})
+        if outputs is not None:
+            composition_file = outputs["composition_file"]
+            with get_backend(path=composition_file).open(composition_file, "r") as hdfr, project.write_stage(output_path, "composition") as group:
+                get_backend(path=output_path).copy_group(hdfr["composition"], group)
+            self.voxel_ratio_file = output_path
+            return
+
+        with VoxelStore(small_chunk_file_name) as store:
+            n_voxels = len(store)
+            spec_lst_len = len(store.spec_name_order)
+            totals = store.get_counts()
+
+            counts = np.zeros((n_voxels, spec_lst_len), dtype=np.uint32)
+            pbar = tqdm(store.iter_blocks(block_size), desc="Calculating voxel composition",
+                        total=int(np.ceil(store.ions.shape[0]/block_size)))
+            for start, block in pbar:
+                #the ions are sorted by voxel, so a block covers a contiguous range of voxels
+                vox = np.searchsorted(store.offsets, np.arange(start, start+len(block)), side="right") - 1
+                first, last = vox[0], vox[-1] + 1
+                flat = (vox - first)*spec_lst_len + store.get_column(block, "spec").astype(np.int64)
+                counts[first:last] += np.bincount(flat, minlength=(last-first)*spec_lst_len).reshape(-1, spec_lst_len).astype(np.uint32)
+            spec_name_order = store.spec_name_order
+            centroids = store.get_centroids()
+            bounds = store.get_bounds()
+
+        ratios = counts/np.maximum(totals, 1)[:,None]
+        vox_ratios = np.column_stack((ratios, totals, np.arange(n_voxels)))
+        df_columns = ["{}".format(spec_name) for spec_name in range(spec_lst_len)] + ["Total_no", "vox"]
+        #identifies this composition to the stages derived from it, the cached copy keeps the same id
+        composition_id = uuid.uuid4().hex
+
+        def write_composition(group, backend):
+            backend.create_dataset(group, "vox_ratios", storage, data = vox_ratios)
+            backend.create_dataset(group, "vox_counts", storage, data = counts)
+            backend.create_dataset(group, "vox_totals", storage, data = totals)
+            backend.create_dataset(group, "vox_centroids", storage, data = centroids)
+            if bounds is not None:
+                backend.create_dataset(group, "vox_bounds", storage, data = bounds)
+            group.attrs["what"] = ["All the Vox ratios for a given APT smaple"]
+            group.attrs["columns"]= df_columns
+            group.attrs["spec_name_order"] = list(spec_name_order)
+            group.attrs["voxel_file"] = os.path.abspath(small_chunk_file_name)
+            group.attrs["composition_id"] = composition_id
+
+        with project.write_stage(output_path, "composition") as group:
+            write_composition(group, get_backend(path=output_path))
         self.voxel_ratio_file = output_path
 
-
-    
-    
-
+        if key is not None:
+            backend = get_backend(self.params.get("storage_backend", None))
+            composition_file = os.path.join(prefix, "composition" + backend.extension)
+            with backend.open(composition_file, "w") as hdfw:
+                write_composition(hdfw.create_group("composition"), backend)
+            self.cache.store("composition", key, {"composition_file": composition_file}, [composition_file])
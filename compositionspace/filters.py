@@ -0,0 +1,125 @@
+"""
+Ion filters applied block-wise while streaming pos and apt files
+"""
+
+import numpy as np
+
+
+class IonFilter:
+    """
+    Conjunction of cuts on mass-to-charge, position and detector data
+
+    Parameters
+    ----------
+    mass_windows: list of [lower, upper], optional
+        Ions are kept if their mass-to-charge ratio lies in any window,
+        bounds inclusive
+
+    box: [[xmin, ymin, zmin], [xmax, ymax, zmax]], optional
+        Ions are kept if they lie inside the box, bounds inclusive
+
+    cylinder: [x, y, radius], optional
+        Ions are kept if they lie within ``radius`` of the axis parallel to
+        z through (x, y)
+
+    multiplicity: [min, max], optional
+        Ions are kept if their multiplicity lies in the range. Requires the
+        Multiplicity section of an apt file.
+
+    detector_radius: float, optional
+        Ions are kept if their hit lies within this radius of the detector
+        centre, in mm. Requires the XDet_mm and YDet_mm sections of an apt
+        file.
+
+    Notes
+    -----
+    Filters are usually given in the input parameters, for example::
+
+        filters:
+           mass_windows: [[0.5, 70], [90, 110]]
+           cylinder: [0, 0, 20]
+           multiplicity: [1, 1]
+    """
+    def __init__(self, mass_windows=None, box=None, cylinder=None, multiplicity=None, detector_radius=None):
+        self.mass_windows = None
+        if mass_windows is not None:
+            windows = np.asarray(mass_windows, dtype=np.float64).reshape(-1, 2)
+            if np.any(windows[:,1] < windows[:,0]):
+                raise ValueError(f"mass windows {windows.tolist()} have an upper bound below the lower bound")
+            self.mass_windows = windows
+        self.box = None if box is None else np.asarray(box, dtype=np.float64).reshape(2, 3)
+        self.cylinder = None if cylinder is None else np.asarray(cylinder, dtype=np.float64).reshape(3)
+        self.multiplicity = None if multiplicity is None else np.asarray(multiplicity, dtype=np.float64).reshape(2)
+        self.detector_radius = detector_radius
+
+    @classmethod
+    def from_params(cls, filters):
+        """
+        Create a filter from a dict, an existing filter or None
+
+        Parameters
+        ----------
+        filters: dict, IonFilter or None
+            The ``filters`` section of the input parameters
+
+        Returns
+        -------
+        ion_filter: IonFilter or None
+            None if no filter is given
+        """
+        if filters is None or isinstance(filters, IonFilter):
+            return filters
+        unknown = [key for key in filters if key not in ["mass_windows", "box", "cylinder", "multiplicity", "detector_radius"]]
+        if len(unknown) > 0:
+            raise ValueError(f"unknown filters {unknown}")
+        return cls(**filters)
+
+    @property
+    def sections(self):
+        """
+        Extra apt sections the filter needs besides Position and Mass
+        """
+        sections = []
+        if self.multiplicity is not None:
+            sections.append("Multiplicity")
+        if self.detector_radius is not None:
+            sections += ["XDet_mm", "YDet_mm"]
+        return sections
+
+    def get_mask(self, block, sections=None):
+        """
+        Evaluate the filter on a block of ions
+
+        Parameters
+        ----------
+        block: np array
+            Ions of shape (n, 4) with columns x, y, z, Da
+
+        sections: dict, optional
+            Maps the names in ``sections`` to arrays of length n
+
+        Returns
+        -------
+        mask: np array
+            True for the ions that are kept
+        """
+        mask = np.ones(len(block), dtype=bool)
+        if self.mass_windows is not None:
+            mass = block[:,3]
+            in_window = np.zeros(len(block), dtype=bool)
+            for lower, upper in self.mass_windows:
+                in_window |= (mass >= lower) & (mass <= upper)
+            mask &= in_window
+        if self.box is not None:
+            mask &= np.all((block[:,:3] >= self.box[0]) & (block[:,:3] <= self.box[1]), axis=1)
+        if self.cylinder is not None:
+            x, y, radius = self.cylinder
+            mask &= (block[:,0] - x)**2 + (block[:,1] - y)**2 <= radius**2
+        if self.multiplicity is not None:
+            multiplicity = np.asarray(sections["Multiplicity"]).reshape(-1)
+            mask &= (multiplicity >= self.multiplicity[0]) & (multiplicity <= self.multiplicity[1])
+        if self.detector_radius is not None:
+            xdet = np.asarray(sections["XDet_mm"]).reshape(-1)
+            ydet = np.asarray(sections["YDet_mm"]).reshape(-1)
+            mask &= xdet**2 + ydet**2 <= self.detector_radius**2
+        return mask
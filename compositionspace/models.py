@@ -1,27 +1,187 @@
-from ast import Raise
+"""
+Registry of the machine learning models for clustering
+"""
+
+import numpy as np
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.mixture import GaussianMixture
-from sklearn.cluster import DBSCAN
+from sklearn.mixture import GaussianMixture, BayesianGaussianMixture
+from sklearn.cluster import DBSCAN, KMeans, MiniBatchKMeans
+
+
+class WeightedGaussianMixture(GaussianMixture):
+    """
+    GaussianMixture that can be fitted on weighted samples
+
+    Notes
+    -----
+    The responsibilities of every sample are scaled by its weight in the
+    initialization and in the EM iterations, and the k-means initialization
+    is fitted with the same weights, so a fit on unique rows weighted by
+    their multiplicity maximizes the same likelihood from an initialization
+    of the same objective as a fit on all rows.
+
+    The EM steps are overridden through private methods of
+    ``BaseMixture``, the supported scikit-learn versions are pinned in
+    ``setup.py``.
+    """
+    _sample_weight = None
+
+    def fit(self, X, y=None, sample_weight=None):
+        self._sample_weight = None if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+        try:
+            return super().fit(X, y)
+        finally:
+            self._sample_weight = None
+
+    def _initialize_parameters(self, X, random_state, *args, **kwargs):
+        if self._sample_weight is None or self.init_params != "kmeans":
+            return super()._initialize_parameters(X, random_state, *args, **kwargs)
+        labels = KMeans(n_clusters=self.n_components, n_init=1, random_state=random_state).fit(
+            X, sample_weight=self._sample_weight).labels_
+        resp = np.zeros((len(X), self.n_components), dtype=X.dtype)
+        resp[np.arange(len(X)), labels] = 1
+        self._initialize(X, resp)
+
+    def _initialize(self, X, resp, *args, **kwargs):
+        if self._sample_weight is None:
+            return super()._initialize(X, resp, *args, **kwargs)
+        super()._initialize(X, resp*self._sample_weight[:,None], *args, **kwargs)
+        if self.weights_init is None:
+            self.weights_ = self.weights_/np.sum(self.weights_)
+
+    def _e_step(self, X, *args, **kwargs):
+        if self._sample_weight is None:
+            return super()._e_step(X, *args, **kwargs)
+        log_prob_norm, log_resp = self._estimate_log_prob_resp(X, *args, **kwargs)
+        return (np.average(log_prob_norm, weights=self._sample_weight),
+                log_resp + np.log(self._sample_weight)[:,None])
+
+
+class ModelSpec:
+    """
+    A registered model
+
+    Parameters
+    ----------
+    name: string
+        Name of the model in ``ml_models`` of the input parameters
+
+    factory: class or function
+        Creates the model from keyword arguments
+
+    schema: dict
+        Accepted parameters and their defaults
+
+    partial_fit: bool
+        The model can be fitted batch by batch with ``partial_fit``
+
+    n_jobs: bool
+        The model takes an ``n_jobs`` parameter
+
+    predict: bool
+        A fitted model can label new data with ``predict``, otherwise it
+        only labels the data it is fitted on with ``fit_predict``
+
+    sample_weight: bool
+        The model can be fitted on weighted samples
+
+    supervised: bool
+        The model needs labels to be fitted and cannot cluster voxels
+    """
+    def __init__(self, name, factory, schema, partial_fit=False, n_jobs=False, predict=True, sample_weight=False,
+                 supervised=False):
+        self.name = name
+        self.factory = factory
+        self.schema = dict(schema)
+        self.partial_fit = partial_fit
+        self.n_jobs = n_jobs
+        self.predict = predict
+        self.sample_weight = sample_weight
+        self.supervised = supervised
+
+    def get_params(self, model_params):
+        """
+        The defaults of the schema updated by ``model_params``
+
+        Raises
+        ------
+        ValueError: if a parameter is not in the schema
+        """
+        model_params = dict(model_params or {})
+        unknown = [key for key in model_params if key not in self.schema]
+        if len(unknown) > 0:
+            raise ValueError(f"unknown parameters {unknown} for the model {self.name}, choose from: {list(self.schema.keys())}")
+        params = dict(self.schema)
+        params.update(model_params)
+        return params
+
+    def create(self, model_params):
+        return self.factory(**self.get_params(model_params))
+
+
+MODELS = {}
+
+
+def register_model(name, factory, schema, partial_fit=False, n_jobs=False, predict=True, sample_weight=False,
+                   supervised=False):
+    """
+    Make a model available to ``get_model``, see ``ModelSpec`` for the
+    parameters
+    """
+    MODELS[name] = ModelSpec(name, factory, schema, partial_fit=partial_fit, n_jobs=n_jobs, predict=predict,
+                             sample_weight=sample_weight, supervised=supervised)
+    return MODELS[name]
+
+
+def get_model_spec(model_name):
+    """
+    Registered model by name
+
+    Raises
+    ------
+    ValueError: if no model is registered with the name
+    """
+    if model_name not in MODELS:
+        raise ValueError(f"No implementation is found for the model {model_name}, choose from: {list(MODELS.keys())}")
+    return MODELS[model_name]
+
 
 def get_model(ml_params):
     """
     get machine learning model for clustering
+
+    Parameters
+    ----------
+    ml_params: dict
+        The ``ml_models`` section of the input parameters, ``name`` selects
+        the model and the section of the same name holds its parameters
+
+    Returns
+    -------
+    model: unfitted model
     """
     model_name = ml_params["name"]
-    model_params = ml_params[model_name]
-    _available_models = ["randomforest"]
-
-    if(model_name == "randomforest"):
-        model = RandomForestClassifier(max_depth=model_params["max_depth"],
-                            n_estimators=model_params["n_estimators"])
-        return model
-    if(model_name == "GaussianMixture"):
-        model =  GaussianMixture(n_components = model_params["n_components"], max_iter=model_params["max_iter"],verbose=model_params["verbose"])
-        return model 
-    
-    if(model_name == "DBScan"):
-        model =  DBSCAN(eps= self.params["eps"], min_samples= model_params["min_samples"])
-        return model       
-        
-    else:
-        raise ValueError(f"Now implementation is found for the model {model_name}, choose from: {_available_models}")
+    return get_model_spec(model_name).create(ml_params.get(model_name, None))
+
+
+register_model("randomforest", RandomForestClassifier,
+               {"max_depth": None, "n_estimators": 100, "random_state": None, "n_jobs": None},
+               n_jobs=True, sample_weight=True, supervised=True)
+
+register_model("GaussianMixture", WeightedGaussianMixture,
+               {"n_components": 1, "covariance_type": "full", "max_iter": 100, "n_init": 1,
+                "random_state": None, "verbose": 0},
+               sample_weight=True)
+
+register_model("BayesianGaussianMixture", BayesianGaussianMixture,
+               {"n_components": 1, "covariance_type": "full", "max_iter": 100, "n_init": 1,
+                "weight_concentration_prior": None, "random_state": None, "verbose": 0})
+
+register_model("MiniBatchKMeans", MiniBatchKMeans,
+               {"n_clusters": 8, "batch_size": 1024, "max_iter": 100, "n_init": 3,
+                "random_state": None, "verbose": 0},
+               partial_fit=True, sample_weight=True)
+
+register_model("DBScan", DBSCAN,
+               {"eps": 0.5, "min_samples": 5, "n_jobs": None},
+               n_jobs=True, predict=False, sample_weight=True)
@@ -5,6 +5,7 @@ MK::GPLV3, 03/09/2020, Markus K\"uhbach, m.kuehbach@mpie.de
 """
 
 
+import os
 import numpy as np
 
 
@@ -298,12 +299,8 @@ class paraprobe_transcoder():
         #self.mass_sect = APTSectionHeader( self.fn )
         #self.xyz_sect = APTSectionHeader( self.fn )
     
-    def read_cameca_apt_section_data_fixed_onetoone(self, fid, sect ):
+    def get_section_dtype(self, sect ):
         #which datatype to use, interpret from the section header
-        ni = int(self.header.llIonCount)
-    #    print('ni ' + str(ni))
-        nj = int(int(sect.iRecordSize) / (int(sect.iDataTypeSize)/int(8)))
-    #    print('nj ' + str(nj))
         dtyp = None #eRecordDataType == 3 and iDataTypeSize == 32
         if sect.eRecordDataType == 1:
             if sect.iDataTypeSize/8 == 2:
@@ -324,8 +321,101 @@ class paraprobe_transcoder():
        #     print('Unknown datatype selection!')
             return None        
    #     print(dtyp)
+        return dtyp
+
+    def read_cameca_apt_section_data_fixed_onetoone(self, fid, sect ):
+        ni = int(self.header.llIonCount)
+    #    print('ni ' + str(ni))
+        nj = int(int(sect.iRecordSize) / (int(sect.iDataTypeSize)/int(8)))
+    #    print('nj ' + str(nj))
+        dtyp = self.get_section_dtype( sect )
+        if dtyp is None:
+            return None
         return np.reshape(np.fromfile(fid, dtyp, count = int(ni*nj)), (int(ni), int(nj)), order='C')
 
+    def index_cameca_apt(self):
+        """
+        Index the section headers of the file without reading section data
+
+        Returns
+        -------
+        section_index: dict
+            Maps the section name to a tuple of (section header, byte offset
+            of the section data, dtype, shape)
+
+        Notes
+        -----
+        Only the 540 byte file header and the section headers are read, the
+        data of every section is skipped by seeking past it.
+        """
+        self.section_index = {}
+        self.idtfyd_sections = []
+        file_size = os.path.getsize(self.fn)
+        with open(self.fn, "rb") as fid:
+            self.header.read_cameca_apt_file_header( fid )
+            if self.header.healthy == False:
+                raise ValueError(f"{self.fn} is not a valid *.APT file")
+            ni = int(self.header.llIonCount)
+
+            while fid.tell() < file_size:
+                start = fid.tell()
+                sect = APTSectionHeader()
+                sect.read_cameca_apt_section_header_auto( fid )
+                if sect.healthy == False:
+                    break
+                dtyp = self.get_section_dtype( sect )
+                if dtyp is None:
+                    break
+                if sect.wcSectionType == 'Position':
+                    #position has preceeding 6 float32 for bounds
+                    self.tipbox = np.reshape(np.fromfile( fid, np.float32, count = int(2*3) ), (int(2), int(3) ), order='C')
+                nj = int(int(sect.iRecordSize) / (int(sect.iDataTypeSize)/int(8)))
+                #*.APT files are little-endian irrespective of the platform
+                dtyp = np.dtype(dtyp).newbyteorder('<')
+                offset = start + int(sect.iHeaderSize)
+                self.idtfyd_sections.append( sect )
+                self.section_index[sect.wcSectionType] = (sect, offset, dtyp, (ni, nj))
+                fid.seek(offset + ni*nj*dtyp.itemsize, os.SEEK_SET)
+
+        return self.section_index
+
+    def read_sections(self, names):
+        """
+        Memory-map the data of selected sections only
+
+        Parameters
+        ----------
+        names: list of strings
+            Section names, for example ``["Position", "Mass"]``
+
+        Returns
+        -------
+        sections: dict
+            Maps each requested name to a read-only np.memmap of shape
+            (llIonCount, elements per record). The arrays are also set as
+            attributes the same way ``read_cameca_apt`` does.
+
+        Raises
+        ------
+        ValueError: if a requested section is not present in the file
+        """
+        if not hasattr(self, "section_index"):
+            self.index_cameca_apt()
+
+        missing = [name for name in names if name not in self.section_index]
+        if len(missing) > 0:
+            raise ValueError(f"sections {missing} not found in {self.fn}, available: {list(self.section_index.keys())}")
+
+        sections = {}
+        for name in names:
+            sect, offset, dtyp, shape = self.section_index[name]
+            if shape[0] == 0:
+                sections[name] = np.zeros(shape, dtype=dtyp)
+            else:
+                sections[name] = np.memmap(self.fn, dtype=dtyp, mode="r", offset=offset, shape=shape, order='C')
+            setattr(self, name.replace(" ", ""), sections[name])
+        return sections
+
 
     def read_cameca_apt(self):
         offset = 0
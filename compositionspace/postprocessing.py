@@ -8,10 +8,12 @@ from sklearn.cluster import DBSCAN
 from pyevtk.hl import pointsToVTK
 from pyevtk.hl import gridToVTK
 import yaml
+from compositionspace.datautils import VoxelStore
+from compositionspace.project import Project
 
 class DataPostprocess:
     
-    def __init__(self, inputfile):
+    def __init__(self, inputfile, project=None):
         if isinstance(inputfile, dict):
             self.params = inputfile
         else:
@@ -19,6 +21,15 @@ class DataPostprocess:
                 params = yaml.safe_load(fin)
             self.params = params
         self.version = "1.0.0"
+        self.project = project
+
+    def get_project(self):
+        """
+        The project file of ``output_path``, opened on first use
+        """
+        if self.project is None:
+            self.project = Project.from_params(self.params)
+        return self.project
 
     def get_post_centroids(self, voxel_centroid_phases_files, cluster_id):
         
@@ -41,10 +52,10 @@ class DataPostprocess:
         """
 
 
-        with h5py.File(voxel_centroid_phases_files , "r") as hdfr:
+        with self.get_project().read_stage(voxel_centroid_phases_files, "segmentation") as hdfr:
             group = cluster_id
-            Phase_arr =  np.array(hdfr.get(f"{group}/{group}"))
-            Phase_columns = list(list(hdfr.get(f"{group}").attrs.values())[0])
+            Phase_arr =  hdfr[f"{group}/{group}"][...]
+            Phase_columns = list(hdfr[f"{group}"].attrs["columns"])
             Phase_cent_df =pd.DataFrame(data=Phase_arr, columns=Phase_columns)
 
             Df_centroids = Phase_cent_df.copy()
@@ -53,6 +64,39 @@ class DataPostprocess:
 
         return Df_centroids_no_files, Df_centroids, Phase_columns
 
+
+    def get_post_ions(self, vox_file, voxel_centroid_phases_files, cluster_id):
+
+        """
+        Reads the ions of all voxels of a phase
+
+        Parameters
+        ----------
+        vox_file : str, voxel file written by DataPreparation.get_voxels
+        voxel_centroid_phases_files : str, Voxel cetroids corresponding to each phase
+        cluster_id: int, phase id in Voxel_centroid_phases_files
+
+        Returns
+        -------
+        pandas dataframe for the ions of the phase, with the columns of the voxel file
+        
+        Notes
+        -----
+        The ions are sliced from the voxel file through VoxelStore, no voxel is read twice.
+        """
+        Df_centroids_no_files, Df_centroids, Phase_columns = self.get_post_centroids(voxel_centroid_phases_files, cluster_id)
+        voxel_ids = Df_centroids['file_name'].values.astype(int)
+
+        with VoxelStore(vox_file) as store:
+            ions_lst = [store[voxel_id] for voxel_id in voxel_ids]
+            if len(ions_lst) == 0:
+                ions = store.ions[:0]
+            else:
+                ions = np.concatenate(ions_lst)
+            Df_ions = pd.DataFrame(data=ions, columns=store.columns)
+
+        return Df_ions
+
         
     def DBSCAN_clustering(self, voxel_centroid_phases_files, cluster_id, 
         plot= False, plot3d = False, save =False):
@@ -75,7 +119,7 @@ class DataPostprocess:
         
         plot3d: boolean, if true plots voxel centroids in corresponding to each precipitate and outputs a .vtu file .
         
-        save: boolean, saves a .h5 file corresponding to a cluster_id containing centroids for each precipitate.
+        save: boolean, saves the centroids of each precipitate to the group dbscan/cluster_id of the project file.
         
 
         Returns
@@ -123,15 +167,14 @@ class DataPostprocess:
             pointsToVTK(OutFile,x,y,z, data = {"label" : label}  )
 
         if save == True:
-            OutFile = os.path.join(self.params["output_path"], f"Output_DBSCAN_segmentation_phase{cluster_id}")
-            with h5py.File(OutFile, "w") as hdfw:
-                G = hdfw.create_group(f"{cluster_id}")
+            project = self.get_project()
+            with project.write_stage(None, f"dbscan/{cluster_id}") as G:
                 G.attrs["columns"] = Phase_columns
                 for i in tqdm(np.unique(labels)):
                     if i !=-1:
                         cl_idx =np.argwhere(labels==i).flatten()
                         cl_cent=Df_centroids.iloc[cl_idx]
-                        G.create_dataset("{}".format(i), data = cl_cent.values)
+                        project.create_dataset(G, "{}".format(i), data = cl_cent.values)
 
 
     
@@ -0,0 +1,169 @@
+"""
+Project file shared by the stages of the pipeline
+"""
+
+import os
+import contextlib
+import yaml
+from compositionspace.storage import get_backend
+
+DEFAULT_PROJECT_FILE = "project.h5"
+
+
+def get_stage_group(hdf, stage):
+    """
+    Group of a stage, or the root of a file written by older versions that
+    held one stage per file
+    """
+    if stage in hdf:
+        return hdf[stage]
+    return hdf
+
+
+class Project:
+    """
+    One HDF5 file, or zarr store, with a group per pipeline stage
+
+    Parameters
+    ----------
+    filename: string
+        Name of the project file, created if it does not exist. Names ending
+        in ``.zarr`` are opened as zarr stores.
+
+    Notes
+    -----
+    The file is opened once and shared by ``DataPreparation``,
+    ``CompositionClustering`` and ``DataPostprocess``::
+
+        data = DataPreparation(params)
+        comps = CompositionClustering(params, project=data.get_project())
+
+    The groups are
+
+    - ``slices`` and ``voxels``: the ``files`` attribute lists the slice and
+      voxel files. These stay separate files so that worker processes can
+      read them and ``VoxelStore`` can memory-map them.
+    - ``composition``: the voxel ratios, counts and centroids
+    - ``pca``: the voxel ratios projected on their principal components
+    - ``labels``: the phase label of every voxel
+    - ``model``: the fitted clustering model, see
+      ``CompositionClustering.save_model``
+    - ``segmentation``: a group per phase with the voxel centroids
+    - ``dbscan``: a group per phase with the centroids of every cluster
+
+    Every group stores its column names in the named attribute ``columns``.
+    """
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.backend = get_backend(path=self.filename)
+        self.hdf = self.backend.open_root(self.filename, "a")
+
+    @classmethod
+    def from_params(cls, params):
+        """
+        Open the project file ``project_file`` in ``output_path``, with the
+        extension of the ``storage_backend``
+        """
+        backend = get_backend(params.get("storage_backend", None))
+        filename = os.path.splitext(params.get("project_file", DEFAULT_PROJECT_FILE))[0] + backend.extension
+        filename = os.path.join(params["output_path"], filename)
+        project = cls(filename)
+        if "params" not in project.hdf.attrs:
+            project.hdf.attrs["params"] = yaml.safe_dump(params)
+        return project
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.backend.close(self.hdf)
+
+    def is_project_file(self, file_name):
+        """
+        True if ``file_name`` is this project file
+        """
+        return file_name is not None and os.path.abspath(file_name) == self.filename
+
+    def create_dataset(self, group, name, data):
+        """
+        Write an array to a group of a stage, in this project or another
+        file of the same backend
+        """
+        return self.backend.create_dataset(group, name, data=data)
+
+    def create_stage(self, stage):
+        """
+        Empty group for a stage, replacing earlier results
+        """
+        if stage in self.hdf:
+            del self.hdf[stage]
+        return self.hdf.create_group(stage)
+
+    def set_files(self, stage, files):
+        """
+        Record the files written by a stage
+        """
+        group = self.hdf.require_group(stage)
+        group.attrs["files"] = [os.path.abspath(file_name) for file_name in files]
+        self.backend.flush(self.hdf)
+
+    def get_files(self, stage):
+        """
+        Files written by a stage, empty if the stage did not run
+        """
+        if stage not in self.hdf or "files" not in self.hdf[stage].attrs:
+            return []
+        return list(self.hdf[stage].attrs["files"])
+
+    @contextlib.contextmanager
+    def read_stage(self, file_name, stage):
+        """
+        Group of a stage in this project, or in another file
+
+        Parameters
+        ----------
+        file_name: string
+            The project file, or a file written with an explicit output
+            file name
+
+        stage: string
+            Name of the stage
+
+        Yields
+        ------
+        group: h5py Group
+        """
+        if self.is_project_file(file_name):
+            yield get_stage_group(self.hdf, stage)
+        else:
+            with get_backend(path=file_name).open(file_name, "r") as hdfr:
+                yield get_stage_group(hdfr, stage)
+
+    @contextlib.contextmanager
+    def write_stage(self, file_name, stage):
+        """
+        Empty group for a stage, in this project or in another file
+
+        Parameters
+        ----------
+        file_name: string or None
+            Output file, None for the project file
+
+        stage: string
+            Name of the stage
+
+        Yields
+        ------
+        group: h5py Group
+        """
+        if file_name is None or self.is_project_file(file_name):
+            yield self.create_stage(stage)
+            self.backend.flush(self.hdf)
+        else:
+            with get_backend(path=file_name).open(file_name, "a") as hdfw:
+                if stage in hdfw:
+                    del hdfw[stage]
+                yield hdfw.create_group(stage)
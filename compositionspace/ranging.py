@@ -0,0 +1,196 @@
+"""
+Vectorized assignment of ions to the mass-to-charge ranges of a range file
+"""
+
+import numpy as np
+
+
+def get_species_dtype(n_species):
+    """
+    Smallest unsigned integer type holding all species ids plus the sentinel
+    for unranged ions
+
+    Parameters
+    ----------
+    n_species: int
+        Number of distinct species
+
+    Returns
+    -------
+    dtype: np.dtype
+        uint8 or uint16
+    """
+    if n_species < np.iinfo(np.uint8).max:
+        return np.dtype(np.uint8)
+    return np.dtype(np.uint16)
+
+
+class RangeTable:
+    """
+    Sorted interval table built once from the ranges of a range file
+
+    Parameters
+    ----------
+    rrngs: pandas DataFrame
+        Ranges as returned by ``DataPreparation.get_rrng``, with the columns
+        lower, upper and comp
+
+    Attributes
+    ----------
+    species_names: np array
+        Sorted unique species names, the species id of an ion is the
+        index into this array
+
+    unranged: int
+        Species id given to ions outside of all ranges
+
+    Notes
+    -----
+    Ranges are inclusive on both ends. Ranges that share a bound are allowed,
+    an ion exactly on the shared bound is assigned to the upper range.
+
+    Raises
+    ------
+    ValueError: if a range has upper < lower or two ranges overlap
+    """
+    def __init__(self, rrngs):
+        lower = np.asarray(rrngs["lower"].values, dtype=np.float64)
+        upper = np.asarray(rrngs["upper"].values, dtype=np.float64)
+        comp = np.asarray(rrngs["comp"].values).astype(str)
+
+        invalid = np.argwhere(upper < lower).flatten()
+        if len(invalid) > 0:
+            raise ValueError(f"ranges {list(rrngs.index.values[invalid])} have an upper bound below the lower bound")
+
+        species_names, species = np.unique(comp, return_inverse=True)
+        #object dtype so the names can be stored as HDF5 attributes
+        self.species_names = species_names.astype(object)
+        self.dtype = get_species_dtype(len(self.species_names))
+        self.unranged = np.iinfo(self.dtype).max
+
+        self.order = np.argsort(lower, kind="stable")
+        self.lower = lower[self.order]
+        self.upper = upper[self.order]
+        self.species = species[self.order].astype(self.dtype)
+
+        overlaps = np.argwhere(self.upper[:-1] > self.lower[1:]).flatten()
+        if len(overlaps) > 0:
+            numbers = rrngs.index.values[self.order]
+            pairs = [(numbers[i], numbers[i+1]) for i in overlaps]
+            raise ValueError(f"overlapping ranges found: {pairs}")
+
+    def __len__(self):
+        return len(self.lower)
+
+    def _get_sorted_ids(self, mass):
+        #index of the last range starting at or below each mass, one past
+        #the end for ions outside of every range
+        mass = np.asarray(mass)
+        idx = np.searchsorted(self.lower, mass, side="right") - 1
+        inside = idx >= 0
+        inside[inside] = mass[inside] <= self.upper[idx[inside]]
+        idx[~inside] = len(self.lower)
+        return idx
+
+    def get_range_ids(self, mass):
+        """
+        Find the range of every ion
+
+        Parameters
+        ----------
+        mass: np array
+            Mass-to-charge ratios
+
+        Returns
+        -------
+        range_ids: np array
+            Row position of the range in the original range table, -1 for
+            unranged ions
+        """
+        idx = self._get_sorted_ids(mass)
+        return np.append(self.order, -1)[idx]
+
+    def get_species_ids(self, mass):
+        """
+        Assign a compact species id to every ion in a single pass
+
+        Parameters
+        ----------
+        mass: np array
+            Mass-to-charge ratios
+
+        Returns
+        -------
+        species_ids: np array
+            Index into ``species_names`` of dtype ``self.dtype``, unranged
+            ions are set to ``self.unranged``
+        """
+        idx = self._get_sorted_ids(mass)
+        return np.append(self.species, self.dtype.type(self.unranged))[idx]
+
+
+class MoleculeTable:
+    """
+    Lookup table from range species to their constituent atoms
+
+    Parameters
+    ----------
+    species_names: list of strings
+        Species as written in the range file, for example "Cr:1 O:1" or
+        "O:2"
+
+    Attributes
+    ----------
+    atom_names: np array
+        Sorted unique atom species, named "El:1"
+
+    n_atoms: np array
+        Number of atoms in every species
+
+    Notes
+    -----
+    Every component "El:n" of a species contributes n atoms of "El:1", so
+    "Ti:1 O:2" decomposes into Ti:1, O:1 and O:1.
+    """
+    def __init__(self, species_names):
+        atoms = []
+        for name in species_names:
+            species_atoms = []
+            for component in str(name).split():
+                element, _, count = component.partition(":")
+                species_atoms += ["{}:1".format(element)]*(int(count) if count else 1)
+            atoms.append(species_atoms)
+
+        #object dtype so the names can be stored as HDF5 attributes
+        self.atom_names = np.unique([atom for species_atoms in atoms for atom in species_atoms]).astype(object)
+        self.n_atoms = np.array([len(species_atoms) for species_atoms in atoms], dtype=np.int64)
+        self.offsets = np.cumsum(self.n_atoms) - self.n_atoms
+        flat = [atom for species_atoms in atoms for atom in species_atoms]
+        self.atom_ids = np.searchsorted(self.atom_names.astype(str), flat).astype(get_species_dtype(len(self.atom_names)))
+
+    def decompose(self, species_ids):
+        """
+        Expand ions into their atoms
+
+        Parameters
+        ----------
+        species_ids: np array
+            Species id of every ion, indices into the species names
+
+        Returns
+        -------
+        parents: np array
+            Index of the ion every atom comes from, use it to repeat the ion
+            coordinates
+
+        atom_ids: np array
+            Atom species of every atom, indices into ``atom_names``
+        """
+        species_ids = np.asarray(species_ids, dtype=np.int64)
+        reps = self.n_atoms[species_ids]
+        parents = np.repeat(np.arange(len(species_ids)), reps)
+        #position of every atom within its ion
+        starts = np.cumsum(reps) - reps
+        position = np.arange(len(parents)) - np.repeat(starts, reps)
+        atom_ids = self.atom_ids[self.offsets[species_ids][parents] + position]
+        return parents, atom_ids
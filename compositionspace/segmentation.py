@@ -1,9 +1,9 @@
-from compositionspace.datautils import DataPreparation
-from compositionspace.models import get_model
-from sklearn.decomposition import PCA
+from compositionspace.datautils import DataPreparation, VoxelStore, DEFAULT_BLOCK_SIZE
+from compositionspace.project import Project
+from compositionspace.models import get_model, get_model_spec
+from sklearn.decomposition import IncrementalPCA
 from sklearn.mixture import GaussianMixture
 import json 
-import h5py
 import numpy as np
 import pandas as pd
 import matplotlib.pylab as plt
@@ -12,11 +12,69 @@ import os
 from pyevtk.hl import pointsToVTK
 from pyevtk.hl import gridToVTK#, pointsToVTKAsTIN
 import yaml
+import time
+import pickle
 import pyvista as pv
+from concurrent.futures import ProcessPoolExecutor
+
+#maximum number of voxels the models are fitted on
+DEFAULT_FIT_SAMPLE_SIZE = 1000000
+
+#dataset holding the clustering features of every stage
+FEATURE_DATASETS = {"composition": "vox_ratios", "pca": "vox_pca"}
+
+
+def fit_mixture(X_train, n_components, n_init=1, random_state=None):
+    """
+    Fit a GaussianMixture and score it, run by the model selection sweep
+
+    Parameters
+    ----------
+    X_train: np array
+        Species ratios of the voxels
+
+    n_components: int
+        Number of mixture components
+
+    n_init: int
+        Number of initializations, the best fit is kept
+
+    random_state: int, optional
+        Seed of the initializations
+
+    Returns
+    -------
+    n_components: int
+
+    aic, bic: float
+        Akaike and Bayesian information criterion of the fit
+
+    fit_time: float
+        Time of the fit in seconds
+    """
+    start = time.perf_counter()
+    gm = GaussianMixture(n_components=n_components, n_init=n_init, random_state=random_state, verbose=0)
+    gm.fit(X_train)
+    fit_time = time.perf_counter() - start
+    return n_components, gm.aic(X_train), gm.bic(X_train), fit_time
+
+
+def get_bic_rises(bics):
+    """
+    Number of consecutive component counts at the end of a sweep for which
+    the BIC rose
+    """
+    rises = 0
+    for i in range(len(bics) - 1, 0, -1):
+        if bics[i] <= bics[i-1]:
+            break
+        rises += 1
+    return rises
+
 
 class CompositionClustering():
     
-    def __init__(self, inputfile):
+    def __init__(self, inputfile, project=None):
         if isinstance(inputfile, dict):
             self.params = inputfile
         else:
@@ -24,28 +82,557 @@ class CompositionClustering():
                 params = yaml.safe_load(fin)
             self.params = params
         self.version = "1.0.0"
+        self.project = project
+
+    def get_project(self):
+        """
+        The project file of ``output_path``, opened on first use
+        """
+        if self.project is None:
+            self.project = Project.from_params(self.params)
+        return self.project
+
+    def get_ratios(self, vox_ratio_file):
+        """
+        Read the voxel ratios
+
+        Parameters
+        ----------
+        vox_ratio_file: string
+            File written by ``DataPreparation.calculate_voxel_composition``,
+            usually the project file
+
+        Returns
+        -------
+        ratios: pandas DataFrame
+            Species ratios, Total_no and vox of every voxel
+        """
+        with self.get_project().read_stage(vox_ratio_file, "composition") as group:
+            ratios = np.array(group["vox_ratios"])
+            ratios_columns = list(group.attrs["columns"])
+        return pd.DataFrame(data=ratios, columns=ratios_columns)
+
+    def get_feature_stage(self):
+        """
+        Stage the clustering features are read from, ``composition`` for
+        the species ratios or ``pca`` for the coordinates saved by
+        ``get_PCA_cumsum``, set by ``cluster_space`` in the input parameters
+        """
+        if self.params.get("cluster_space", "ratios") == "pca":
+            return "pca"
+        return "composition"
+
+    def get_feature_shape(self, vox_ratio_file, stage="composition"):
+        """
+        Number of voxels and features of a stage
+
+        Raises
+        ------
+        ValueError: if the stage has no features
+        """
+        if stage == "pca":
+            n_rows, n_components, _, _ = self.get_pca_stage(vox_ratio_file)
+            return n_rows, n_components
+        with self.get_project().read_stage(vox_ratio_file, stage) as group:
+            if FEATURE_DATASETS[stage] not in group:
+                raise ValueError(f"no {stage} features found in {vox_ratio_file}")
+            shape = group[FEATURE_DATASETS[stage]].shape
+            if stage == "composition":
+                return shape[0], len(group.attrs["columns"]) - 2
+            return shape[0], shape[1]
+
+    def get_pca_stage(self, vox_ratio_file):
+        """
+        Principal components saved by ``get_PCA_cumsum``, checked against
+        the current voxel composition
+
+        Parameters
+        ----------
+        vox_ratio_file: string
+            File written by ``DataPreparation.calculate_voxel_composition``
+
+        Returns
+        -------
+        n_rows: int
+            Number of voxels
+
+        n_components: int
+            Number of principal components
+
+        components: np array
+            Principal axes, shape (n_components, n_species)
+
+        mean: np array
+            Mean of the ratios, shape (n_species,)
+
+        Raises
+        ------
+        ValueError: if no components are saved or they were computed from
+            another composition
+        """
+        n_rows, n_species = self.get_feature_shape(vox_ratio_file, "composition")
+        with self.get_project().read_stage(vox_ratio_file, "composition") as group:
+            composition_id = group.attrs.get("composition_id", None)
+        project = self.get_project()
+        with project.read_stage(project.filename, "pca") as group:
+            if FEATURE_DATASETS["pca"] not in group:
+                raise ValueError(f"no pca features found in {project.filename}, run get_PCA_cumsum with save=True")
+            shape = group[FEATURE_DATASETS["pca"]].shape
+            components = np.asarray(group.attrs["components"])
+            mean = np.asarray(group.attrs["mean"])
+            pca_composition_id = group.attrs.get("composition_id", None)
+            pca_composition_file = group.attrs.get("composition_file", None)
+        if (shape[0] != n_rows or components.shape != (shape[1], n_species) or len(mean) != n_species
+                or pca_composition_id != composition_id
+                or pca_composition_file != os.path.abspath(vox_ratio_file)):
+            raise ValueError(f"the pca features in {project.filename} were not computed from the composition in "
+                             f"{vox_ratio_file}, run get_PCA_cumsum with save=True again")
+        return n_rows, shape[1], components, mean
+
+    def iter_ratio_blocks(self, vox_ratio_file, block_size=None, stage="composition"):
+        """
+        Stream the species ratios of the voxels in blocks of rows
+
+        Parameters
+        ----------
+        vox_ratio_file: string
+            File written by ``DataPreparation.calculate_voxel_composition``
+
+        block_size: int, optional
+            Number of voxels per block. Defaults to ``read_block_size`` from
+            the input parameters.
+
+        stage: string
+            ``composition`` for the species ratios, ``pca`` for the
+            coordinates saved by ``get_PCA_cumsum`` in the project file
+
+        Yields
+        ------
+        start: int
+            Voxel id of the first row of the block
+
+        block: np array
+            Features, shape (block_size, n_features)
+        """
+        if block_size is None:
+            block_size = self.params.get("read_block_size", DEFAULT_BLOCK_SIZE)
+        n_rows, n_features = self.get_feature_shape(vox_ratio_file, stage)
+        if stage == "pca":
+            vox_ratio_file = self.get_project().filename
+        with self.get_project().read_stage(vox_ratio_file, stage) as group:
+            dataset = group[FEATURE_DATASETS[stage]]
+            for start in range(0, n_rows, block_size):
+                yield start, dataset[start:start+block_size, :n_features]
+
+    def get_ratio_sample(self, vox_ratio_file, n_samples=None):
+        """
+        Uniform random sample of the voxel ratios to fit models on
+
+        Parameters
+        ----------
+        vox_ratio_file: string
+            File written by ``DataPreparation.calculate_voxel_composition``
+
+        n_samples: int, optional
+            Number of voxels. Defaults to ``fit_sample_size`` from the input
+            parameters.
+
+        Returns
+        -------
+        sample: np array
+            Features, shape (n_samples, n_features). All voxels, in order,
+            if there are no more than ``n_samples``.
+
+        Notes
+        -----
+        The sample is gathered while streaming the features block-wise, so
+        at most ``n_samples`` rows are held in memory. ``random_state`` from
+        the input parameters seeds the sample, ``cluster_space`` selects the
+        features, see ``get_feature_stage``.
+        """
+        if n_samples is None:
+            n_samples = self.params.get("fit_sample_size", DEFAULT_FIT_SAMPLE_SIZE)
+        stage = self.get_feature_stage()
+        n_rows, n_features = self.get_feature_shape(vox_ratio_file, stage)
+
+        sample = [np.zeros((0, n_features))]
+        if n_rows <= n_samples:
+            for start, block in self.iter_ratio_blocks(vox_ratio_file, stage=stage):
+                sample.append(block)
+            return np.concatenate(sample)
+
+        rng = np.random.default_rng(self.params.get("random_state", None))
+        rows = np.sort(rng.choice(n_rows, size=n_samples, replace=False))
+        for start, block in self.iter_ratio_blocks(vox_ratio_file, stage=stage):
+            lower, upper = np.searchsorted(rows, [start, start+len(block)])
+            sample.append(block[rows[lower:upper] - start])
+        return np.concatenate(sample)
+
+    def predict_labels(self, model, vox_ratio_file, transform=None, stage=None):
+        """
+        Label every voxel with a fitted model, block by block
+
+        Parameters
+        ----------
+        model: fitted model with a ``predict`` method
+
+        vox_ratio_file: string
+            File written by ``DataPreparation.calculate_voxel_composition``
+
+        transform: function, optional
+            Preprocessing applied to every block of features, see
+            ``load_model``
+
+        stage: string, optional
+            Stage the features are read from, see ``iter_ratio_blocks``.
+            Defaults to the stage selected by ``cluster_space``.
+
+        Returns
+        -------
+        labels: np array
+            Label of every voxel
+
+        Notes
+        -----
+        The labels are written to the ``labels`` group of the project file
+        as every block is predicted.
+        """
+        if stage is None:
+            stage = self.get_feature_stage()
+        n_rows, n_features = self.get_feature_shape(vox_ratio_file, stage)
+
+        project = self.get_project()
+        labels = np.zeros(n_rows, dtype=np.int16)
+        with project.write_stage(None, "labels") as group:
+            dataset = project.backend.create_dataset(group, "labels", shape=(n_rows,), dtype=np.int16)
+            for start, block in self.iter_ratio_blocks(vox_ratio_file, stage=stage):
+                if transform is not None:
+                    block = transform(block)
+                if len(block) > 0:
+                    labels[start:start+len(block)] = model.predict(block)
+                    dataset[start:start+len(block)] = labels[start:start+len(block)]
+        return labels
+
+    def fit_blocks(self, model, vox_ratio_file):
+        """
+        Fit a model with ``partial_fit`` on all voxels, block by block
+
+        Parameters
+        ----------
+        model: model with a ``partial_fit`` method
+
+        vox_ratio_file: string
+            File written by ``DataPreparation.calculate_voxel_composition``
+
+        Notes
+        -----
+        Blocks are joined until the first batch holds at least
+        ``n_clusters`` voxels, the minimum for the first ``partial_fit``.
+        """
+        min_rows = getattr(model, "n_clusters", 1)
+        fitted = False
+        pending = []
+        for start, block in self.iter_ratio_blocks(vox_ratio_file, stage=self.get_feature_stage()):
+            pending.append(block)
+            if fitted or sum(len(batch) for batch in pending) >= min_rows:
+                model.partial_fit(np.concatenate(pending))
+                fitted = True
+                pending = []
+        if len(pending) > 0:
+            model.partial_fit(np.concatenate(pending))
+        return model
+
+    def iter_count_keys(self, vox_ratio_file, block_size=None):
+        """
+        Stream the species counts and the total number of ions of the
+        voxels in blocks, every voxel as one row key
+
+        Yields
+        ------
+        start: int
+            Voxel id of the first row of the block
+
+        keys: np array
+            Row keys of void dtype, equal for voxels with equal counts
+        """
+        if block_size is None:
+            block_size = self.params.get("read_block_size", DEFAULT_BLOCK_SIZE)
+        with self.get_project().read_stage(vox_ratio_file, "composition") as group:
+            counts = group["vox_counts"]
+            totals = group["vox_totals"]
+            for start in range(0, counts.shape[0], block_size):
+                rows = np.column_stack((counts[start:start+block_size], totals[start:start+block_size])).astype(np.uint32)
+                rows = np.ascontiguousarray(rows)
+                yield start, rows.view(np.dtype((np.void, rows.dtype.itemsize*rows.shape[1]))).ravel()
+
+    def get_unique_compositions(self, vox_ratio_file):
+        """
+        Collapse the voxels with equal species counts
+
+        Parameters
+        ----------
+        vox_ratio_file: string
+            File written by ``DataPreparation.calculate_voxel_composition``
+
+        Returns
+        -------
+        keys: np array
+            Sorted unique row keys, see ``iter_count_keys``
+
+        features: np array
+            Features of every unique row, the species ratios or, with
+            ``cluster_space: pca``, their principal components
+
+        weights: np array
+            Number of voxels of every unique row
+
+        Raises
+        ------
+        ValueError: if there are no voxels, or with ``cluster_space: pca``
+            if the saved principal components do not match the composition
+
+        Notes
+        -----
+        The counts are read block-wise, so only the unique rows are held in
+        memory. Voxels with equal counts have equal ratios and are given
+        the same label by every model.
+        """
+        keys = None
+        for start, block in self.iter_count_keys(vox_ratio_file):
+            block_keys, block_weights = np.unique(block, return_counts=True)
+            if keys is None:
+                keys, weights = block_keys, block_weights
+            else:
+                keys, inverse = np.unique(np.concatenate((keys, block_keys)), return_inverse=True)
+                weights = np.bincount(inverse.ravel(), weights=np.concatenate((weights, block_weights)))
+        if keys is None:
+            raise ValueError(f"no voxels found in {vox_ratio_file}")
+
+        rows = keys.view(np.uint32).reshape(len(keys), -1)
+        features = rows[:,:-1]/np.maximum(rows[:,-1], 1)[:,None]
+        if self.get_feature_stage() == "pca":
+            _, _, components, mean = self.get_pca_stage(vox_ratio_file)
+            features = (features - mean) @ components.T
+        return keys, features, weights.astype(np.int64)
+
+    def fit_unique_compositions(self, model, vox_ratio_file):
+        """
+        Fit a model on the unique voxel compositions and label all voxels
+
+        Parameters
+        ----------
+        model: unfitted model from ``models.get_model``
+
+        vox_ratio_file: string
+            File written by ``DataPreparation.calculate_voxel_composition``
+
+        Returns
+        -------
+        labels: np array
+            Label of every voxel, also written to the ``labels`` group of the
+            project file
+
+        Notes
+        -----
+        Models with ``sample_weight``, such as GaussianMixture with weighted
+        EM, are fitted on the unique rows weighted by their number of
+        voxels, which is the same objective as a fit on all voxels, and
+        are initialized with weighted k-means. The k-means draws differ
+        from those of a fit on all voxels, so the labels can differ where
+        the likelihood has several optima. Other models are
+        fitted on a sample of as many rows as there are unique rows, at most
+        ``fit_sample_size``, drawn in proportion to the weights. Only the
+        unique rows are predicted, their labels are mapped back to the
+        voxels through the sorted keys. The number of rows the model is
+        fitted on is kept in ``self.fit_rows``.
+        """
+        spec = get_model_spec(self.params["ml_models"]["name"])
+        keys, features, weights = self.get_unique_compositions(vox_ratio_file)
+        self.fit_rows = len(features)
+        if spec.sample_weight:
+            if spec.predict:
+                model.fit(features, sample_weight=weights)
+                unique_labels = model.predict(features)
+            else:
+                unique_labels = model.fit_predict(features, sample_weight=weights)
+        elif spec.predict:
+            n_samples = min(len(features), self.params.get("fit_sample_size", DEFAULT_FIT_SAMPLE_SIZE))
+            rng = np.random.default_rng(self.params.get("random_state", None))
+            X_train = features[rng.choice(len(features), size=n_samples, p=weights/weights.sum())]
+            self.fit_rows = n_samples
+            model.fit(X_train)
+            unique_labels = model.predict(features)
+        else:
+            raise ValueError(f"{spec.name} can neither predict nor be fitted on weighted compositions")
+
+        project = self.get_project()
+        unique_labels = np.asarray(unique_labels, dtype=np.int16)
+        n_rows = int(weights.sum())
+        labels = np.zeros(n_rows, dtype=np.int16)
+        with project.write_stage(None, "labels") as group:
+            dataset = project.backend.create_dataset(group, "labels", shape=(n_rows,), dtype=np.int16)
+            for start, block in self.iter_count_keys(vox_ratio_file):
+                labels[start:start+len(block)] = unique_labels[np.searchsorted(keys, block)]
+                dataset[start:start+len(block)] = labels[start:start+len(block)]
+        return labels
+
+    def save_model(self, model, vox_ratio_file, phase_order):
+        """
+        Write a fitted model to the ``model`` group of the project file
+
+        Parameters
+        ----------
+        model: fitted model with a ``predict`` method
+
+        vox_ratio_file: string
+            File the model was fitted on, its species order is saved
+
+        phase_order: list of ints
+            Model labels in the order of the phases
 
-    def get_PCA_cumsum(self, vox_ratio_file, vox_file):
+        Notes
+        -----
+        The group holds the pickled model and, for models fitted with
+        ``cluster_space: pca``, the principal axes and mean used to project
+        the ratios. ``load_model`` reads it back.
+        """
+        project = self.get_project()
+        with project.read_stage(vox_ratio_file, "composition") as group:
+            spec_name_order = list(group.attrs["spec_name_order"])
+        stage = self.get_feature_stage()
+        pca = None
+        if stage == "pca":
+            with project.read_stage(project.filename, "pca") as group:
+                pca = (np.asarray(group.attrs["components"]), np.asarray(group.attrs["mean"]))
+
+        with project.write_stage(None, "model") as group:
+            project.create_dataset(group, "model", np.frombuffer(pickle.dumps(model), dtype=np.uint8))
+            if pca is not None:
+                project.create_dataset(group, "pca_components", pca[0])
+                project.create_dataset(group, "pca_mean", pca[1])
+            group.attrs["name"] = self.params["ml_models"]["name"]
+            group.attrs["spec_name_order"] = spec_name_order
+            group.attrs["preprocessing"] = stage
+            group.attrs["phase_order"] = [int(label) for label in phase_order]
+
+    def load_model(self, model_file, vox_ratio_file=None):
+        """
+        Read a model written by ``save_model``
+
+        Parameters
+        ----------
+        model_file: string
+            Project file of the specimen the model was fitted on
+
+        vox_ratio_file: string, optional
+            File written by ``DataPreparation.calculate_voxel_composition``
+            for the specimen to label, its species order is checked
+
+        Returns
+        -------
+        saved: dict
+            The ``model``, its ``spec_name_order`` and ``phase_order``, the
+            ``stage`` to read the features from and the ``transform`` to
+            apply to them, None if the model was fitted on the ratios
+
+        Notes
+        -----
+        The features of a saved model are always read from the species
+        ratios of the ``composition`` stage, whatever the current
+        ``cluster_space``. A model fitted in the PCA space projects them with
+        the saved principal axes.
+
+        The model is unpickled, only load model files you trust.
+
+        Raises
+        ------
+        ValueError: if the species order of the ratio file does not match
+        """
+        project = self.get_project()
+        with project.read_stage(model_file, "model") as group:
+            saved = {"model": pickle.loads(np.asarray(group["model"][...]).tobytes()),
+                     "name": group.attrs["name"],
+                     "spec_name_order": list(group.attrs["spec_name_order"]),
+                     "phase_order": [int(label) for label in group.attrs["phase_order"]],
+                     "stage": "composition",
+                     "transform": None}
+            if group.attrs["preprocessing"] == "pca":
+                components = np.asarray(group["pca_components"][...])
+                mean = np.asarray(group["pca_mean"][...])
+                saved["transform"] = lambda block: (block - mean) @ components.T
+
+        if vox_ratio_file is not None:
+            with project.read_stage(vox_ratio_file, "composition") as group:
+                spec_name_order = list(group.attrs["spec_name_order"])
+            if spec_name_order != saved["spec_name_order"]:
+                raise ValueError(f"the species {spec_name_order} of {vox_ratio_file} do not match the species {saved['spec_name_order']} of the model in {model_file}")
+        return saved
+
+    def get_PCA_cumsum(self, vox_ratio_file, vox_file=None, save=False):
+        """
+        Principal components of the voxel ratios
 
-        with h5py.File(vox_file,"r") as hdf:
-            group = hdf.get("Group_sm_vox_xyz_Da_spec")
-            group0 = hdf.get("0")
-            spec_lst = list(list(group0.attrs.values())[1])
+        Parameters
+        ----------
+        vox_ratio_file: string
+            File written by ``DataPreparation.calculate_voxel_composition``
+
+        vox_file: string, optional
+            Not used, the number of species is read from the ratio file
 
-        with h5py.File(vox_ratio_file , "r") as hdfr:
-            ratios = np.array(hdfr.get("vox_ratios"))
-            ratios_columns = list(list(hdfr.attrs.values())[0])
-            group_name = list(list(hdfr.attrs.values())[1])
+        save: bool
+            Write the projected coordinates of all voxels to the ``pca``
+            group of the project file. Set ``cluster_space: pca`` to cluster
+            them instead of the ratios.
 
-        print(len(ratios))
-        print((ratios_columns))
+        Returns
+        -------
+        PCACumsumArr: np array
+            Cumulative explained variance ratio
 
-        ratios = pd.DataFrame(data=ratios, columns=ratios_columns)   
+        components: np array
+            Principal axes, shape (n_components, n_species)
 
-        X_train=ratios.drop(['Total_no','vox'], axis=1)
-        PCAObj = PCA(n_components = len(spec_lst)) 
-        PCATrans = PCAObj.fit_transform(X_train)
+        Notes
+        -----
+        The ratios are streamed in blocks of ``read_block_size`` voxels into
+        an ``IncrementalPCA``, the fitted model is kept in ``self.pca``.
+        """
+        n_rows, n_species = self.get_feature_shape(vox_ratio_file, "composition")
+        n_components = max(1, min(n_species, n_rows))
+        #every batch needs at least n_components rows
+        block_size = max(self.params.get("read_block_size", DEFAULT_BLOCK_SIZE), n_components)
+
+        PCAObj = IncrementalPCA(n_components = n_components)
+        pending = None
+        for start, block in self.iter_ratio_blocks(vox_ratio_file, block_size):
+            if pending is not None:
+                if len(block) < n_components:
+                    block = np.concatenate((pending, block))
+                else:
+                    PCAObj.partial_fit(pending)
+            pending = block
+        if pending is not None:
+            PCAObj.partial_fit(pending)
         PCACumsumArr = np.cumsum(PCAObj.explained_variance_ratio_)
+        self.pca = PCAObj
+
+        if save:
+            project = self.get_project()
+            with project.read_stage(vox_ratio_file, "composition") as group:
+                composition_id = group.attrs.get("composition_id", None)
+            with project.write_stage(None, "pca") as group:
+                dataset = project.backend.create_dataset(group, "vox_pca", self.params.get("hdf5", None),
+                                                         shape=(n_rows, n_components), dtype=np.float64)
+                for start, block in self.iter_ratio_blocks(vox_ratio_file, block_size):
+                    dataset[start:start+len(block)] = PCAObj.transform(block)
+                group.attrs["columns"] = ["pc{}".format(i) for i in range(n_components)]
+                group.attrs["components"] = PCAObj.components_.tolist()
+                group.attrs["mean"] = PCAObj.mean_.tolist()
+                group.attrs["explained_variance_ratio"] = PCAObj.explained_variance_ratio_.tolist()
+                if composition_id is not None:
+                    group.attrs["composition_id"] = composition_id
+                group.attrs["composition_file"] = os.path.abspath(vox_ratio_file)
         
         plt.figure(figsize=(5,5))
         plt.plot( range(1,len(PCACumsumArr)+1,1),PCACumsumArr,"-o")
@@ -56,40 +643,86 @@ class CompositionClustering():
         plt.savefig(output_path)
         plt.show()
         
-        return PCACumsumArr, ratios
+        return PCACumsumArr, PCAObj.components_
 
     
     
     def get_bics_minimization(self, vox_ratio_file, vox_file):
-        
-        with h5py.File(vox_file,"r") as hdf:
-            group = hdf.get("Group_sm_vox_xyz_Da_spec")
-            group0 = hdf.get("0")
-            spec_lst = list(list(group0.attrs.values())[2])
+        """
+        Select the number of phases by the BIC of GaussianMixture fits
+
+        Parameters
+        ----------
+        vox_ratio_file: string
+            File written by ``DataPreparation.calculate_voxel_composition``
 
-        with h5py.File(vox_ratio_file , "r") as hdfr:
-            ratios = np.array(hdfr.get("vox_ratios"))
-            ratios_columns = list(list(hdfr.attrs.values())[0])
-            group_name = list(list(hdfr.attrs.values())[1])
+        vox_file: string
+            Voxel file written by ``DataPreparation.get_voxels``
 
-        ratios = pd.DataFrame(data=ratios, columns=ratios_columns) 
+        Returns
+        -------
+        n_phases: int
+            Number of components with the lowest BIC
+
+        aics, bics: lists
+            Information criteria for 1, 2, ... components
+
+        Notes
+        -----
+        The fits for 1 to ``bics_clusters`` - 1 components run ``n_workers``
+        at a time in a process pool, each with ``bics_n_init``
+        initializations. The sweep stops once the BIC has risen for
+        ``bics_patience`` consecutive component counts, None sweeps all
+        counts. The component counts, criteria and fit times are kept in
+        ``self.bics_results``.
+        """
+        X_train = self.get_ratio_sample(vox_ratio_file)
+        n_workers = self.params.get("n_workers", 1)
+        n_init = self.params.get("bics_n_init", 1)
+        patience = self.params.get("bics_patience", None)
+        random_state = self.params.get("random_state", None)
         
-        gm_scores=[]
         aics=[]
         bics=[]
-        
-        X_train=ratios.drop(['Total_no','vox'], axis=1)
+        fit_times=[]
         
         n_clusters=list(range(1,self.params["bics_clusters"]))
         
-        pbar = tqdm(n_clusters, desc="Clustering")
-        for n_cluster in pbar:
-            gm = GaussianMixture(n_components=n_cluster,verbose=0)
-            gm.fit(X_train)
-            y_pred=gm.predict(X_train)
-            #gm_scores.append(homogeneity_score(y,y_pred))
-            aics.append(gm.aic(X_train))
-            bics.append(gm.bic(X_train))
+        pbar = tqdm(total=len(n_clusters), desc="Clustering")
+        executor = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+        try:
+            #fit one wave of n_workers component counts at a time, so the
+            #sweep can stop after any wave
+            for wave in range(0, len(n_clusters), n_workers):
+                counts = n_clusters[wave:wave+n_workers]
+                if executor is not None:
+                    futures = [executor.submit(fit_mixture, X_train, n_cluster, n_init, random_state) for n_cluster in counts]
+                    results = [future.result() for future in futures]
+                else:
+                    results = [fit_mixture(X_train, n_cluster, n_init, random_state) for n_cluster in counts]
+                stop = False
+                for n_cluster, aic, bic, fit_time in results:
+                    aics.append(aic)
+                    bics.append(bic)
+                    fit_times.append(fit_time)
+                    pbar.update(1)
+                    if patience is not None and get_bic_rises(bics) >= patience:
+                        stop = True
+                        break
+                if stop:
+                    break
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            pbar.close()
+
+        n_clusters = n_clusters[:len(bics)]
+        n_phases = n_clusters[int(np.argmin(bics))]
+        self.bics_results = {"n_clusters": n_clusters, "aics": aics, "bics": bics,
+                             "fit_times": fit_times, "n_phases": n_phases}
+        for n_cluster, fit_time in zip(n_clusters, fit_times):
+            print("{} components fitted in {:.2f} s".format(n_cluster, fit_time))
+        print("lowest BIC with n_phases: {}".format(n_phases))
             
         output_path = os.path.join(self.params["output_path"], "bics_aics.png")
         plt.plot(n_clusters, aics, "-o",label="AIC")
@@ -97,7 +730,7 @@ class CompositionClustering():
         plt.legend()
         plt.savefig(output_path)
         plt.show()
-        return self.params["bics_clusters"], aics, bics    
+        return n_phases, aics, bics    
     
    
     def calculate_centroid(self, data):
@@ -126,117 +759,196 @@ class CompositionClustering():
 
 
     def get_voxel_centroid(self, vox_file, files_arr):
-
-        with h5py.File(vox_file, "r") as hdf:
-            items = list(hdf.items())
-            item_lst = []
-            for item in range(len(items)):
-                item_lst.append([100000*(item),100000*(item+1)])
-            item_lst = np.array(item_lst)
-
-            dic_centroids = {}
-            dic_centroids["x"]=[]
-            dic_centroids["y"]=[]
-            dic_centroids["z"] = []
-            dic_centroids["file_name"] = []
-            df_centroids = pd.DataFrame(columns=['x', 'y', 'z','filename'])
-            
-            for filename in files_arr:
-                group = np.min(item_lst[[filename in range(j[0],j[1]) for j in item_lst]])
-                xyz_Da_spec_atoms = np.array(hdf.get("{}/{}".format(group, filename)))
-                x, y, z = self.calculate_centroid(xyz_Da_spec_atoms)
-                dic_centroids["x"].append(x)
-                dic_centroids["y"].append(y)
-                dic_centroids["z"].append(z)
-                dic_centroids["file_name"].append(filename)            
+        """
+        Get the centroids of a set of voxels
+        Parameters
+        ----------
+        vox_file: voxel file written by DataPreparation.get_voxels
+        files_arr: list of voxel ids
+        Returns
+        -------
+        dictionary with the lists x, y, z and file_name
+        Notes
+        -----
+        The centroids are computed during voxelization, this only indexes them.
+        """
+        with VoxelStore(vox_file) as store:
+            centroids = store.get_centroids()
+
+        voxel_ids = np.asarray(files_arr, dtype=np.int64)
+        dic_centroids = {}
+        dic_centroids["x"] = list(centroids[voxel_ids,0])
+        dic_centroids["y"] = list(centroids[voxel_ids,1])
+        dic_centroids["z"] = list(centroids[voxel_ids,2])
+        dic_centroids["file_name"] = list(voxel_ids)
         return dic_centroids
 
     
-    def get_composition_cluster_files(self, vox_ratio_file, vox_file, n_components):
+    def get_composition_cluster_files(self, vox_ratio_file, vox_file, n_components, model_file=None):
+        """
+        Fit the clustering model and group the voxels by phase
 
-        ml_params = self.params["ml_models"]
-        
-        with h5py.File(vox_file,"r") as hdf:
-            group = hdf.get("Group_sm_vox_xyz_Da_spec")
-            group0 = hdf.get("0")
-            spec_lst = list(list(group0.attrs.values())[2])
+        Parameters
+        ----------
+        vox_ratio_file: string
+            File written by ``DataPreparation.calculate_voxel_composition``
 
-        with h5py.File(vox_ratio_file , "r") as hdfr:
-            ratios = np.array(hdfr.get("vox_ratios"))
-            ratios_columns = list(list(hdfr.attrs.values())[0])
-            group_name = list(list(hdfr.attrs.values())[1])
+        vox_file: string
+            Voxel file written by ``DataPreparation.get_voxels``
 
-        ratios = pd.DataFrame(data=ratios, columns=ratios_columns) 
-        
-        X_train=ratios.drop(['Total_no','vox'], axis=1)
-        
-        gm = get_model(ml_params=ml_params)
-        gm.fit(X_train)
-        y_pred=gm.predict(X_train)
+        n_components: int
+            Number of phases
+
+        model_file: string, optional
+            Project file holding a model saved by an earlier run, defaults
+            to ``model_file`` from the input parameters. The voxels are
+            labelled by this model without fitting.
+
+        Returns
+        -------
+        cluster_lst: list of np arrays
+            Voxel ids of every phase, sorted by the number of voxels, or in
+            the phase order of the saved model
+
+        labels: np array
+            Label of every voxel
+
+        Notes
+        -----
+        The path depends on the capabilities of the model in
+        ``ml_models``, see ``models.register_model``:
+
+        - models with ``partial_fit`` are fitted on all voxels, block by
+          block, see ``fit_blocks``
+        - other models are fitted on at most ``fit_sample_size`` voxels,
+          see ``get_ratio_sample``
+        - models with ``predict`` then label all voxels block-wise, see
+          ``predict_labels``, so the ratio matrix is never loaded as a
+          whole. Models without, such as DBScan, label the voxels they are
+          fitted on, so all voxels must fit into the sample. Voxels they
+          leave unlabelled, with label -1, belong to no phase.
+        - models with ``n_jobs`` use ``n_workers`` jobs, unless ``n_jobs``
+          is given in their parameters
+        - with ``unique_compositions`` set, voxels with equal species
+          counts are collapsed before fitting, see
+          ``fit_unique_compositions``. The model is fitted on as many rows
+          as there are unique compositions, a fraction of the voxels if most
+          voxels hold few ions. Models with ``sample_weight`` fit the same
+          objective as on all voxels, other models a weighted sample.
+
+        A model with ``predict`` is saved to the project file, see
+        ``save_model``, so that further specimens of the same alloy can be
+        labelled with it.
+
+        Raises
+        ------
+        ValueError: if the model is supervised, such as randomforest
+        """
+        ml_params = self.params["ml_models"]
+        if model_file is None:
+            model_file = self.params.get("model_file", None)
+
+        if model_file is not None:
+            saved = self.load_model(model_file, vox_ratio_file)
+            y_pred = self.predict_labels(saved["model"], vox_ratio_file, saved["transform"], saved["stage"])
+            phase_order = saved["phase_order"]
+        else:
+            spec = get_model_spec(ml_params["name"])
+            if spec.supervised:
+                raise ValueError(f"{spec.name} is a supervised model and cannot cluster voxels, choose an unsupervised model")
+            gm = get_model(ml_params=ml_params)
+            if spec.n_jobs and gm.get_params()["n_jobs"] is None:
+                gm.set_params(n_jobs=self.params.get("n_workers", 1))
+
+            if self.params.get("unique_compositions", False):
+                y_pred = self.fit_unique_compositions(gm, vox_ratio_file)
+            elif not spec.predict:
+                n_rows, n_features = self.get_feature_shape(vox_ratio_file, self.get_feature_stage())
+                X_train = self.get_ratio_sample(vox_ratio_file)
+                if len(X_train) < n_rows:
+                    raise ValueError(f"{ml_params['name']} cannot label voxels it is not fitted on, increase fit_sample_size to {n_rows}")
+                y_pred = gm.fit_predict(X_train).astype(np.int16)
+                with self.get_project().write_stage(None, "labels") as group:
+                    self.get_project().create_dataset(group, "labels", y_pred)
+            else:
+                if spec.partial_fit:
+                    self.fit_blocks(gm, vox_ratio_file)
+                else:
+                    gm.fit(self.get_ratio_sample(vox_ratio_file))
+                y_pred = self.predict_labels(gm, vox_ratio_file)
+            
+            #sorting by the number of voxels
+            phases = np.unique(y_pred[y_pred >= 0]) if not spec.predict else np.arange(n_components)
+            len_arr = np.array([np.count_nonzero(y_pred == phase) for phase in phases])
+            phase_order = phases[np.argsort(len_arr, kind="stable")]
+            if spec.predict:
+                self.save_model(gm, vox_ratio_file, phase_order)
         
         cluster_lst = []
-        for phase in range(n_components):
+        for phase in phase_order:
             cluster_lst.append(np.argwhere(y_pred == phase).flatten())        
-        df_lst = []
-        for cluster in cluster_lst:
-            df_lst.append(ratios.iloc[cluster])
-            
-        #sorting
-        cluster_lst_sort = []
-        len_arr = np.array([len(x) for x in cluster_lst])
-        sorted_len_arr = np.sort(len_arr)
-        for length in sorted_len_arr:
-            cluster_lst_sort.append(cluster_lst[np.argwhere(len_arr == length)[0,0]])
-
-        #print([len(x) for x in cluster_lst_sort])
-        cluster_lst = cluster_lst_sort
         
-        return cluster_lst, ratios
+        return cluster_lst, y_pred
     
-    def get_composition_clusters(self, vox_ratio_file, vox_file, outfile="vox_centroid_file.h5"):
+    def get_composition_clusters(self, vox_ratio_file, vox_file, outfile=None, model_file=None):
+        """
+        Segment the voxels into phases by their composition
+
+        Parameters
+        ----------
+        vox_ratio_file: string
+            File written by ``DataPreparation.calculate_voxel_composition``
+
+        vox_file: string
+            Voxel file written by ``DataPreparation.get_voxels``
+
+        outfile: string, optional
+            Name of a separate output file in ``output_path``. By default
+            the phases are written to the project file.
+
+        model_file: string, optional
+            Project file of an earlier specimen, its saved model labels the
+            voxels without fitting, see ``get_composition_cluster_files``
+
+        Returns
+        -------
+
+        Notes
+        -----
+        The ``segmentation`` group holds a group per phase, sorted by the
+        number of voxels, and a last group with all voxels. Each holds the
+        voxel centroids and ids, described by the ``columns`` attribute.
+        ``self.voxel_centroid_output_file`` is set to the file holding the
+        group.
+        """
         voxel_centroid_output_file = []
         n_components = self.params["n_phases"]
         ml_params = self.params["ml_models"]
-        cluster_lst, ratios = self.get_composition_cluster_files(vox_ratio_file, vox_file, n_components)
-
-        plot_files = []
-        for phase in range(len(cluster_lst)):
-            cluster_files = []
-            cluster = cluster_lst[phase]
-            for voxel_id in cluster:
-                cluster_files.append(ratios['vox'][voxel_id])
-            plot_files.append(cluster_files)
+        cluster_lst, labels = self.get_composition_cluster_files(vox_ratio_file, vox_file, n_components, model_file)
 
+        #the rows of the ratio matrix are the voxel ids
         plot_files_group = []
-        for cluster_files in plot_files:
-            plot_files_group.append([int(file_num) for file_num in cluster_files ])
+        for cluster in cluster_lst:
+            plot_files_group.append(cluster.astype(np.int64))
             
-        with h5py.File(vox_file,"r") as hdf_sm_r:
-            hdf_sm_r = h5py.File(vox_file,"r")
-            group = hdf_sm_r.get("0")
-            #total_voxels =list(list(group.attrs.values())[0])
-            total_voxels =list(list(group.attrs.values())[2])
-
-            total_voxels_int =""
-            for number in total_voxels:
-                total_voxels_int = total_voxels_int + number
-
-            total_voxels_int = int(total_voxels_int)
-            hdf_sm_r.close()
-            plot_files_cl_All_group = [file_num for file_num in range(total_voxels_int)]
+        with VoxelStore(vox_file) as store:
+            centroids = store.get_centroids()
+            plot_files_cl_All_group = np.arange(len(store))
             
         plot_files_group.append(plot_files_cl_All_group)
-        output_path = os.path.join(self.params["output_path"], outfile)
-        with h5py.File(output_path,"w") as hdfw:
+        project = self.get_project()
+        output_path = project.filename
+        if outfile is not None:
+            output_path = os.path.join(self.params["output_path"], outfile)
+        with project.write_stage(output_path, "segmentation") as hdfw:
             for cluster_file_id in range(len(plot_files_group)):
 
                 G = hdfw.create_group(f"{cluster_file_id}")
                 G.attrs["what"] = ["Centroid of voxels"]
-                G.attrs["howto_Group_name"] = ["Group_sm_vox_xyz_Da_spec/"]
-                G.attrs["colomns"] = ["x","y","z","file_name"]
+                G.attrs["columns"] = ["x","y","z","file_name"]
 
-                CentroidsDic = self.get_voxel_centroid(vox_file, plot_files_group[cluster_file_id])
-                G.create_dataset(f"{cluster_file_id}", data = pd.DataFrame.from_dict(CentroidsDic).values)
+                voxel_ids = plot_files_group[cluster_file_id]
+                project.create_dataset(G, f"{cluster_file_id}", data = np.column_stack((centroids[voxel_ids], voxel_ids)))
 
         self.voxel_centroid_output_file = output_path
 
@@ -244,16 +956,16 @@ class CompositionClustering():
     def generate_plots(self):
 
         vtk_files = []
-        with h5py.File(self.voxel_centroid_output_file, "r") as hdfr:            
+        with self.get_project().read_stage(self.voxel_centroid_output_file, "segmentation") as hdfr:
             groups =list(hdfr.keys())
             for group in range(len(groups)-1):
-                phase_arr =  np.array(hdfr.get(f"{group}/{group}"))
-                phase_columns = list(list(hdfr.get(f"{group}").attrs.values())[0])
+                phase_arr =  hdfr[f"{group}/{group}"][...]
+                phase_columns = list(hdfr[f"{group}"].attrs["columns"])
                 phase_cent_df =pd.DataFrame(data=phase_arr, columns=phase_columns)
                 
                 image = phase_cent_df.values
                 
-                file_path = self.voxel_centroid_output_file + f"_{group}"
+                file_path = os.path.join(self.params["output_path"], f"vox_centroid_phase_{group}")
                
                 vtk_files.append(file_path + ".vtu")
 
@@ -0,0 +1,368 @@
+"""
+Storage backends, chunking and compression of the datasets written by the
+pipeline
+"""
+
+import os
+import time
+import shutil
+import contextlib
+from abc import ABC, abstractmethod
+import h5py
+import numpy as np
+
+#size of one chunk if compression is enabled and no chunk size is given
+DEFAULT_CHUNK_KB = 1024
+
+COMPRESSIONS = [None, "lzf", "gzip"]
+
+
+def get_dataset_options(shape, dtype, compression=None, compression_opts=None, shuffle=True, chunk_kb=None):
+    """
+    Keyword arguments for ``h5py.Group.create_dataset``
+
+    Parameters
+    ----------
+    shape: tuple
+        Shape of the dataset
+
+    dtype: np.dtype
+        Type of the dataset
+
+    compression: string, optional
+        None, "lzf" or "gzip"
+
+    compression_opts: int, optional
+        gzip level from 0 to 9
+
+    shuffle: bool
+        Apply the shuffle filter before compressing
+
+    chunk_kb: float, optional
+        Target size of one chunk in kB. Defaults to ``DEFAULT_CHUNK_KB`` if
+        compression is enabled, otherwise the dataset is stored contiguously.
+
+    Returns
+    -------
+    options: dict
+        chunks, compression, compression_opts and shuffle, empty for a
+        contiguous dataset
+
+    Notes
+    -----
+    All datasets of the pipeline are read in blocks of whole rows, so chunks
+    span complete rows: a chunk of an ion array is a block of ions, a chunk
+    of a ratio matrix a block of voxels with all their columns. Contiguous
+    datasets can be memory-mapped, see ``VoxelStore``.
+
+    Raises
+    ------
+    ValueError: if the compression is unknown
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"unknown compression {compression}, choose from: {COMPRESSIONS}")
+    if compression is None and chunk_kb is None:
+        return {}
+    if len(shape) == 0 or shape[0] == 0:
+        return {}
+    if chunk_kb is None:
+        chunk_kb = DEFAULT_CHUNK_KB
+
+    row_bytes = np.dtype(dtype).itemsize*int(np.prod(shape[1:]))
+    rows = int(min(shape[0], max(1, chunk_kb*1024//row_bytes)))
+    options = {"chunks": (rows,) + tuple(shape[1:])}
+    if compression is not None:
+        options["compression"] = compression
+        if compression == "gzip" and compression_opts is not None:
+            options["compression_opts"] = compression_opts
+        options["shuffle"] = shuffle
+    return options
+
+
+def create_dataset(group, name, storage=None, data=None, shape=None, dtype=None):
+    """
+    Create an HDF5 dataset with the chunking and compression of ``storage``
+
+    Parameters
+    ----------
+    group: h5py Group or File
+
+    name: string
+        Name of the dataset
+
+    storage: dict, optional
+        Keyword arguments of ``get_dataset_options``, usually the ``hdf5``
+        section of the input parameters
+
+    data: np array, optional
+        Initial data
+
+    shape, dtype: optional
+        Shape and type if no data is given
+
+    Returns
+    -------
+    dataset: h5py Dataset
+    """
+    if data is not None:
+        data = np.asarray(data)
+        shape, dtype = data.shape, data.dtype
+    options = get_dataset_options(shape, dtype, **(storage or {}))
+    return group.create_dataset(name, shape=shape, dtype=dtype, data=data, **options)
+
+
+class StorageBackend(ABC):
+    """
+    Minimal interface of a hierarchical array store
+
+    Notes
+    -----
+    A store holds groups with attributes and n-dimensional, possibly
+    structured, arrays that are read and written in slices. Groups are
+    h5py or zarr groups, which share ``create_group``, ``require_group``,
+    ``attrs``, ``keys``, item access and deletion, so only opening, creating
+    arrays and backend specific details go through the backend. Backends
+    must implement ``open_root``, ``create_dataset`` and ``remove``.
+    """
+    name = None
+    extension = None
+
+    @abstractmethod
+    def open_root(self, path, mode="r"):
+        """
+        Open a store and return its root group, close it with ``close``
+        """
+        raise NotImplementedError
+
+    def close(self, root):
+        pass
+
+    def flush(self, root):
+        pass
+
+    @contextlib.contextmanager
+    def open(self, path, mode="r"):
+        """
+        Context manager yielding the root group of a store
+
+        Parameters
+        ----------
+        path: string
+            Name of the store
+
+        mode: string
+            "r", "a" or "w", as for ``h5py.File``
+        """
+        root = self.open_root(path, mode)
+        try:
+            yield root
+        finally:
+            self.close(root)
+
+    @abstractmethod
+    def create_dataset(self, group, name, storage=None, data=None, shape=None, dtype=None):
+        """
+        Create an array, see ``get_dataset_options`` for ``storage``
+        """
+        raise NotImplementedError
+
+    def get_memmap(self, path, dataset):
+        """
+        Memory-map an array, None if its layout does not allow it
+        """
+        return None
+
+    @abstractmethod
+    def remove(self, path):
+        """
+        Delete a store
+        """
+        raise NotImplementedError
+
+    def copy_group(self, source, target):
+        """
+        Copy the arrays, subgroups and attributes of a group, also between
+        backends
+        """
+        target.attrs.update(dict(source.attrs))
+        for name in source.keys():
+            item = source[name]
+            if hasattr(item, "shape"):
+                self.create_dataset(target, name, data=np.asarray(item[...]))
+            else:
+                self.copy_group(item, target.create_group(name))
+
+
+class HDF5Backend(StorageBackend):
+    """
+    One HDF5 file per store, the default
+
+    Notes
+    -----
+    HDF5 files cannot be written by several processes at once, parallel
+    workers write separate partial files instead.
+    """
+    name = "hdf5"
+    extension = ".h5"
+
+    def open_root(self, path, mode="r"):
+        return h5py.File(path, mode)
+
+    def close(self, root):
+        if root.id.valid:
+            root.close()
+
+    def flush(self, root):
+        root.flush()
+
+    def create_dataset(self, group, name, storage=None, data=None, shape=None, dtype=None):
+        return create_dataset(group, name, storage, data=data, shape=shape, dtype=dtype)
+
+    def get_memmap(self, path, dataset):
+        file_offset = dataset.id.get_offset()
+        if dataset.chunks is None and file_offset is not None:
+            return np.memmap(path, dtype=dataset.dtype, mode="r", offset=file_offset, shape=dataset.shape)
+        return None
+
+    def remove(self, path):
+        os.remove(path)
+
+
+class ZarrBackend(StorageBackend):
+    """
+    Zarr directory store on local disk
+
+    Notes
+    -----
+    Every array chunk is a file of its own, so worker processes can write
+    different arrays, or different chunks of one array, of the same store
+    at the same time. Stores are written in the Zarr v2 format, which
+    supports the structured ion arrays. Requires ``zarr`` >= 3, and
+    ``numcodecs`` for compression.
+    """
+    name = "zarr"
+    extension = ".zarr"
+
+    def __init__(self):
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError("the zarr storage backend needs zarr, install it with: pip install zarr")
+        self.zarr = zarr
+
+    def open_root(self, path, mode="r"):
+        return self.zarr.open_group(path, mode=mode, zarr_format=2)
+
+    def get_compressor(self, compression=None, compression_opts=None, shuffle=True):
+        if compression is None:
+            return None
+        import numcodecs
+        if compression == "gzip":
+            return numcodecs.GZip(level=4 if compression_opts is None else compression_opts)
+        #lzf is HDF5 specific, lz4 is the closest fast codec
+        return numcodecs.Blosc(cname="lz4", shuffle=numcodecs.Blosc.SHUFFLE if shuffle else numcodecs.Blosc.NOSHUFFLE)
+
+    def create_dataset(self, group, name, storage=None, data=None, shape=None, dtype=None):
+        if data is not None:
+            data = np.asarray(data)
+            shape, dtype = data.shape, data.dtype
+        storage = dict(storage or {})
+        #zarr arrays are always chunked
+        options = get_dataset_options((max(shape[0], 1),) + tuple(shape[1:]), dtype,
+                                      compression=storage.get("compression", None),
+                                      chunk_kb=storage.get("chunk_kb", None) or DEFAULT_CHUNK_KB)
+        compressor = self.get_compressor(storage.get("compression", None), storage.get("compression_opts", None),
+                                         storage.get("shuffle", True))
+        array = group.create_array(name, shape=shape, dtype=dtype, chunks=options["chunks"],
+                                   compressors=compressor, overwrite=True)
+        if data is not None and data.size > 0:
+            array[...] = data
+        return array
+
+    def remove(self, path):
+        shutil.rmtree(path)
+
+
+BACKENDS = {"hdf5": HDF5Backend, "zarr": ZarrBackend}
+
+
+def get_backend(name=None, path=None):
+    """
+    Storage backend by name, or by the extension of a store
+
+    Parameters
+    ----------
+    name: string, optional
+        "hdf5" or "zarr", usually ``storage_backend`` of the input
+        parameters
+
+    path: string, optional
+        Name of an existing store, used if no name is given
+
+    Returns
+    -------
+    backend: StorageBackend
+
+    Raises
+    ------
+    ValueError: if the backend is unknown
+    """
+    if name is None:
+        name = "zarr" if path is not None and path.rstrip(os.sep).endswith(ZarrBackend.extension) else "hdf5"
+    if name not in BACKENDS:
+        raise ValueError(f"unknown storage backend {name}, choose from: {list(BACKENDS.keys())}")
+    return BACKENDS[name]()
+
+
+def benchmark_storage(data, settings, path, repeat=1):
+    """
+    Write throughput and file size of storage settings
+
+    Parameters
+    ----------
+    data: np array
+        Array to write, for example the ions of a slice
+
+    settings: list of dicts
+        Keyword arguments of ``get_dataset_options``
+
+    path: string
+        Folder for the temporary files
+
+    repeat: int
+        Number of writes per setting, the fastest is reported
+
+    Returns
+    -------
+    results: list of dicts
+        The setting, the write and read throughput in MB/s, the file size
+        in MB and the ratio of the file size to the raw data size
+
+    Examples
+    --------
+    >>> benchmark_storage(ions, [{}, {"compression": "lzf"},
+    ...                          {"compression": "gzip", "compression_opts": 4}], "/tmp")
+    """
+    data = np.asarray(data)
+    raw_mb = data.nbytes/1024**2
+    results = []
+    for i, storage in enumerate(settings):
+        file_name = os.path.join(path, "storage_benchmark_{}.h5".format(i))
+        write_time = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with h5py.File(file_name, "w") as hdfw:
+                create_dataset(hdfw, "data", storage, data=data)
+            write_time = min(write_time, time.perf_counter() - start)
+        start = time.perf_counter()
+        with h5py.File(file_name, "r") as hdfr:
+            np.array(hdfr["data"])
+        read_time = time.perf_counter() - start
+        size_mb = os.path.getsize(file_name)/1024**2
+        os.remove(file_name)
+        results.append({"storage": storage,
+                        "write_mb_s": raw_mb/max(write_time, 1e-9),
+                        "read_mb_s": raw_mb/max(read_time, 1e-9),
+                        "size_mb": size_mb,
+                        "ratio": size_mb/max(raw_mb, 1e-9)})
+    return results
@@ -28,8 +28,9 @@ setup(
         'Programming Language :: Python :: 3.7',
     ],
     description="APT analysis tools",
-    install_requires = ['numpy', 'matplotlib', 'pandas', 'h5py', 'scikit-learn',
+    install_requires = ['numpy', 'matplotlib', 'pandas', 'h5py', 'scikit-learn>=1.2,<1.10',
     'tqdm', 'pyevtk', 'pyyaml', 'pyvista'],
+    extras_require = {'zarr': ['zarr>=3', 'numcodecs']},
     #license="GNU General Public License v3",
     long_description=readme,
     long_description_content_type='text/markdown',
@@ -0,0 +1,118 @@
+import pytest
+import shutil
+import yaml
+import numpy as np
+from compositionspace.datautils import DataPreparation
+
+
+def write_pos(file_name, x, y, z, m):
+    """
+    Write ions as a big-endian pos file
+    """
+    pos = np.empty(len(x), dtype=[('x', '>f4'), ('y', '>f4'), ('z', '>f4'), ('m', '>f4')])
+    pos['x'], pos['y'], pos['z'], pos['m'] = x, y, z, m
+    pos.tofile(file_name)
+
+
+@pytest.fixture
+def pos_ions():
+    """
+    Random ions in a 20 nm cube with masses inside the C, O and Fe ranges
+    of tests/data/R31_06365-v02.rrng
+    """
+    rng = np.random.default_rng(42)
+    n = 20000
+    xyz = rng.uniform(-10, 10, size=(n, 3)).astype(np.float32)
+    m = rng.choice(np.array([6.0, 16.0, 28.0, 55.9, 100.0], dtype=np.float32), size=n)
+    return xyz[:,0], xyz[:,1], xyz[:,2], m
+
+
+@pytest.fixture
+def pos_file(tmp_path, pos_ions):
+    file_name = str(tmp_path / "synthetic.pos")
+    write_pos(file_name, *pos_ions)
+    return file_name
+
+
+def write_apt(file_name, sections):
+    """
+    Write a minimal APSuite6 *.APT file
+
+    sections is a list of (name, data) tuples, data being float32 or int32
+    arrays of shape (n, elements per record)
+    """
+    file_header = np.dtype([('cSignature', np.int8, (4,)), ('iHeaderSize', np.int32),
+                            ('iHeaderVersion', np.int32), ('wcFilename', np.uint16, 256),
+                            ('ftCreationTime', np.uint64), ('llIonCount', np.uint64)])
+    section_header = np.dtype([('cSignature', np.int8, (4,)), ('iHeaderSize', np.int32),
+                               ('iHeaderVersion', np.int32), ('wcSectionType', np.uint16, 32),
+                               ('iSectionVersion', np.int32), ('eRelationshipType', np.uint32),
+                               ('eRecordType', np.uint32), ('eRecordDataType', np.uint32),
+                               ('iDataTypeSize', np.int32), ('iRecordSize', np.int32),
+                               ('wcDataUnit', np.uint16, 16), ('llRecordCount', np.uint64),
+                               ('llByteCount', np.uint64)])
+    n = len(sections[0][1])
+    with open(file_name, "wb") as fid:
+        head = np.zeros(1, dtype=file_header)
+        head['cSignature'] = [ord(c) for c in 'APT\x00']
+        head['iHeaderSize'], head['iHeaderVersion'], head['llIonCount'] = 540, 2, n
+        head.tofile(fid)
+        for name, data in sections:
+            integer = np.issubdtype(np.asarray(data).dtype, np.integer)
+            data = np.ascontiguousarray(data, dtype=np.int32 if integer else np.float32)
+            sect = np.zeros(1, dtype=section_header)
+            sect['cSignature'] = [ord(c) for c in 'SEC\x00']
+            sect['iHeaderSize'] = 148 + 6*4 if name == 'Position' else 148
+            sect['iHeaderVersion'], sect['iSectionVersion'] = 2, 1
+            sect['eRelationshipType'], sect['eRecordType'], sect['eRecordDataType'] = 1, 1, 1 if integer else 3
+            sect['iDataTypeSize'], sect['iRecordSize'] = 32, 4*data.shape[1]
+            sect['wcSectionType'][0, :len(name)] = [ord(c) for c in name]
+            sect['llRecordCount'], sect['llByteCount'] = n, data.nbytes
+            sect.tofile(fid)
+            if name == 'Position':
+                np.concatenate((data.min(axis=0), data.max(axis=0))).astype(np.float32).tofile(fid)
+            data.tofile(fid)
+
+
+@pytest.fixture
+def apt_file(tmp_path, pos_ions):
+    x, y, z, m = pos_ions
+    file_name = str(tmp_path / "synthetic.apt")
+    write_apt(file_name, [("tof", np.ones((len(x), 1))),
+                          ("Mass", m[:, None]),
+                          ("XDet_mm", np.zeros((len(x), 1))),
+                          ("Position", np.stack((x, y, z), axis=1))])
+    return file_name
+
+
+@pytest.fixture
+def specimen_params(tmp_path, pos_ions):
+    """
+    Input parameters for a synthetic specimen with a pos and a range file
+    """
+    input_path = tmp_path / "data"
+    input_path.mkdir()
+    write_pos(str(input_path / "synthetic.pos"), *pos_ions)
+    shutil.copy("tests/data/R31_06365-v02.rrng", str(input_path))
+    with open("tests/experiment_params.yaml", "r") as fin:
+        params = yaml.safe_load(fin)
+    params["input_path"] = str(input_path)
+    params["output_path"] = str(tmp_path / "output")
+    params["n_big_slices"] = 4
+    params["min_voxel_ions"] = 5
+    return params
+
+
+@pytest.fixture
+def run_preparation():
+    """
+    Run the preparation stages up to the voxel composition, returns a
+    function of the input parameters
+    """
+    def run(params, outfilename=None):
+        data = DataPreparation(params)
+        data.get_big_slices()
+        data.get_voxels()
+        data.calculate_voxel_composition(outfilename=outfilename)
+        return data
+    return run
@@ -0,0 +1,24 @@
+import pytest
+import json
+import os
+import numpy as np
+from compositionspace.batch import BatchProcessing
+from conftest import write_apt
+
+def test_batch(specimen_params, pos_ions):
+    x, y, z, m = pos_ions
+    write_apt(os.path.join(specimen_params["input_path"], "second.apt"),
+              [("Mass", m[:, None]), ("Position", np.stack((x, y, z), axis=1))])
+    with open(os.path.join(specimen_params["input_path"], "broken.pos"), "wb") as fout:
+        fout.write(b"truncated")
+    specimen_params["batch"] = {"n_workers": 2, "memory_budget_gb": 1}
+    batch = BatchProcessing(specimen_params)
+    results = batch.run()
+    with open(batch.manifest_file, "r") as fin:
+        manifest = json.load(fin)
+    status = {entry["specimen"]: entry["status"] for entry in manifest["specimens"]}
+    assert status == {"broken.pos": "failed", "second.apt": "done", "synthetic.pos": "done"}
+    for entry in manifest["specimens"]:
+        if entry["status"] == "done":
+            assert os.path.exists(entry["voxel_ratio_file"])
+            assert entry["timings"]["total"] > 0
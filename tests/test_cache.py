@@ -0,0 +1,82 @@
+import pytest
+import os
+import time
+import numpy as np
+import h5py
+import pandas as pd
+from compositionspace.datautils import DataPreparation
+from compositionspace.cache import StageCache
+
+def get_composition_files(params):
+    cache_path = os.path.join(params["output_path"], "cache")
+    return sorted(os.path.join(cache_path, name, "composition.h5") for name in os.listdir(cache_path) if name.startswith("composition_"))
+
+def test_stage_cache(specimen_params, run_preparation):
+    specimen_params["cache"] = {"enabled": True}
+    first = run_preparation(specimen_params)
+    files = first.chunk_files + first.voxel_files + get_composition_files(specimen_params)
+    mtimes = [os.path.getmtime(f) for f in files]
+    with h5py.File(first.voxel_ratio_file, "r") as hdfr:
+        ratios = np.array(hdfr["composition/vox_ratios"])
+
+    second = run_preparation(specimen_params)
+    assert second.chunk_files == first.chunk_files
+    assert second.voxel_files == first.voxel_files
+    assert second.chunk_files + second.voxel_files + get_composition_files(specimen_params) == files
+    assert [os.path.getmtime(f) for f in files] == mtimes
+    with h5py.File(second.voxel_ratio_file, "r") as hdfr:
+        assert np.array_equal(np.array(hdfr["composition/vox_ratios"]), ratios)
+
+    #only the voxel and composition stages are recomputed
+    specimen_params["min_voxel_ions"] = 8
+    third = run_preparation(specimen_params)
+    assert third.chunk_files == first.chunk_files
+    assert third.voxel_files != first.voxel_files
+    assert len(get_composition_files(specimen_params)) == 2
+    assert os.path.exists(first.voxel_files[0])
+
+def test_cache_eviction(tmp_path):
+    cache = StageCache(str(tmp_path))
+    entries = []
+    for i in range(3):
+        key = cache.get_key("stage", {"i": i})
+        entry = cache.get_entry("stage", key)
+        file_name = os.path.join(entry, "data.bin")
+        with open(file_name, "wb") as fout:
+            fout.write(b"0"*1024)
+        cache.store("stage", key, {"file": file_name}, [file_name])
+        os.utime(os.path.join(entry, "manifest.json"), (time.time()-i*3600, time.time()-i*3600))
+        entries.append((key, entry))
+
+    budget = cache.get_size(entries[0][1]) + cache.get_size(entries[1][1])
+    cache = StageCache(str(tmp_path), max_size_gb=budget/1024**3)
+    assert cache.lookup("stage", entries[0][0]) is not None
+    evicted = cache.evict()
+    assert evicted == [entries[2][1]]
+    assert cache.lookup("stage", entries[2][0]) is None
+
+    cache = StageCache(str(tmp_path), max_age_days=0.5/24)
+    assert cache.evict() == [entries[1][1]]
+    assert cache.lookup("stage", entries[0][0]) is not None
+
+def test_ingest_cache(specimen_params, pos_file, apt_file):
+    rrng_file = os.path.join(specimen_params["input_path"], "R31_06365-v02.rrng")
+    data = DataPreparation(specimen_params)
+    ions, rrngs = data.get_rrng(rrng_file)
+    specimen_params["cache"] = {"enabled": True}
+    cached = DataPreparation(specimen_params)
+    for file_name in [pos_file, apt_file]:
+        expected = np.concatenate(list(data.iter_ion_blocks(file_name)))
+        assert np.array_equal(data.get_ingested_ions(file_name), expected)
+        ingested = cached.get_ingested_ions(file_name)
+        assert isinstance(ingested, np.memmap)
+        assert np.array_equal(ingested, expected)
+        npy_file = ingested.filename
+        mtime = os.path.getmtime(npy_file)
+        blocks = list(cached.iter_ion_blocks(file_name, block_size=7000))
+        assert len(blocks) == 3 and np.array_equal(np.concatenate(blocks), expected)
+        assert os.path.getmtime(npy_file) == mtime
+    for i in range(2):
+        cached_ions, cached_rrngs = cached.get_rrng(rrng_file)
+        pd.testing.assert_frame_equal(cached_ions, ions)
+        pd.testing.assert_frame_equal(cached_rrngs, rrngs)
@@ -0,0 +1,36 @@
+import pytest
+import os
+import numpy as np
+from compositionspace.datautils import DataPreparation
+from compositionspace.filters import IonFilter
+from conftest import write_apt
+
+def test_filter_pos(specimen_params, pos_file, pos_ions):
+    x, y, z, m = pos_ions
+    filters = {"mass_windows": [[5, 20], [99, 101]], "cylinder": [0, 0, 15]}
+    expected = (((m >= 5) & (m <= 20)) | ((m >= 99) & (m <= 101))) & (x**2 + y**2 <= 15**2)
+    data = DataPreparation(specimen_params)
+    pos = data.get_pos(pos_file, columns=["z", "m"], block_size=3000, filters=filters)
+    assert np.array_equal(pos["z"], z[expected]) and np.array_equal(pos["m"], m[expected])
+    blocks = list(data.iter_ion_blocks(pos_file, block_size=3000, filters=filters))
+    assert np.array_equal(np.concatenate(blocks)[:,3], m[expected])
+    with pytest.raises(ValueError):
+        data.get_pos(pos_file, filters={"multiplicity": [1, 1]})
+    with pytest.raises(ValueError):
+        IonFilter.from_params({"radius": 3})
+
+def test_filter_apt(specimen_params, tmp_path, pos_ions):
+    x, y, z, m = pos_ions
+    rng = np.random.default_rng(0)
+    multiplicity = rng.integers(1, 4, len(x)).astype(np.int32)
+    xdet = rng.uniform(-40, 40, len(x)).astype(np.float32)
+    ydet = rng.uniform(-40, 40, len(x)).astype(np.float32)
+    file_name = str(tmp_path / "detector.apt")
+    write_apt(file_name, [("Mass", m[:, None]), ("Multiplicity", multiplicity[:, None]),
+                          ("XDet_mm", xdet[:, None]), ("YDet_mm", ydet[:, None]),
+                          ("Position", np.stack((x, y, z), axis=1))])
+    filters = {"box": [[-10, -10, -np.inf], [10, 10, np.inf]], "multiplicity": [1, 1], "detector_radius": 30}
+    expected = (np.abs(x) <= 10) & (np.abs(y) <= 10) & (multiplicity == 1) & (xdet**2 + ydet**2 <= 900)
+    data = DataPreparation(specimen_params)
+    apt = data.get_apt(file_name, filters=filters)
+    assert np.array_equal(apt, np.stack((x, y, z, m), axis=1)[expected])
@@ -0,0 +1,137 @@
+import pytest
+import os
+import numpy as np
+from compositionspace.models import get_model, get_model_spec, MODELS
+from compositionspace.segmentation import CompositionClustering
+from conftest import write_pos
+
+def test_registry():
+    for name in ["GaussianMixture", "BayesianGaussianMixture", "MiniBatchKMeans", "DBScan", "randomforest"]:
+        assert name in MODELS
+    assert get_model_spec("MiniBatchKMeans").partial_fit
+    assert not get_model_spec("DBScan").predict
+    model = get_model({"name": "DBScan", "DBScan": {"eps": 3, "min_samples": 5}})
+    assert model.eps == 3
+    model = get_model({"name": "GaussianMixture", "GaussianMixture": {"n_components": 2}})
+    assert model.n_components == 2 and model.max_iter == 100
+    with pytest.raises(ValueError):
+        get_model({"name": "GaussianMixture", "GaussianMixture": {"n_clusters": 2}})
+    with pytest.raises(ValueError):
+        get_model({"name": "KMeans"})
+
+def test_weighted_gaussian_mixture():
+    rng = np.random.default_rng(0)
+    rows = np.concatenate((rng.normal(0, 0.1, size=(40, 2)), rng.normal(1, 0.1, size=(20, 2))))
+    weights = rng.integers(1, 6, size=len(rows))
+    model = get_model({"name": "GaussianMixture", "GaussianMixture": {"n_components": 2, "random_state": 0}})
+
+    #the weighted initialization equals the initialization on the repeated rows
+    resp = np.zeros((len(rows), 2))
+    resp[np.arange(len(rows)), (rows[:,0] > 0.5).astype(int)] = 1
+    model._sample_weight = weights.astype(np.float64)
+    model._initialize(rows, resp)
+    model._sample_weight = None
+    weighted = (model.weights_, model.means_, model.covariances_)
+    model._initialize(np.repeat(rows, weights, axis=0), np.repeat(resp, weights, axis=0))
+    assert all(np.allclose(a, b) for a, b in zip(weighted, (model.weights_, model.means_, model.covariances_)))
+
+    model.fit(rows, sample_weight=weights)
+    order = np.argsort(model.means_[:,0])
+    weighted = (model.weights_[order], model.means_[order], model.covariances_[order])
+    model.fit(np.repeat(rows, weights, axis=0))
+    order = np.argsort(model.means_[:,0])
+    assert all(np.allclose(a, b) for a, b in zip(weighted, (model.weights_[order], model.means_[order],
+                                                            model.covariances_[order])))
+
+def test_supervised_model(specimen_params, run_preparation):
+    specimen_params["ml_models"]["name"] = "randomforest"
+    data = run_preparation(specimen_params)
+    comps = CompositionClustering(specimen_params, project=data.get_project())
+    with pytest.raises(ValueError, match="supervised"):
+        comps.get_composition_cluster_files(data.voxel_ratio_file, data.voxel_files[0], specimen_params["n_phases"])
+    data.get_project().close()
+
+@pytest.mark.parametrize("name", ["MiniBatchKMeans", "BayesianGaussianMixture", "DBScan"])
+def test_model_paths(specimen_params, name, run_preparation):
+    specimen_params["read_block_size"] = 7
+    specimen_params["ml_models"]["name"] = name
+    specimen_params["ml_models"]["DBScan"] = {"eps": 0.2, "min_samples": 3}
+    data = run_preparation(specimen_params)
+    comps = CompositionClustering(specimen_params, project=data.get_project())
+    n_voxels = len(comps.get_ratios(data.voxel_ratio_file))
+    cluster_lst, labels = comps.get_composition_cluster_files(data.voxel_ratio_file, data.voxel_files[0],
+                                                              specimen_params["n_phases"])
+    assert len(labels) == n_voxels
+    assert sum(len(cluster) for cluster in cluster_lst) == np.count_nonzero(labels >= 0)
+    assert ("model" in data.get_project().hdf) == get_model_spec(name).predict
+
+    if name == "DBScan":
+        specimen_params["fit_sample_size"] = n_voxels - 1
+        with pytest.raises(ValueError):
+            comps.get_composition_cluster_files(data.voxel_ratio_file, data.voxel_files[0], specimen_params["n_phases"])
+    data.get_project().close()
+
+def same_partition(a, b):
+    pairs = np.unique(np.column_stack((a, b)), axis=0)
+    return len(pairs) == len(np.unique(a)) == len(np.unique(b)) and np.array_equal(a < 0, b < 0)
+
+def write_two_phases(params, pos_ions):
+    #an O rich phase at x < 0 and an Fe rich phase at x >= 0
+    x, y, z, m = pos_ions
+    rng = np.random.default_rng(0)
+    m = np.where(x < 0, rng.choice([6.0, 16.0], size=len(x), p=[0.2, 0.8]),
+                 rng.choice([16.0, 55.9], size=len(x), p=[0.2, 0.8])).astype(np.float32)
+    write_pos(os.path.join(params["input_path"], "synthetic.pos"), x, y, z, m)
+
+@pytest.mark.parametrize("name", ["GaussianMixture", "DBScan"])
+def test_unique_compositions(specimen_params, pos_ions, name, run_preparation):
+    write_two_phases(specimen_params, pos_ions)
+    specimen_params["read_block_size"] = 7
+    specimen_params["random_state"] = 0
+    specimen_params["ml_models"]["name"] = name
+    specimen_params["ml_models"]["GaussianMixture"]["random_state"] = 0
+    specimen_params["ml_models"]["DBScan"] = {"eps": 0.05, "min_samples": 3}
+    data = run_preparation(specimen_params)
+    comps = CompositionClustering(specimen_params, project=data.get_project())
+    ratios = comps.get_ratios(data.voxel_ratio_file).drop(['Total_no','vox'], axis=1).values
+
+    keys, features, weights = comps.get_unique_compositions(data.voxel_ratio_file)
+    assert weights.sum() == len(ratios)
+    assert len(features) < len(ratios)
+    assert np.array_equal(np.unique(features, axis=0), np.unique(ratios, axis=0))
+
+    cluster_lst, labels = comps.get_composition_cluster_files(data.voxel_ratio_file, data.voxel_files[0],
+                                                              specimen_params["n_phases"])
+    specimen_params["unique_compositions"] = True
+    unique_lst, unique_labels = comps.get_composition_cluster_files(data.voxel_ratio_file, data.voxel_files[0],
+                                                                    specimen_params["n_phases"])
+    #the model is fitted on the unique rows only
+    assert comps.fit_rows == len(features)
+    if name == "DBScan":
+        assert same_partition(labels, unique_labels)
+    else:
+        agreement = max(np.mean(labels == unique_labels), np.mean(labels != unique_labels))
+        assert agreement > 0.95
+    data.get_project().close()
+
+def test_unique_compositions_pca(specimen_params, run_preparation):
+    specimen_params["cluster_space"] = "pca"
+    data = run_preparation(specimen_params, outfilename="ratios.h5")
+    comps = CompositionClustering(specimen_params, project=data.get_project())
+    comps.get_PCA_cumsum(data.voxel_ratio_file, save=True)
+    keys, features, weights = comps.get_unique_compositions(data.voxel_ratio_file)
+    pca = np.concatenate([block for start, block in comps.iter_ratio_blocks(data.voxel_ratio_file, stage="pca")])
+    assert np.allclose(np.unique(features, axis=0), np.unique(pca, axis=0))
+
+    #components of another number of species
+    group = data.get_project().hdf["pca"]
+    group.attrs["components"] = np.asarray(group.attrs["components"])[:,:-1].tolist()
+    with pytest.raises(ValueError):
+        comps.get_unique_compositions(data.voxel_ratio_file)
+
+    #components of a previous composition
+    comps.get_PCA_cumsum(data.voxel_ratio_file, save=True)
+    data.calculate_voxel_composition(outfilename="ratios.h5")
+    with pytest.raises(ValueError):
+        comps.get_unique_compositions(data.voxel_ratio_file)
+    data.get_project().close()
@@ -0,0 +1,39 @@
+import pytest
+import os
+import numpy as np
+import h5py
+import matplotlib
+matplotlib.use("Agg")
+from compositionspace.segmentation import CompositionClustering
+from compositionspace.postprocessing import DataPostprocess
+
+def test_project(specimen_params, run_preparation):
+    data = run_preparation(specimen_params)
+    project = data.get_project()
+    assert data.voxel_ratio_file == project.filename
+
+    comps = CompositionClustering(specimen_params, project=project)
+    comps.get_composition_clusters(data.voxel_ratio_file, data.voxel_files[0])
+    assert comps.voxel_centroid_output_file == project.filename
+    ratios = comps.get_ratios(data.voxel_ratio_file)
+
+    post = DataPostprocess(specimen_params, project=project)
+    post.DBSCAN_clustering(comps.voxel_centroid_output_file, cluster_id=0, save=True)
+    ions = post.get_post_ions(data.voxel_files[0], comps.voxel_centroid_output_file, 0)
+    project.close()
+
+    assert sorted(os.listdir(specimen_params["output_path"])) == sorted(
+        [os.path.basename(f) for f in data.chunk_files + data.voxel_files] + ["project.h5"])
+    with h5py.File(project.filename, "r") as hdfr:
+        assert list(hdfr["voxels"].attrs["files"]) == data.voxel_files
+        assert list(hdfr["composition"].attrs["columns"]) == list(ratios.columns)
+        segmentation = hdfr["segmentation"]
+        assert len(segmentation) == specimen_params["n_phases"] + 1
+        assert np.array_equal(np.sort(segmentation["0/0"][:,3]), np.sort(np.unique(ions["vox_file"])))
+        assert len(hdfr["dbscan/0"].attrs["columns"]) == 4
+
+def test_project_outfile(specimen_params, run_preparation):
+    data = run_preparation(specimen_params, outfilename="ratios.h5")
+    assert data.voxel_ratio_file == os.path.join(specimen_params["output_path"], "ratios.h5")
+    comps = CompositionClustering(specimen_params, project=data.get_project())
+    assert len(comps.get_ratios(data.voxel_ratio_file)) > 0
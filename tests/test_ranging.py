@@ -0,0 +1,69 @@
+import pytest
+import numpy as np
+import pandas as pd
+import h5py
+import os
+from compositionspace.datautils import DataPreparation, get_column
+from compositionspace.ranging import RangeTable, MoleculeTable
+from conftest import write_pos
+
+def test_species_ids():
+    data = DataPreparation("tests/experiment_params.yaml")
+    ions, rrngs = data.get_rrng("tests/data/R31_06365-v02.rrng")
+    table = RangeTable(rrngs)
+    assert list(table.species_names) == sorted(np.unique(rrngs.comp.values))
+    mass = np.array([6.0, 16.0, 100.0, 12.0])
+    spec = table.get_species_ids(mass)
+    assert spec.dtype == np.uint8
+    assert list(table.species_names[spec[[0, 1, 3]]]) == ["C:1", "O:1", "C:1"]
+    assert spec[2] == table.unranged
+
+def test_overlapping_ranges():
+    rrngs = pd.DataFrame({"lower": [1.0, 1.5], "upper": [2.0, 3.0], "comp": ["C:1", "O:1"]},
+                         index=["1", "2"])
+    with pytest.raises(ValueError):
+        RangeTable(rrngs)
+
+def test_label_ions():
+    data = DataPreparation("tests/experiment_params.yaml")
+    ions, rrngs = data.get_rrng("tests/data/R31_06365-v02.rrng")
+    pos = pd.DataFrame({"Da": [6.0, 100.0, 16.0]})
+    pos = data.get_label_ions(pos, rrngs)
+    assert list(pos["comp"]) == ["C:1", "", "O:1"]
+    assert list(pos["nature"]) == [1, "", 3]
+    assert pos["colour"][1] == "#FFFFFF"
+
+def test_molecule_table():
+    table = MoleculeTable(["C:1", "Cr:1 O:1", "O:2", "Ti:1 O:2"])
+    assert list(table.atom_names) == ["C:1", "Cr:1", "O:1", "Ti:1"]
+    parents, atom_ids = table.decompose(np.array([3, 0, 2]))
+    assert list(parents) == [0, 0, 0, 1, 2, 2]
+    assert list(table.atom_names[atom_ids]) == ["Ti:1", "O:1", "O:1", "C:1", "O:1", "O:1"]
+
+def read_slice_species(file_name):
+    with h5py.File(file_name, "r") as hdfr:
+        group = hdfr["group_xyz_Da_spec"]
+        names = np.array(list(group.attrs["spec_name_order"]))
+        spec = np.concatenate([get_column(group[key][...], "spec") for key in group.keys()])
+    return names[spec.astype(np.int64)]
+
+def test_big_slices_molecules(specimen_params, pos_ions):
+    #a tenth of the ions at 31 Da, inside a "Ti:1 O:1" range
+    x, y, z, m = pos_ions
+    m = m.copy()
+    m[::10] = 31.0
+    write_pos(os.path.join(specimen_params["input_path"], "synthetic.pos"), x, y, z, m)
+    n_molecules = len(m[::10])
+
+    data = DataPreparation(specimen_params)
+    data.get_big_slices()
+    ions = read_slice_species(data.chunk_files[0])
+    assert np.count_nonzero(ions == "Ti:1 O:1") == n_molecules
+
+    data.get_big_slices_molecules()
+    atoms = read_slice_species(data.chunk_files[0])
+    assert "Ti:1 O:1" not in atoms
+    assert len(atoms) == len(ions) + n_molecules
+    assert np.count_nonzero(atoms == "Ti:1") == n_molecules
+    assert np.count_nonzero(atoms == "O:1") == np.count_nonzero(ions == "O:1") + n_molecules
+    assert np.count_nonzero(atoms == "C:1") == np.count_nonzero(ions == "C:1")
@@ -3,6 +3,7 @@ import numpy as np
 import os
 import sys
 from compositionspace.datautils import DataPreparation
+import compositionspace.paraprobe_transcoder as paraprobe_transcoder
 def test_file_rrng():
     data = DataPreparation("tests/experiment_params.yaml")
     datarrng = data.get_rrng("tests/data/R31_06365-v02.rrng")
@@ -34,3 +35,33 @@ def test_voxelise():
     assert os.path.exists(data.voxel_ratio_file) == True
 
     
+
+def test_file_pos_blocks(pos_file, pos_ions):
+    data = DataPreparation("tests/experiment_params.yaml")
+    datapos = data.get_pos(pos_file, block_size=999)
+    assert datapos.dtype == np.dtype([('x', np.float32), ('y', np.float32), ('z', np.float32), ('m', np.float32)])
+    assert np.array_equal(datapos['z'], pos_ions[2])
+    mass = data.get_pos(pos_file, columns=['m'])
+    assert mass.dtype.names == ('m',)
+    assert np.array_equal(mass['m'], pos_ions[3])
+
+def test_file_apt_sections(apt_file, pos_ions):
+    apt = paraprobe_transcoder.paraprobe_transcoder(apt_file)
+    index = apt.index_cameca_apt()
+    assert list(index.keys()) == ["tof", "Mass", "XDet_mm", "Position"]
+    sections = apt.read_sections(["Mass"])
+    assert np.array_equal(sections["Mass"][:,0], pos_ions[3])
+    assert not hasattr(apt, "tof")
+    with pytest.raises(ValueError):
+        apt.read_sections(["Vap"])
+    data = DataPreparation("tests/experiment_params.yaml")
+    assert np.array_equal(data.get_apt(apt_file)[:,2], pos_ions[2])
+
+def test_ion_blocks(pos_file, apt_file, pos_ions):
+    data = DataPreparation("tests/experiment_params.yaml")
+    for file_name in [pos_file, apt_file]:
+        blocks = list(data.iter_ion_blocks(file_name, block_size=3000))
+        assert [len(block) for block in blocks] == [3000]*6 + [2000]
+        assert blocks[0].dtype == np.float32
+        ions = np.concatenate(blocks)
+        assert np.array_equal(ions, np.stack(pos_ions, axis=1))
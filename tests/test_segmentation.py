@@ -0,0 +1,137 @@
+import pytest
+import os
+import numpy as np
+import h5py
+import matplotlib
+matplotlib.use("Agg")
+from compositionspace.segmentation import CompositionClustering, get_bic_rises
+
+def test_streaming_fit(specimen_params, run_preparation):
+    specimen_params["read_block_size"] = 7
+    data = run_preparation(specimen_params)
+    comps = CompositionClustering(specimen_params, project=data.get_project())
+    ratios = comps.get_ratios(data.voxel_ratio_file)
+    features = ratios.drop(['Total_no','vox'], axis=1).values
+
+    assert np.allclose(comps.get_ratio_sample(data.voxel_ratio_file), features)
+    sample = comps.get_ratio_sample(data.voxel_ratio_file, n_samples=10)
+    assert sample.shape == (10, features.shape[1])
+    assert all(np.any(np.all(features == row, axis=1)) for row in sample)
+
+    cluster_lst, labels = comps.get_composition_cluster_files(data.voxel_ratio_file, data.voxel_files[0],
+                                                              specimen_params["n_phases"])
+    assert len(labels) == len(features)
+    assert np.array_equal(np.sort(np.concatenate(cluster_lst)), np.arange(len(features)))
+    with h5py.File(data.voxel_ratio_file, "r") as hdfr:
+        assert np.array_equal(hdfr["labels/labels"][...], labels)
+    data.get_project().close()
+
+def test_bics_sweep(specimen_params, run_preparation):
+    specimen_params["bics_clusters"] = 5
+    specimen_params["bics_patience"] = None
+    specimen_params["random_state"] = 0
+    data = run_preparation(specimen_params)
+    comps = CompositionClustering(specimen_params, project=data.get_project())
+    n_phases, aics, bics = comps.get_bics_minimization(data.voxel_ratio_file, data.voxel_files[0])
+    assert len(bics) == len(aics) == len(comps.bics_results["fit_times"]) == 4
+    assert n_phases == comps.bics_results["n_clusters"][int(np.argmin(bics))]
+
+    specimen_params["n_workers"] = 2
+    n_phases_parallel, aics_parallel, bics_parallel = comps.get_bics_minimization(data.voxel_ratio_file, data.voxel_files[0])
+    assert np.allclose(bics_parallel, bics)
+    assert n_phases_parallel == n_phases
+
+    #the sweep stops once the BIC rose for bics_patience counts
+    specimen_params["n_workers"] = 1
+    specimen_params["bics_clusters"] = 10
+    specimen_params["bics_patience"] = 1
+    n_phases, aics, bics = comps.get_bics_minimization(data.voxel_ratio_file, data.voxel_files[0])
+    assert len(bics) < specimen_params["bics_clusters"] - 1
+    assert bics[-1] > bics[-2]
+    assert all(bics[i] <= bics[i-1] for i in range(1, len(bics) - 1))
+    assert n_phases == int(np.argmin(bics)) + 1
+    data.get_project().close()
+
+def test_bic_rises():
+    assert get_bic_rises([5, 3, 4, 6]) == 2
+    assert get_bic_rises([5, 3, 4, 2]) == 0
+    assert get_bic_rises([5]) == 0
+
+def test_incremental_pca(specimen_params, run_preparation):
+    specimen_params["read_block_size"] = 7
+    data = run_preparation(specimen_params, outfilename="ratios.h5")
+    comps = CompositionClustering(specimen_params, project=data.get_project())
+    ratios = comps.get_ratios(data.voxel_ratio_file).drop(['Total_no','vox'], axis=1).values
+
+    cumsum, components = comps.get_PCA_cumsum(data.voxel_ratio_file, save=True)
+    assert components.shape == (ratios.shape[1], ratios.shape[1])
+    assert np.isclose(cumsum[-1], 1)
+    #the leading component matches a dense PCA up to its sign
+    centered = ratios - ratios.mean(axis=0)
+    dense = np.linalg.svd(centered, full_matrices=False)[2]
+    assert np.isclose(abs(np.dot(dense[0], components[0])), 1, atol=1e-3)
+
+    specimen_params["cluster_space"] = "pca"
+    assert comps.get_ratio_sample(data.voxel_ratio_file).shape == (len(ratios), len(components))
+    cluster_lst, labels = comps.get_composition_cluster_files(data.voxel_ratio_file, data.voxel_files[0],
+                                                              specimen_params["n_phases"])
+    assert len(labels) == len(ratios)
+    data.get_project().close()
+
+def test_stale_pca(specimen_params, run_preparation):
+    data = run_preparation(specimen_params, outfilename="ratios.h5")
+    comps = CompositionClustering(specimen_params, project=data.get_project())
+    comps.get_PCA_cumsum(data.voxel_ratio_file, save=True)
+    n_voxels = len(comps.get_ratios(data.voxel_ratio_file))
+    data.get_project().close()
+
+    #the composition is recomputed with other voxels, the saved pca is stale
+    specimen_params["voxel_size"] = 2*specimen_params["voxel_size"]
+    data = run_preparation(specimen_params, outfilename="ratios.h5")
+    comps = CompositionClustering(dict(specimen_params, cluster_space="pca"), project=data.get_project())
+    assert len(comps.get_ratios(data.voxel_ratio_file)) != n_voxels
+    with pytest.raises(ValueError):
+        comps.get_composition_cluster_files(data.voxel_ratio_file, data.voxel_files[0], specimen_params["n_phases"])
+
+    comps.get_PCA_cumsum(data.voxel_ratio_file, save=True)
+    cluster_lst, labels = comps.get_composition_cluster_files(data.voxel_ratio_file, data.voxel_files[0],
+                                                              specimen_params["n_phases"])
+    assert len(labels) == len(comps.get_ratios(data.voxel_ratio_file))
+
+    #a recomputed composition of the same voxels invalidates the pca too
+    data.calculate_voxel_composition(outfilename="ratios.h5")
+    with pytest.raises(ValueError):
+        next(comps.iter_ratio_blocks(data.voxel_ratio_file, stage="pca"))
+    data.get_project().close()
+
+def test_saved_model(specimen_params, tmp_path, run_preparation):
+    data = run_preparation(specimen_params)
+    comps = CompositionClustering(specimen_params, project=data.get_project())
+    cluster_lst, labels = comps.get_composition_cluster_files(data.voxel_ratio_file, data.voxel_files[0],
+                                                              specimen_params["n_phases"])
+    model_file = data.get_project().filename
+    data.get_project().close()
+
+    #a second specimen is labelled by the saved model without fitting
+    params = dict(specimen_params, output_path=str(tmp_path / "second"))
+    os.makedirs(params["output_path"])
+    data = run_preparation(params)
+    comps = CompositionClustering(params, project=data.get_project())
+    predicted_lst, predicted = comps.get_composition_cluster_files(data.voxel_ratio_file, data.voxel_files[0],
+                                                                   params["n_phases"], model_file=model_file)
+    assert np.array_equal(predicted, labels)
+    assert all(np.array_equal(a, b) for a, b in zip(predicted_lst, cluster_lst))
+    assert "model" not in data.get_project().hdf
+
+    #a model fitted on the ratios reads the ratios whatever the cluster_space
+    comps.get_PCA_cumsum(data.voxel_ratio_file, save=True)
+    params["cluster_space"] = "pca"
+    predicted_lst, predicted = comps.get_composition_cluster_files(data.voxel_ratio_file, data.voxel_files[0],
+                                                                   params["n_phases"], model_file=model_file)
+    assert np.array_equal(predicted, labels)
+
+    with data.get_project().write_stage(None, "composition") as group:
+        group.attrs["spec_name_order"] = ["Fe:1"]
+    with pytest.raises(ValueError):
+        comps.load_model(model_file, data.voxel_ratio_file)
+    data.get_project().close()
@@ -0,0 +1,77 @@
+import pytest
+import os
+import numpy as np
+import pandas as pd
+import h5py
+import matplotlib
+matplotlib.use("Agg")
+from compositionspace.datautils import VoxelStore
+from compositionspace.segmentation import CompositionClustering
+from compositionspace.postprocessing import DataPostprocess
+from compositionspace.storage import get_dataset_options, benchmark_storage, StorageBackend, HDF5Backend
+
+def test_dataset_options():
+    assert get_dataset_options((1000, 4), np.float32) == {}
+    options = get_dataset_options((100000, 30), np.float64, compression="gzip", compression_opts=4, chunk_kb=64)
+    assert options["chunks"] == (273, 30)
+    assert options["compression_opts"] == 4 and options["shuffle"]
+    assert get_dataset_options((10,), np.float32, compression="lzf")["chunks"] == (10,)
+    with pytest.raises(ValueError):
+        get_dataset_options((10,), np.float32, compression="zstd")
+
+def test_compressed_pipeline(specimen_params, run_preparation):
+    data = run_preparation(specimen_params)
+    with VoxelStore(data.voxel_files[0]) as store:
+        ions = np.array(store.ions)
+    with h5py.File(data.voxel_ratio_file, "r") as hdfr:
+        ratios = np.array(hdfr["composition/vox_ratios"])
+
+    specimen_params["hdf5"] = {"compression": "gzip", "chunk_kb": 16}
+    data = run_preparation(specimen_params)
+    with VoxelStore(data.voxel_files[0]) as store:
+        assert store.hdf["voxels/ions"].compression == "gzip"
+        assert not isinstance(store.ions, np.memmap)
+        assert np.array_equal(np.concatenate([block for start, block in store.iter_blocks(5000)]), ions)
+    with h5py.File(data.voxel_ratio_file, "r") as hdfr:
+        assert hdfr["composition/vox_ratios"].chunks[1] == ratios.shape[1]
+        assert np.array_equal(np.array(hdfr["composition/vox_ratios"]), ratios)
+
+def test_incomplete_backend():
+    class ReadOnlyBackend(StorageBackend):
+        def open_root(self, path, mode="r"):
+            return h5py.File(path, mode)
+    with pytest.raises(TypeError):
+        ReadOnlyBackend()
+    assert HDF5Backend().name == "hdf5"
+
+def test_benchmark_storage(tmp_path):
+    data = np.tile(np.arange(1000, dtype=np.float32), 100).reshape(-1, 4)
+    results = benchmark_storage(data, [{}, {"compression": "lzf"}], str(tmp_path))
+    assert [result["storage"] for result in results] == [{}, {"compression": "lzf"}]
+    assert results[1]["size_mb"] < results[0]["size_mb"]
+    assert all(result["write_mb_s"] > 0 for result in results)
+
+def test_zarr_backend(specimen_params, run_preparation):
+    pytest.importorskip("zarr")
+    data = run_preparation(specimen_params)
+    with VoxelStore(data.voxel_files[0]) as store:
+        ions = np.array(store.ions)
+    ratios = CompositionClustering(specimen_params, project=data.get_project()).get_ratios(data.voxel_ratio_file)
+
+    specimen_params["storage_backend"] = "zarr"
+    specimen_params["n_workers"] = 2
+    specimen_params["hdf5"] = {"compression": "lzf"}
+    data = run_preparation(specimen_params)
+    assert data.voxel_files[0].endswith(".zarr") and os.path.isdir(data.voxel_files[0])
+    with VoxelStore(data.voxel_files[0]) as store:
+        assert "parts" not in store.hdf
+        assert np.array_equal(np.concatenate([block for start, block in store.iter_blocks(5000)]), ions)
+        assert np.array_equal(store[3], ions[store.offsets[3]:store.offsets[4]])
+
+    project = data.get_project()
+    assert project.filename.endswith("project.zarr")
+    comps = CompositionClustering(specimen_params, project=project)
+    pd.testing.assert_frame_equal(comps.get_ratios(data.voxel_ratio_file), ratios)
+    comps.get_composition_clusters(data.voxel_ratio_file, data.voxel_files[0])
+    DataPostprocess(specimen_params, project=project).DBSCAN_clustering(comps.voxel_centroid_output_file, cluster_id=0, save=True)
+    assert list(project.hdf["dbscan/0"].attrs["columns"]) == ["x", "y", "z", "file_name"]
@@ -0,0 +1,88 @@
+import pytest
+import numpy as np
+import h5py
+import os
+from compositionspace.datautils import DataPreparation, VoxelStore, voxelize, get_ion_dtype, get_xyz, get_column
+
+def test_voxelize():
+    xyz = np.array([[0.5, 0.5, 0.5], [1.9, 0.1, 0.0], [2.0, 0.0, 0.0],
+                    [0.1, 0.1, -0.1], [3.0, 1.0, 1.0]], dtype=np.float32)
+    order, counts, lattice = voxelize(xyz, 2, min_ions=1)
+    assert list(counts) == [1, 2, 2]
+    assert lattice.tolist() == [[0, 0, -1], [0, 0, 0], [1, 0, 0]]
+    assert sorted(order[1:3]) == [0, 1]
+    order, counts, lattice = voxelize(xyz, 2, min_ions=2)
+    assert len(order) == 4 and list(counts) == [2, 2]
+    legacy = np.column_stack((xyz, np.ones(len(xyz)), np.arange(len(xyz))))
+    assert np.array_equal(get_xyz(legacy), xyz)
+    assert np.array_equal(get_column(legacy, "spec"), np.arange(len(xyz)))
+
+def test_voxel_store(specimen_params):
+    specimen_params["voxel_bounds"] = True
+    data = DataPreparation(specimen_params)
+    data.get_big_slices()
+    data.get_voxels()
+    with VoxelStore(data.voxel_files[0]) as store:
+        assert isinstance(store.ions, np.memmap)
+        assert store.columns == ["x", "y", "z", "Da", "spec", "vox_file"]
+        assert store.ions.dtype == get_ion_dtype(np.uint8, np.uint32)
+        assert store.ions.dtype.itemsize == 21
+        counts = store.get_counts()
+        assert len(counts) == len(store) and np.all(counts >= 5)
+        for voxel_id in [0, len(store)//2, len(store)-1]:
+            ions = store[voxel_id]
+            assert np.all(ions["vox_file"] == voxel_id)
+            xyz = get_xyz(ions)
+            lattice = np.floor(xyz/store.voxel_size)
+            assert np.all(lattice == lattice[0])
+            assert np.allclose(store.get_centroids()[voxel_id], xyz.mean(axis=0))
+            assert np.allclose(store.get_bounds()[voxel_id], np.concatenate((xyz.min(axis=0), xyz.max(axis=0))))
+
+def test_voxel_composition(specimen_params):
+    specimen_params["read_block_size"] = 3333
+    data = DataPreparation(specimen_params)
+    data.get_big_slices()
+    data.get_voxels()
+    data.calculate_voxel_composition()
+    with h5py.File(data.voxel_ratio_file, "r") as hdfr:
+        counts = np.array(hdfr["composition/vox_counts"])
+        totals = np.array(hdfr["composition/vox_totals"])
+        ratios = np.array(hdfr["composition/vox_ratios"])
+    assert np.issubdtype(totals.dtype, np.integer)
+    assert np.allclose(ratios[:,:-2].sum(axis=1), 1)
+    with VoxelStore(data.voxel_files[0]) as store:
+        assert np.array_equal(totals, store.get_counts())
+        for voxel_id in range(len(store)):
+            spec = store.get_column(store[voxel_id], "spec").astype(int)
+            assert np.array_equal(np.bincount(spec, minlength=counts.shape[1]), counts[voxel_id])
+
+def test_parallel_voxels(specimen_params):
+    data = DataPreparation(specimen_params)
+    data.get_big_slices()
+    data.get_voxels()
+    with VoxelStore(data.voxel_files[0]) as store:
+        serial_ions = np.array(store.ions)
+        serial_centroids = store.get_centroids()
+    data.params["n_workers"] = 2
+    data.get_voxels()
+    with VoxelStore(data.voxel_files[0]) as store:
+        assert np.array_equal(serial_ions, store.ions)
+        assert np.array_equal(serial_centroids, store.get_centroids())
+    assert not any("_part_" in name for name in os.listdir(specimen_params["output_path"]))
+
+def test_slice_modes(specimen_params, tmp_path):
+    rng = np.random.default_rng(0)
+    atom_spec = np.zeros(10000, dtype=get_ion_dtype())
+    atom_spec["z"] = rng.exponential(20, size=len(atom_spec))
+    specimen_params["voxel_size"] = 1
+    data = DataPreparation(specimen_params)
+    filestring = str(tmp_path / "slices.h5")
+    for slice_mode in ["length", "count"]:
+        data.params["slice_mode"] = slice_mode
+        data.write_big_slices(filestring, atom_spec, ["C:1"])
+        with h5py.File(filestring, "r") as hdfr:
+            slices = [np.array(hdfr["group_xyz_Da_spec/chunk_{}".format(i)]) for i in range(4)]
+        assert sum(len(chunk) for chunk in slices) == len(atom_spec)
+        for lower, upper in zip(slices[:-1], slices[1:]):
+            assert np.floor(lower["z"].max()) < np.floor(upper["z"].min())
+    assert max(len(chunk) for chunk in slices) < 0.3*len(atom_spec)